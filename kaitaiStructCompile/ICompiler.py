@@ -1,8 +1,15 @@
 import ast
+import hashlib
+import mmap
+import os
+import shutil
 import types
 import typing
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import IntEnum
 from pathlib import Path, PurePath
+from time import perf_counter
 
 from .defaults import subDirsNames
 from .KaitaiCompilerException import KaitaiCompilerException, issueFactory, warnInKSY
@@ -22,6 +29,17 @@ class ICompileResult:
 	def getText(self) -> str:
 		raise NotImplementedError()
 
+	@contextmanager
+	def bytesView(self) -> typing.Iterator[memoryview]:
+		"""The UTF-8 encoded text. Valid only within the `with` block."""
+		yield memoryview(self.getText().encode("utf-8"))
+
+	@property
+	def digest(self) -> str:
+		"""SHA-256 of the UTF-8 encoded text, the same as the one used in the caches"""
+		with self.bytesView() as b:
+			return hashlib.sha256(b).hexdigest()
+
 	@property
 	def needsSave(self):
 		raise NotImplementedError()
@@ -38,6 +56,27 @@ class IndexResultsBy(IntEnum):
 	fileNamesStems = 2
 
 
+class CompilePhase(IntEnum):
+	started = 0  # a source is being compiled
+	result = 1  # a module is ready, it is in `result`
+	finished = 2  # all the modules of a source are ready
+
+
+class CompileProgressEvent:
+	"""Yielded by `ICompiler.compileIter`. `elapsed` is the time in seconds since the compilation of `source` has started."""
+
+	__slots__ = ("source", "phase", "elapsed", "result")
+
+	def __init__(self, source: Path, phase: CompilePhase, elapsed: float, result: typing.Optional["ICompileResult"] = None) -> None:
+		self.source = source
+		self.phase = phase
+		self.elapsed = elapsed
+		self.result = result
+
+	def __repr__(self) -> str:
+		return self.__class__.__name__ + "(" + ", ".join((str(self.source), self.phase.name, format(self.elapsed, ".3f")) + ((repr(self.result),) if self.result is not None else ())) + ")"
+
+
 class InMemoryCompileResult(ICompileResult):
 	__slots__ = ("text",)
 
@@ -54,18 +93,60 @@ class InMemoryCompileResult(ICompileResult):
 
 
 class InFileCompileResult(InMemoryCompileResult):
-	__slots__ = ("_needsSave",)
+	"""The text is not kept in memory, it is read from the file every time it is needed, so many results can be alive at once. Hashing and copying don't decode it at all."""
+
+	__slots__ = ("_needsSave", "_digest")
 
 	def __init__(self, moduleName: str, mainClassName: str, msg: str, path):
 		self._needsSave = False
+		self._digest = None
 		super().__init__(moduleName, mainClassName, msg, None)
 		self.path = path
 
 	def getText(self):
-		if self.text is None:
-			with self.path.open("rt", encoding="utf-8") as f:
-				self.text = f.read()
-		return self.text
+		if self.text is not None:
+			return self.text
+		with self.bytesView() as b:
+			text = str(b, "utf-8")
+		if "\r" in text:  # the same as reading in text mode
+			text = text.replace("\r\n", "\n").replace("\r", "\n")
+		return text
+
+	@contextmanager
+	def bytesView(self) -> typing.Iterator[memoryview]:
+		"""A view of the mmapped file. The file is unmapped and closed on exit from the `with` block, so no descriptors are held by the results."""
+		if self.text is not None:
+			yield memoryview(self.text.encode("utf-8"))
+			return
+
+		with self.path.open("rb") as f:
+			if not os.fstat(f.fileno()).st_size:
+				yield memoryview(b"")  # empty files cannot be mmapped
+				return
+
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+				v = memoryview(m)
+				try:
+					yield v
+				finally:
+					v.release()
+
+	@property
+	def digest(self) -> str:
+		"""Computed once, on first access"""
+		if self._digest is None:
+			self._digest = super().digest
+		return self._digest
+
+	def copyTo(self, dest: Path) -> None:
+		"""Copies the file without decoding it. Uses the in-kernel copying where the OS has it."""
+		shutil.copyfile(str(self.path), str(dest))
+
+	def moveTo(self, dest: Path) -> None:
+		"""Moves the file, a rename if within the same FS. The result refers to the new location afterwards."""
+		dest = Path(dest)
+		shutil.move(str(self.path), str(dest))
+		self.path = dest
 
 	@property
 	def needsSave(self):
@@ -112,17 +193,47 @@ class WrappedResult(ICompileResult):
 		return self.__class__.__name__ + "(" + repr(self.wrapped) + ")"
 
 
+def getPostprocessingFileName(res: ICompileResult) -> typing.Union[Path, str]:
+	"""The file name passed to postprocessors. In-memory results get the name of the file they are going to be saved into, so the postprocessors matching by name (i.e. patches) work for them too."""
+	return res.path if res.path else res.moduleName + ".py"
+
+
 class PostprocessResult(WrappedResult):
 	__slots__ = ()
 
-	def __init__(self, wrapped: ICompileResult, postprocessingTasks: typing.Mapping[str, typing.Iterable[typing.Any]]) -> None:
+	def __init__(self, wrapped: ICompileResult, postprocessingTasks: typing.Mapping[str, typing.Iterable[typing.Any]], cache=None, uncacheable: typing.Container[typing.Callable] = (), text: typing.Optional[str] = None) -> None:
+		"""`text` is the result of postprocessing done elsewhere (i.e. in a worker process), if it is given, the postprocessing is not done again"""
 		super().__init__(wrapped)
-		path = self.path if self.path else "<KS in-memory result>"
-		ppi = tuple(postprocessingTasks.items())
-		for i, (postprocessor, args) in enumerate(ppi):
-			text = postprocessor(self.getText(), path, *args)
-			self.wrapped = InMemoryCompileResult(moduleName=wrapped.moduleName, mainClassName=wrapped.mainClassName, msg=wrapped.msg, text=text)
-			path = "<KS intermediate postprocessed result: " + repr(ppi[: i + 1]) + ">"
+		if not postprocessingTasks:
+			return
+
+		if text is None:
+			from .postprocessors import runCachedPostprocessingChain
+
+			text = runCachedPostprocessingChain(self.getText(), getPostprocessingFileName(wrapped), postprocessingTasks.items(), cache, uncacheable)
+		self.wrapped = InMemoryCompileResult(moduleName=wrapped.moduleName, mainClassName=wrapped.mainClassName, msg=wrapped.msg, text=text)
+
+
+def splitBatchResults(ksyPaths: typing.Iterable[Path], compileResults: typing.Mapping[str, ICompileResult], importPaths: typing.Iterable[Path]) -> typing.List[typing.Mapping[str, ICompileResult]]:
+	"""Splits the results of compiling multiple KSYs by a single backend invocation into the results each KSY would have if compiled separately. The results we cannot attribute are given to the first KSY."""
+	from .ksyImports import getModulesNamesOfKSY
+
+	res = []
+	attributed = set()
+	for p in ksyPaths:
+		targetResults = OrderedDict()
+		for moduleName in getModulesNamesOfKSY(p, importPaths):
+			r = compileResults.get(moduleName, None)
+			if r is not None:
+				targetResults[moduleName] = r
+				attributed.add(moduleName)
+		res.append(targetResults)
+
+	for moduleName, r in compileResults.items():
+		if moduleName not in attributed:
+			res[0][moduleName] = r
+
+	return res
 
 
 class IPrefsStorage:
@@ -133,6 +244,9 @@ class IPrefsStorage:
 class ICompiler:
 	__slots__ = ("progressCallback", "dirs", "namespaces", "importPath")
 
+	selectsBackend = False  # Delegating backends (i.e. the daemon) select a backend themselves. They get the selection settings of the build as `tolerableIssues` and `forcedBackend` ctor args.
+	inProcess = False  # Backends compiling within the Python process itself (i.e. the JVM one via JPype). Only they keep a warm compiler between compilations, so only they can be driven by the daemon.
+
 	def __init__(self, progressCallback=None, dirs=None, namespaces=None, importPath: typing.Optional[Path] = None) -> None:
 		if progressCallback is None:
 
@@ -155,15 +269,49 @@ class ICompiler:
 			raise KaitaiCompilerException("Source file " + str(sourceFilePath) + " doesn't exist")
 		return sourceFilePath
 
-	def compile(self, sourceFilesPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str] = (), needInMemory: bool = False, target: str = "python", verbose: typing.Optional[typing.Iterable[str]] = None, opaqueTypes: typing.Optional[bool] = None, autoRead: typing.Optional[bool] = None, readStoresPos: typing.Optional[bool] = None) -> typing.Mapping[str, ICompileResult]:
+	@staticmethod
+	def prepareDestDir(destDir: typing.Optional[Path], needInMemory: bool) -> typing.Tuple[typing.Optional[Path], bool]:
 		if destDir is not None:
-			destDir = Path(destDir).absolute()
-		else:
-			# We don't emit a warning here because `needInMemory` is a hint that we prefer avoiding disk writes
-			needInMemory = True
+			return Path(destDir).absolute(), needInMemory
+
+		# We don't emit a warning here because `needInMemory` is a hint that we prefer avoiding disk writes
+		return None, True
 
+	def compile(self, sourceFilesPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str] = (), needInMemory: bool = False, target: str = "python", verbose: typing.Optional[typing.Iterable[str]] = None, opaqueTypes: typing.Optional[bool] = None, autoRead: typing.Optional[bool] = None, readStoresPos: typing.Optional[bool] = None) -> typing.Mapping[str, ICompileResult]:
+		destDir, needInMemory = self.prepareDestDir(destDir, needInMemory)
 		sourceFilesPaths = [self.prepareSourceFilePath(p) for p in sourceFilesPaths]
 		return self.compile_(sourceFilesAbsPaths=sourceFilesPaths, destDir=destDir, additionalFlags=additionalFlags, verbose=verbose, opaqueTypes=opaqueTypes, autoRead=autoRead, readStoresPos=readStoresPos, needInMemory=needInMemory, target=target)
 
 	def compile_(self, sourceFilesAbsPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str], needInMemory: bool, target: str, verbose, opaqueTypes, autoRead, readStoresPos) -> typing.Iterable[ICompileResult]:
 		raise NotImplementedError()
+
+	def compileIter(self, sourceFilesPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str] = (), needInMemory: bool = False, target: str = "python", verbose: typing.Optional[typing.Iterable[str]] = None, opaqueTypes: typing.Optional[bool] = None, autoRead: typing.Optional[bool] = None, readStoresPos: typing.Optional[bool] = None) -> typing.Iterator[CompileProgressEvent]:
+		"""Like `compile`, but yields the progress of compilation, each module in an event of `CompilePhase.result` phase as soon as it is ready, so the caller can process it while the rest are being compiled. Each module is yielded once."""
+		destDir, needInMemory = self.prepareDestDir(destDir, needInMemory)
+		sourceFilesPaths = [self.prepareSourceFilePath(p) for p in sourceFilesPaths]
+		return self.compileIter_(sourceFilesAbsPaths=sourceFilesPaths, destDir=destDir, additionalFlags=additionalFlags, verbose=verbose, opaqueTypes=opaqueTypes, autoRead=autoRead, readStoresPos=readStoresPos, needInMemory=needInMemory, target=target)
+
+	def compileIter_(self, sourceFilesAbsPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str], needInMemory: bool, target: str, verbose, opaqueTypes, autoRead, readStoresPos) -> typing.Iterator[CompileProgressEvent]:
+		"""Compiles the sources in chunks, each by a single invocation of `compile_`, and yields the results of a chunk as soon as it is compiled. The chunks double in size, starting from a single source, so the first results come early, and the number of invocations grows only logarithmically with the number of sources. A module is reported for the first source importing it. The backends able to report the results of a single invocation as they are ready should override it."""
+		sourceFilesAbsPaths = list(sourceFilesAbsPaths)
+		importPaths = [self.importPath] if self.importPath is not None else []
+		yielded = set()
+		chunkStart = 0
+		chunkSize = 1
+		while chunkStart < len(sourceFilesAbsPaths):
+			chunk = sourceFilesAbsPaths[chunkStart : chunkStart + chunkSize]
+			chunkStart += chunkSize
+			chunkSize *= 2
+
+			start = perf_counter()
+			for src in chunk:
+				yield CompileProgressEvent(src, CompilePhase.started, 0.0)
+			results = self.compile_(sourceFilesAbsPaths=chunk, destDir=destDir, additionalFlags=additionalFlags, verbose=verbose, opaqueTypes=opaqueTypes, autoRead=autoRead, readStoresPos=readStoresPos, needInMemory=needInMemory, target=target)
+			elapsed = perf_counter() - start
+
+			for src, sourceResults in zip(chunk, splitBatchResults(chunk, results, importPaths)):
+				for moduleName, res in sourceResults.items():
+					if moduleName not in yielded:
+						yielded.add(moduleName)
+						yield CompileProgressEvent(src, CompilePhase.result, elapsed, res)
+				yield CompileProgressEvent(src, CompilePhase.finished, elapsed)
@@ -1,26 +1,55 @@
-__all__ = ("compile", "ChosenBackend")
+__all__ = ("compile", "compileIter", "ChosenBackend")
 import typing
 from pathlib import Path
 
-from .backendSelector import ChosenBackend
-from .ICompiler import ICompiler, ICompileResult, PostprocessResult
+from .ICompiler import CompilePhase, CompileProgressEvent, ICompiler, ICompileResult, PostprocessResult
 
 
-def compile(ksyFiles: typing.Union[Path, str, typing.Iterable[Path]], outputDir: Path = None, progressCallback=None, dirs=None, additionalFlags: typing.Tuple[str] = (), namespaces=None, backend: typing.Optional[typing.Type[ICompiler]] = None, **kwargs) -> typing.Dict[str, ICompileResult]:
-	if isinstance(ksyFiles, str):
-		ksyFiles = Path(ksyFiles)
-	if isinstance(ksyFiles, Path):
-		ksyFiles = [ksyFiles]
+def __getattr__(name: str) -> typing.Any:
+	# Discovering and initializing a backend is expensive, so it is done on first use, not on import
+	if name == "ChosenBackend":
+		from .backendSelector import ChosenBackend
 
+		return ChosenBackend
+	if name == "__version__":
+		# `importlib.metadata` is expensive to import too
+		from importlib.metadata import PackageNotFoundError, version
+
+		try:
+			res = version(__name__)
+		except PackageNotFoundError:
+			res = "0.0.0"  # a checkout, not installed
+		globals()[name] = res
+		return res
+	raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+def _createCompiler(progressCallback, dirs, additionalFlags: typing.Tuple[str], namespaces, backend: typing.Optional[typing.Type[ICompiler]]) -> ICompiler:
 	if namespaces is None:
 		namespaces = {"python": "."}
 
 	if backend is None:
-		backend = ChosenBackend
+		from .backendSelector import ChosenBackend as backend
+
+	# The flags given to the constructor apply to every compilation, the same way the pipeline passes the global ones
+	return backend(progressCallback=progressCallback, dirs=dirs, additionalFlags=additionalFlags, namespaces=namespaces)
+
+
+def _normalizeKSYFiles(ksyFiles: typing.Union[Path, str, typing.Iterable[Path]]) -> typing.Iterable[Path]:
+	if isinstance(ksyFiles, str):
+		ksyFiles = Path(ksyFiles)
+	if isinstance(ksyFiles, Path):
+		ksyFiles = [ksyFiles]
+	return ksyFiles
+
 
-	compiler = backend(progressCallback=progressCallback, dirs=dirs, additionalFlags=(), namespaces=namespaces)
+def compile(ksyFiles: typing.Union[Path, str, typing.Iterable[Path]], outputDir: Path = None, progressCallback=None, dirs=None, additionalFlags: typing.Tuple[str] = (), namespaces=None, backend: typing.Optional[typing.Type[ICompiler]] = None, needInMemory: bool = False, **kwargs) -> typing.Dict[str, ICompileResult]:
+	"""Without `outputDir` (or with `needInMemory`) the results are `InMemoryCompileResult`s and nothing is written into the output dir."""
+	compiler = _createCompiler(progressCallback, dirs, additionalFlags, namespaces, backend)
+	return compiler.compile(_normalizeKSYFiles(ksyFiles), outputDir, needInMemory=needInMemory, **kwargs)
 
-	if outputDir is None:
-		needInMemory = True
 
-	return compiler.compile(ksyFiles, outputDir, additionalFlags=additionalFlags, needInMemory=False, **kwargs)
+def compileIter(ksyFiles: typing.Union[Path, str, typing.Iterable[Path]], outputDir: Path = None, progressCallback=None, dirs=None, additionalFlags: typing.Tuple[str] = (), namespaces=None, backend: typing.Optional[typing.Type[ICompiler]] = None, needInMemory: bool = False, **kwargs) -> typing.Iterator[CompileProgressEvent]:
+	"""Like `compile`, but yields `CompileProgressEvent`s; each module is in `result` of an event of `CompilePhase.result` phase as soon as it is ready."""
+	compiler = _createCompiler(progressCallback, dirs, additionalFlags, namespaces, backend)
+	return compiler.compileIter(_normalizeKSYFiles(ksyFiles), outputDir, needInMemory=needInMemory, **kwargs)
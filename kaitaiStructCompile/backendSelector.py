@@ -1,17 +1,18 @@
+import os
+import stat
+import sys
 import typing
 import warnings
 from collections import OrderedDict
+from importlib import import_module
 from itertools import chain
 from pathlib import Path
 
-from . import ICompiler as ICompilerModule
 from . import defaults, utils
 from .KaitaiCompilerException import KaitaiCompilerException
 
-try:
-	from lazy_object_proxy import Proxy as LOProxy
-except ImportError:
-	LOProxy = None
+# `from . import ICompiler` would give the class, `__init__` shadows the submodule with it
+ICompilerModule = import_module(".ICompiler", __package__)
 
 defaultPriority = 0
 
@@ -22,28 +23,53 @@ try:
 	from importlib.metadata import EntryPoint, entry_points
 
 	def _discoverEntryPoints(key: str) -> OrderedDict:
+		eps = entry_points()
+		if hasattr(eps, "select"):
+			return eps.select(group=key)
 		try:
-			return entry_points()[key]
+			return eps[key]
 		except KeyError:
 			return {}
 
+	def _makeEntryPoint(name: str, value: str) -> EntryPoint:
+		return EntryPoint(name, value, ENTRY_POINT_KEY)
+
+	def _getEntryPointValue(ep: EntryPoint) -> str:
+		return ep.value
+
 except ImportError:
 	from pkg_resources import EntryPoint, iter_entry_points
 
 	def _discoverEntryPoints(key: str) -> OrderedDict:
 		return iter_entry_points(group=key)
 
+	def _makeEntryPoint(name: str, value: str) -> EntryPoint:
+		return EntryPoint.parse(name + " = " + value)
+
+	def _getEntryPointValue(ep: EntryPoint) -> str:
+		return ep.module_name + (":" + ".".join(ep.attrs) if ep.attrs else "")
+
+
+def _getEntryPointDistVersion(ep: EntryPoint) -> typing.Optional[str]:
+	dist = getattr(ep, "dist", None)
+	if dist is None:
+		return None
+	return getattr(dist, "version", None)
+
 
 class BackendDescriptor:
-	__slots__ = ("entryPoint", "name", "prio", "issues")
+	__slots__ = ("entryPoint", "name", "prio", "issues", "version")
 
-	def __init__(self, entryPoint: EntryPoint, name: str, prio: int = defaultPriority, issues: set = None) -> None:
+	def __init__(self, entryPoint: EntryPoint, name: str, prio: int = defaultPriority, issues: set = None, version: typing.Optional[str] = None) -> None:
 		self.entryPoint = entryPoint
 		self.name = name
 		self.prio = prio
 		if issues:
 			issues = set(issues)
 		self.issues = issues
+		if version is None:
+			version = _getEntryPointDistVersion(entryPoint)
+		self.version = version
 
 	@property
 	def broken(self) -> bool:
@@ -52,13 +78,18 @@ class BackendDescriptor:
 	def __repr__(self):
 		return self.__class__.__name__ + "(" + repr(self.entryPoint) + ")"
 
+	@property
+	def identity(self) -> str:
+		"""Identifies the backend and its version without loading it"""
+		return self.name + "=" + _getEntryPointValue(self.entryPoint) + "@" + str(self.version)
+
 	def __call__(self) -> ICompilerModule.ICompiler:
 		"""Initializes a backend"""
 		init = self.entryPoint.load()
 		return init(ICompilerModule, KaitaiCompilerException, utils, defaults)
 
 
-def recognizeBackends(b: EntryPoint) -> BackendDescriptor:
+def recognizeBackends(b: EntryPoint, version: typing.Optional[str] = None) -> BackendDescriptor:
 	if hasattr(b.__class__, "__slots__") and "metadata" in b.__class__.__slots__:
 		metadata = b.metadata
 	else:
@@ -70,47 +101,250 @@ def recognizeBackends(b: EntryPoint) -> BackendDescriptor:
 				metadata = utils.json.loads(encoded[1])
 			except BaseException:
 				warnings.warn("Entry point " + repr(b) + " is invalid. The value after @ must be must be a valid JSON!.")
-				return BackendDescriptor(b, backendName, prio=-1)  # broken, so not using
+				return BackendDescriptor(b, backendName, prio=-1, version=version)  # broken, so not using
 		else:
 			metadata = None
 
 	if metadata is not None:
 		if isinstance(metadata, int):
-			return BackendDescriptor(b, backendName, prio=metadata)  # it is priority
+			return BackendDescriptor(b, backendName, prio=metadata, version=version)  # it is priority
 		elif isinstance(metadata, dict):
-			return BackendDescriptor(b, backendName, **metadata)
+			return BackendDescriptor(b, backendName, version=version, **metadata)
 		else:
 			warnings.warn("Entry point " + repr(b) + " is invalid. The value after @ must be must be either a dict, or a number!.")
-			return BackendDescriptor(b, backendName, prio=-1)  # broken, so not using
+			return BackendDescriptor(b, backendName, prio=-1, version=version)  # broken, so not using
 	else:
-		return BackendDescriptor(b, backendName)
+		return BackendDescriptor(b, backendName, version=version)
+
+
+def parseAdditionalEntryPoints(lines: typing.Iterable[str]) -> typing.Iterator[EntryPoint]:
+	"""Parses entry points from the lines in the format `name = module:attr`, as they are written in `entry_points.txt`"""
+	for l in lines:
+		l = l.strip()
+		if not l or l[0] == "#":
+			continue
+		name, value = l.split("=", 1)
+		yield _makeEntryPoint(name.strip(), value.strip())
 
 
 def discoverOurEntryPoints():
-	return _discoverEntryPoints(ENTRY_POINT_KEY)
+	return chain(_discoverEntryPoints(ENTRY_POINT_KEY), parseAdditionalEntryPoints(utils.getAdditionalBackendEntryPointSources()))
 
 
-def entryPointsIntoBackends(pts: typing.Iterable[EntryPoint]):
-	backendsList = sorted(filter(lambda b: not b.broken, map(recognizeBackends, pts)), key=lambda b: b.prio, reverse=True)
+def descriptorsIntoBackends(descriptors: typing.Iterable[BackendDescriptor]) -> OrderedDict:
+	backendsList = sorted(filter(lambda b: not b.broken, descriptors), key=lambda b: b.prio, reverse=True)
 	return OrderedDict(((b.name, b) for b in backendsList))
 
 
+def entryPointsIntoBackends(pts: typing.Iterable[EntryPoint]):
+	return descriptorsIntoBackends(map(recognizeBackends, pts))
+
+
+DISCOVERY_CACHE_FORMAT_VERSION = 1
+DISTRIBUTIONS_METADATA_SUFFIXES = (".dist-info", ".egg-info", ".egg-link", ".pth")
+
+
+def getDistributionsFingerprint() -> list:
+	"""The mtimes of `sys.path` dirs and of the metadata of the distributions within them. Installing, uninstalling or reinstalling a distribution changes it."""
+	res = []
+	for d in sys.path:
+		try:
+			st = os.stat(d or ".")
+		except OSError:
+			continue
+
+		rec = [d, st.st_mtime_ns]
+		if stat.S_ISDIR(st.st_mode):
+			try:
+				with os.scandir(d or ".") as it:
+					rec.append(sorted([e.name, e.stat().st_mtime_ns] for e in it if e.name.endswith(DISTRIBUTIONS_METADATA_SUFFIXES)))
+			except OSError:
+				pass
+		res.append(rec)
+	return res
+
+
+def getDiscoveryCacheFile() -> Path:
+	"""Each interpreter and `sys.path` gets own file"""
+	from .cache import hashJSONable
+
+	return utils.getUserCacheDir() / "backendsDiscovery" / (hashJSONable([sys.executable, sys.path])[:16] + ".json")
+
+
+def _loadDiscoveryCache(cacheFile: Path, fingerprint: list) -> typing.Optional[list]:
+	try:
+		with cacheFile.open("rb") as f:
+			o = utils.json.loads(f.read().decode("utf-8"))
+	except (OSError, ValueError):
+		return None
+
+	if not isinstance(o, dict) or o.get("version", None) != DISCOVERY_CACHE_FORMAT_VERSION or o.get("fingerprint", None) != fingerprint:
+		return None
+	return o.get("entryPoints", None)
+
+
+def _saveDiscoveryCache(cacheFile: Path, fingerprint: list, rows: list) -> None:
+	from .cache import atomicWrite
+
+	try:
+		cacheFile.parent.mkdir(parents=True, exist_ok=True)
+		atomicWrite(cacheFile, utils.json.dumps({"version": DISCOVERY_CACHE_FORMAT_VERSION, "fingerprint": fingerprint, "entryPoints": rows}).encode("utf-8"))
+	except OSError:
+		pass  # the cache is just an optimization
+
+
+def discoverInstalledEntryPoints() -> typing.List[typing.Tuple[str, str, typing.Optional[str]]]:
+	"""Returns `(name, value, distribution version)` of our entry points of the installed distributions. The result is persisted and reused by other processes until a distribution is installed or removed, so they don't scan the metadata of all the distributions."""
+	fingerprint = utils.json.loads(utils.json.dumps(getDistributionsFingerprint()))
+	cacheFile = getDiscoveryCacheFile()
+
+	rows = _loadDiscoveryCache(cacheFile, fingerprint)
+	if rows is not None:
+		return [tuple(r) for r in rows]
+
+	rows = [(ep.name, _getEntryPointValue(ep), _getEntryPointDistVersion(ep)) for ep in _discoverEntryPoints(ENTRY_POINT_KEY)]
+	_saveDiscoveryCache(cacheFile, fingerprint, rows)
+	return rows
+
+
 def discoverBackends() -> OrderedDict:
-	return entryPointsIntoBackends(discoverOurEntryPoints())
+	installed = (recognizeBackends(_makeEntryPoint(name, value), version=version) for name, value, version in discoverInstalledEntryPoints())
+	# Not cached: env is cheap to parse and may differ between processes
+	additional = map(recognizeBackends, parseAdditionalEntryPoints(utils.getAdditionalBackendEntryPointSources()))
+	return descriptorsIntoBackends(chain(installed, additional))
+
+
+def getDiscoveredBackends() -> OrderedDict:
+	"""Discovers the backends on first call"""
+	res = globals().get("discoveredBackends", None)
+	if res is None:
+		res = __getattr__("discoveredBackends")
+	return res
+
+
+BACKEND_RANKINGS = ("prio", "latency")
+LATENCY_CACHE_FORMAT_VERSION = 1
+CALIBRATION_RUNS = 3
+CALIBRATION_SPEC = """meta:
+  id: calibration
+  endian: le
+seq:
+  - id: magic
+    contents: [0x4b, 0x53]
+  - id: len_body
+    type: u2
+  - id: body
+    size: len_body
+"""
+
+
+def getLatencyIdentity(b: BackendDescriptor, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> str:
+	"""The latency depends on the KSC the backend uses too, so a custom `kaitaiStructRoot` is a part of the identity"""
+	if kaitaiStructRoot is None:
+		return b.identity
+	return b.identity + ";" + str(Path(kaitaiStructRoot).absolute())
+
+
+def getLatencyCacheFile(identity: str) -> Path:
+	"""Each backend version gets own file, so upgrading a backend recalibrates it"""
+	from .cache import hashJSONable
+
+	return utils.getUserCacheDir() / "backendsLatency" / (hashJSONable(identity)[:16] + ".json")
+
+
+def calibrateBackend(b: BackendDescriptor, runs: int = CALIBRATION_RUNS, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> typing.Optional[float]:
+	"""Returns the best of wall-clock times of compiling a tiny reference spec, in seconds. The backends failing to initialize, to compile it or producing nothing are unhealthy, `None` is returned for them."""
+	from tempfile import TemporaryDirectory
+	from time import perf_counter
+
+	from . import _createCompiler
+
+	try:
+		compiler = _createCompiler(None, kaitaiStructRoot, (), None, b())
+		with TemporaryDirectory(prefix="kaitaiStructCompileCalibration") as d:
+			ksy = Path(d) / "calibration.ksy"
+			ksy.write_text(CALIBRATION_SPEC, encoding="utf-8")
+			best = None
+			for i in range(runs):
+				start = perf_counter()
+				res = compiler.compile((ksy,), Path(d), needInMemory=True)
+				duration = perf_counter() - start
+				if not res or not all(r.getText() for r in res.values()):
+					warnings.warn("Backend " + b.name + " has produced nothing for the calibration spec")
+					return None
+				best = duration if best is None else min(best, duration)
+			return best
+	except Exception as ex:
+		warnings.warn(repr(ex) + " when calibrating backend " + b.name)
+		return None
+
+
+def _loadLatencyCache(cacheFile: Path, identity: str) -> typing.Tuple[bool, typing.Optional[float]]:
+	try:
+		with cacheFile.open("rb") as f:
+			o = utils.json.loads(f.read().decode("utf-8"))
+	except (OSError, ValueError):
+		return False, None
+
+	if not isinstance(o, dict) or o.get("version", None) != LATENCY_CACHE_FORMAT_VERSION or o.get("identity", None) != identity:
+		return False, None
+	return True, o.get("seconds", None)
+
+
+def _saveLatencyCache(cacheFile: Path, identity: str, seconds: typing.Optional[float]) -> None:
+	from .cache import atomicWrite
+
+	try:
+		cacheFile.parent.mkdir(parents=True, exist_ok=True)
+		atomicWrite(cacheFile, utils.json.dumps({"version": LATENCY_CACHE_FORMAT_VERSION, "identity": identity, "seconds": seconds}).encode("utf-8"))
+	except OSError:
+		pass  # the cache is just an optimization
+
+
+_backendsLatencies = {}  # Also remembered for the lifetime of the process, so a backend is calibrated once even if the cache dir is not writable
+
+
+def getBackendLatency(b: BackendDescriptor, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> typing.Optional[float]:
+	"""Returns the calibrated latency of a backend, `None` for unhealthy ones. Only a backend having no timing cached is initialized and calibrated, once per its version, the result is persisted in the user cache dir; remove `backendsLatency` dir from it to recalibrate."""
+	identity = getLatencyIdentity(b, kaitaiStructRoot)
+	if identity in _backendsLatencies:
+		return _backendsLatencies[identity]
+
+	cacheFile = getLatencyCacheFile(identity)
+	found, seconds = _loadLatencyCache(cacheFile, identity)
+	if not found:
+		seconds = calibrateBackend(b, kaitaiStructRoot=kaitaiStructRoot)
+		_saveLatencyCache(cacheFile, identity, seconds)
+	_backendsLatencies[identity] = seconds
+	return seconds
+
+
+def rankBackendsByLatency(backends: typing.Iterable[BackendDescriptor], debugPrint: bool = False, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> typing.List[BackendDescriptor]:
+	"""The healthy backends, the fastest first, then the unhealthy ones. The ties and the unhealthy ones keep their static priority order."""
+	latencies = []
+	for b in backends:
+		latency = getBackendLatency(b, kaitaiStructRoot)
+		if debugPrint:
+			print("Backend", b, "latency:", latency, "s")
+		latencies.append((b, latency))
+	latencies.sort(key=lambda r: (r[1] is None, r[1] or 0.0))
+	return [b for b, latency in latencies]
 
 
-if LOProxy:
-	discoveredBackends = LOProxy(discoverBackends)
-else:
-	discoveredBackends = discoverBackends()
-	print(discoveredBackends)
+def getBackendRanking(ranking: typing.Optional[str] = None) -> str:
+	"""`prio` (the default) orders backends by the static priorities from their entry points metadata, `latency` by the calibrated latencies"""
+	if not ranking:
+		ranking = utils.getBackendRankingFromEnv() or BACKEND_RANKINGS[0]
+	if ranking not in BACKEND_RANKINGS:
+		raise ValueError("Backend ranking must be one of " + repr(BACKEND_RANKINGS) + ", not " + repr(ranking))
+	return ranking
 
 
-def iterateSuitableBackends(tolerableIssues=None, backendsPresent: typing.Mapping[str, BackendDescriptor] = None, forcedBackend=None, debugPrint: bool = False) -> typing.Iterator[BackendDescriptor]:
-	"""Iterates suitable backends. Suitability is determined by the arguments."""
+def iterateSuitableBackends(tolerableIssues=None, backendsPresent: typing.Mapping[str, BackendDescriptor] = None, forcedBackend=None, debugPrint: bool = False, ranking: typing.Optional[str] = None, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> typing.Iterator[BackendDescriptor]:
+	"""Iterates suitable backends. Suitability is determined by the arguments, the order by `ranking` (see `getBackendRanking`). `kaitaiStructRoot` is the one the backends are calibrated with."""
 
 	if backendsPresent is None:
-		backendsPresent = discoveredBackends
+		backendsPresent = getDiscoveredBackends()
 	if tolerableIssues is None:
 		tolerableIssues = utils.getTolerableIssuesFromEnv()
 
@@ -123,7 +357,17 @@ def iterateSuitableBackends(tolerableIssues=None, backendsPresent: typing.Mappin
 	if forcedBackend:
 		backendsPresent = {forcedBackend: backendsPresent[forcedBackend]}
 
-	for b in backendsPresent.values():
+	suitable = filterSuitableBackends(backendsPresent.values(), tolerableIssues, debugPrint)
+	if getBackendRanking(ranking) == "latency":
+		suitable = list(suitable)
+		if len(suitable) > 1:  # a single one needs no calibration
+			suitable = rankBackendsByLatency(suitable, debugPrint, kaitaiStructRoot)
+
+	yield from suitable
+
+
+def filterSuitableBackends(backends: typing.Iterable[BackendDescriptor], tolerableIssues: typing.Set[str], debugPrint: bool = False) -> typing.Iterator[BackendDescriptor]:
+	for b in backends:
 		if debugPrint:
 			print("Considering backend", b)
 		if b.issues:
@@ -136,17 +380,61 @@ def iterateSuitableBackends(tolerableIssues=None, backendsPresent: typing.Mappin
 		yield b
 
 
-def selectAndInitializeBackend(tolerableIssues=None, backendsPresent: typing.Mapping[str, BackendDescriptor] = None, forcedBackend=None, debugPrint: bool = False) -> typing.Optional[ICompilerModule.ICompiler]:
-	"""Selects and initializes the first suitable backend from the all available."""
+_selectedBackends = {}
+
+
+def clearSelectedBackendsCache() -> None:
+	"""Forgets the selected backends and the latencies calibrated in this process"""
+	_selectedBackends.clear()
+	_backendsLatencies.clear()
+
+
+def selectAndInitializeBackendWithDescriptor(tolerableIssues=None, backendsPresent: typing.Mapping[str, BackendDescriptor] = None, forcedBackend=None, debugPrint: bool = False, ranking: typing.Optional[str] = None, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> typing.Tuple[typing.Optional[BackendDescriptor], typing.Optional[ICompilerModule.ICompiler]]:
+	"""Selects and initializes the first suitable backend from the all available, in the order of `ranking`. Returns its descriptor too. The backends selected from the discovered ones are remembered for the lifetime of the process."""
+
+	if tolerableIssues is None:
+		tolerableIssues = utils.getTolerableIssuesFromEnv()
+	if forcedBackend is None:
+		forcedBackend = utils.getForcedBackendFromEnv()
+	ranking = getBackendRanking(ranking)
 
-	for b in iterateSuitableBackends(tolerableIssues=tolerableIssues, backendsPresent=backendsPresent, forcedBackend=forcedBackend, debugPrint=debugPrint):
+	memoKey = None
+	if backendsPresent is None:
+		memoKey = (frozenset(tolerableIssues), forcedBackend, ranking, str(kaitaiStructRoot))
+		res = _selectedBackends.get(memoKey, None)
+		if res is not None:
+			return res
+
+	for b in iterateSuitableBackends(tolerableIssues=tolerableIssues, backendsPresent=backendsPresent, forcedBackend=forcedBackend, debugPrint=debugPrint, ranking=ranking, kaitaiStructRoot=kaitaiStructRoot):
 		try:
-			return b()
+			res = (b, b())
 		except Exception as ex:
 			warnings.warn(repr(ex) + " when loading backend " + b.entryPoint.name)
-			pass
+			continue
+
+		if memoKey is not None:
+			_selectedBackends[memoKey] = res
+		return res
+
+	return None, None
+
+
+def selectAndInitializeBackend(tolerableIssues=None, backendsPresent: typing.Mapping[str, BackendDescriptor] = None, forcedBackend=None, debugPrint: bool = False, ranking: typing.Optional[str] = None, kaitaiStructRoot: typing.Optional[typing.Union[Path, str]] = None) -> typing.Optional[ICompilerModule.ICompiler]:
+	"""Selects and initializes the first suitable backend from the all available."""
+
+	return selectAndInitializeBackendWithDescriptor(tolerableIssues=tolerableIssues, backendsPresent=backendsPresent, forcedBackend=forcedBackend, debugPrint=debugPrint, ranking=ranking, kaitaiStructRoot=kaitaiStructRoot)[1]
+
+
+_lazyGlobals = {
+	"discoveredBackends": discoverBackends,
+	"ChosenBackend": selectAndInitializeBackend,
+}
+
 
-if LOProxy:
-	ChosenBackend = LOProxy(selectAndInitializeBackend)
-else:
-	ChosenBackend = selectAndInitializeBackend()
+def __getattr__(name: str) -> typing.Any:
+	"""`discoveredBackends` and `ChosenBackend` are computed on first access and then stored as usual globals"""
+	factory = _lazyGlobals.get(name, None)
+	if factory is None:
+		raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+	res = globals()[name] = factory()
+	return res
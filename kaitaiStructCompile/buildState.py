@@ -0,0 +1,90 @@
+import typing
+from pathlib import Path
+
+from .cache import atomicWrite, hashJSONable
+from .dependencyGraph import KSYDependencyGraph
+from .ICompiler import ICompileResult, InFileCompileResult
+from .ksyScanner import KSYDirsIndex
+from .utils import getUserCacheDir, json
+
+
+def getDefaultStateDir(prefixPath: Path) -> Path:
+	"""Each project gets own dir, so they don't pollute each other's checkouts"""
+	return getUserCacheDir() / "states" / hashJSONable(str(Path(prefixPath).absolute()))[:16]
+
+
+class BuildState:
+	"""What is remembered between builds of a project for incremental rebuilds: the graph of imports of KSYs, the listings of the dirs with them and what each target has been built from and into"""
+
+	__slots__ = ("dir", "graph", "dirsIndex", "targets", "newTargets", "affected")
+
+	GRAPH_FILE_NAME = "ksyDependencyGraph.json"
+	DIRS_INDEX_FILE_NAME = "ksyDirsIndex.json"
+	TARGETS_FILE_NAME = "targets.json"
+
+	def __init__(self, dir: Path) -> None:
+		self.dir = Path(dir)
+		self.graph = KSYDependencyGraph.load(self.graphFile)
+		self.dirsIndex = KSYDirsIndex.load(self.dirsIndexFile)
+		self.targets = self._loadTargets()
+		self.newTargets = {}
+		self.affected = None
+
+	@property
+	def graphFile(self) -> Path:
+		return self.dir / self.__class__.GRAPH_FILE_NAME
+
+	@property
+	def dirsIndexFile(self) -> Path:
+		return self.dir / self.__class__.DIRS_INDEX_FILE_NAME
+
+	@property
+	def targetsFile(self) -> Path:
+		return self.dir / self.__class__.TARGETS_FILE_NAME
+
+	def _loadTargets(self) -> dict:
+		try:
+			with self.targetsFile.open("rb") as f:
+				return json.loads(f.read().decode("utf-8"))
+		except (OSError, ValueError):
+			return {}
+
+	def updateGraph(self, ksysWithImportPaths: typing.Iterable[typing.Tuple[Path, typing.Iterable[Path]]]) -> typing.Set[str]:
+		"""Syncs the graph with the files. Returns the KSYs needing recompilation because of the changes since the previous build."""
+		changed = self.graph.update(ksysWithImportPaths)
+		self.affected = self.graph.affectedBy(changed)
+		return self.affected
+
+	def getUpToDateResults(self, resultFilePath: Path, ksyPath: Path, targetKey: str) -> typing.Optional[typing.List[typing.Tuple[ICompileResult, Path]]]:
+		"""Returns the results of the previous build of a target, if neither the KSY, nor anything it imports, nor the settings have changed since then, and the results are still in place"""
+		rec = self.targets.get(str(resultFilePath), None)
+		if rec is None or rec["ksy"] != str(ksyPath) or rec["key"] != targetKey:
+			return None
+
+		if ksyPath not in self.graph or str(ksyPath.absolute()) in self.affected:
+			return None
+
+		res = []
+		for m in rec["outputs"]:
+			p = Path(m["path"])
+			if not p.is_file():
+				return None
+			res.append((InFileCompileResult(m["moduleName"], m["mainClassName"], m["msg"], p), p))
+
+		self.newTargets[str(resultFilePath)] = rec
+		return res
+
+	def recordTarget(self, resultFilePath: Path, ksyPath: Path, targetKey: str, resultsWithPaths: typing.Iterable[typing.Tuple[ICompileResult, Path]]) -> None:
+		self.newTargets[str(resultFilePath)] = {
+			"ksy": str(ksyPath),
+			"key": targetKey,
+			"outputs": [{"moduleName": res.moduleName, "mainClassName": res.mainClassName, "msg": res.msg, "path": str(savePath)} for res, savePath in resultsWithPaths],
+		}
+
+	def save(self) -> None:
+		"""Must be called only after the build has succeeded. The targets not built this time are forgotten."""
+		self.graph.save(self.graphFile)
+		self.dirsIndex.save(self.dirsIndexFile)
+		atomicWrite(self.targetsFile, json.dumps(self.newTargets).encode("utf-8"))
+		self.targets = self.newTargets
+		self.newTargets = {}
@@ -1,22 +1,44 @@
+import json
 import os
 import typing
 import warnings
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
 from copy import deepcopy
 from importlib import import_module
+from itertools import chain
 from pathlib import Path
+from queue import Empty, Queue
+from tempfile import TemporaryDirectory
 
-from ..backendSelector import selectAndInitializeBackend
+from ..backendSelector import iterateSuitableBackends, selectAndInitializeBackendWithDescriptor
+from ..buildState import BuildState, getDefaultStateDir
+from ..cache import CacheStats, DiskCache, computeCompileCacheKey, dirFingerprint, hashJSONable, postprocessingChainIdentity, writeIfChanged
 from ..colors import styles
-from ..ICompiler import InFileCompileResult, InMemoryCompileResult, PostprocessResult
-from ..postprocessors import postprocessors
+from ..defaults import subDirsNames
+from ..ICompiler import CompilePhase, ICompileResult, InFileCompileResult, InMemoryCompileResult, PostprocessResult, getPostprocessingFileName
+from ..ksyImports import getModulesNamesOfKSY
+from ..ksyScanner import KSYDirsIndex, walkKSYs
+from ..postprocessors import postprocessors, resolvePostprocessor, runCachedPostprocessingChain
 from ..schemas import schema
-from ..utils import getTolerableIssuesFromEnv
+from ..tracing import getTraceFileFromEnv, getTracer, message, span, startTracing, stopTracing
+from ..utils import KSCDirs, getTolerableIssuesFromEnv, getUserCacheDir
 
-try:
-	from ..schemas.validators import validator
-except ImportError as ex:
-	validator = None
-	warnings.warn("Cannot import kaitaiStructCompile.schemas: " + str(ex) + " . Skipping JSONSchema validation...")
+from ..schemas.validators import validateCfg as _validateCfg
+
+validationAvailable = True
+
+
+def validateCfg(cfg) -> None:
+	"""`jsonschema` is imported on first validation, if it is missing the validation is skipped"""
+	global validationAvailable
+	if not validationAvailable:
+		return
+	try:
+		_validateCfg(cfg)
+	except ImportError as ex:
+		validationAvailable = False
+		warnings.warn("Cannot import jsonschema: " + str(ex) + " . Skipping JSONSchema validation...")
 
 
 def empty(o, k):
@@ -27,6 +49,12 @@ def prepareFdir(repoURI, refspec, fdir):
 	if empty(fdir, "update"):
 		fdir["update"] = schema["definitions"]["formatsRepoRefspec"]["properties"]["update"]["default"]
 
+	if "updateTTL" not in fdir:
+		fdir["updateTTL"] = schema["definitions"]["formatsRepoRefspec"]["properties"]["updateTTL"]["default"]
+
+	if "sparse" not in fdir:
+		fdir["sparse"] = schema["definitions"]["formatsRepoRefspec"]["properties"]["sparse"]["default"]
+
 	if empty(fdir, "git"):
 		if not repoURI:
 			repoURI = schema["definitions"]["formatsRepoRefspec"]["properties"]["git"]["default"]
@@ -70,9 +98,37 @@ def preparePathInCfg(cfg, schema, propName: str, prefixPath: Path) -> Path:
 	return res
 
 
+def prepareCacheCfg(cacheCfg, prefixPath: Path, specName: str = "cacheSpec"):
+	for k, v in schema["definitions"][specName]["properties"].items():
+		if k not in cacheCfg:
+			cacheCfg[k] = v["default"]
+
+	cacheDir = cacheCfg["dir"]
+	if cacheDir is not None and not isinstance(cacheDir, Path):
+		cacheCfg["dir"] = prefixPath / cacheDir
+
+
+def isTracingRequested(cfg) -> bool:
+	return getTraceFileFromEnv() is not None or bool(cfg.get("trace", None))
+
+
 def prepareCfg(cfg):
+	"""Starts tracing, if it is enabled, so that the preparation of the config is traced by all the build system plugins. The tracing is stopped by `doTranspilationWithCfg`."""
+	if isTracingRequested(cfg):
+		startTracing()
+	try:
+		with span("config preparation"):
+			_prepareCfg(cfg)
+	except BaseException:
+		stopTracing()
+		raise
+
+
+def _prepareCfg(cfg):
 	if empty(cfg, "postprocessors"):
 		cfg["postprocessors"] = type(postprocessors)(postprocessors)
+	else:
+		cfg["postprocessors"] = type(cfg["postprocessors"])((k, resolvePostprocessor(v)) for k, v in cfg["postprocessors"].items())
 
 	if empty(cfg, "tolerableIssues"):
 		cfg["tolerableIssues"] = schema["properties"]["tolerableIssues"]["default"]
@@ -80,12 +136,19 @@ def prepareCfg(cfg):
 	if empty(cfg, "forceBackend"):
 		cfg["forceBackend"] = schema["properties"]["forceBackend"]["default"]
 
+	if empty(cfg, "backendRanking"):
+		cfg["backendRanking"] = schema["properties"]["backendRanking"]["default"]
+
 	if empty(cfg, "kaitaiStructRoot"):
 		cfg["kaitaiStructRoot"] = schema["properties"]["kaitaiStructRoot"]["default"]
 
 	if "search" not in cfg:
 		cfg["search"] = schema["definitions"]["search"]["default"]
 
+	for k in ("searchInclude", "searchExclude"):
+		if k not in cfg:
+			cfg[k] = list(schema["definitions"][k]["default"])
+
 	if empty(cfg, "flags"):
 		cfg["flags"] = {}
 
@@ -97,9 +160,39 @@ def prepareCfg(cfg):
 
 	prepareCompilerFlags(cfg["flags"])
 
-	if validator is not None:
-		validator.check_schema(cfg)
-		validator.validate(cfg)
+	if "incremental" not in cfg:
+		cfg["incremental"] = schema["properties"]["incremental"]["default"]
+
+	preparePathInCfg(cfg, schema, "stateDir", prefixPath)
+	preparePathInCfg(cfg, schema, "trace", prefixPath)
+
+	if "inMemory" not in cfg:
+		cfg["inMemory"] = schema["properties"]["inMemory"]["default"]
+
+	if "jobs" not in cfg:
+		cfg["jobs"] = schema["properties"]["jobs"]["default"]
+	cfg["jobs"] = int(cfg["jobs"])  # setuptools passes command line options as strings
+
+	if cfg.get("postprocessingJobs", None) is None:
+		cfg["postprocessingJobs"] = schema["properties"]["postprocessingJobs"]["default"]
+	else:
+		cfg["postprocessingJobs"] = int(cfg["postprocessingJobs"])
+
+	if empty(cfg, "cache"):
+		cfg["cache"] = {}
+	prepareCacheCfg(cfg["cache"], prefixPath)
+
+	if empty(cfg, "postprocessingCache"):
+		cfg["postprocessingCache"] = {}
+	prepareCacheCfg(cfg["postprocessingCache"], prefixPath, "postprocessingCacheSpec")
+
+	if empty(cfg, "bytecode"):
+		cfg["bytecode"] = {}
+	for k, v in schema["definitions"]["bytecodeSpec"]["properties"].items():
+		if k not in cfg["bytecode"]:
+			cfg["bytecode"][k] = deepcopy(v["default"])
+
+	validateCfg(cfg)
 
 	repos = cfg["repos"]
 
@@ -110,9 +203,18 @@ def prepareCfg(cfg):
 			if "search" not in repoRefspecCfg:
 				repoRefspecCfg["search"] = cfg["search"]
 
+			for k in ("searchInclude", "searchExclude"):
+				if k not in repoRefspecCfg:
+					repoRefspecCfg[k] = cfg[k]
+
 			if "postprocessors" not in repoRefspecCfg:
 				repoRefspecCfg["postprocessors"] = cfg["postprocessors"]
 
+			patches = repoRefspecCfg.get("patches", None) or ()
+			if patches and "applyPatches" not in postprocessors:
+				raise ImportError("`patches` require `patch_ng` to be installed")
+			repoRefspecCfg["patches"] = [str(prefixPath / p) for p in patches]
+
 			localPath = preparePathInCfg(repoRefspecCfg, schema, "localPath", prefixPath)
 			if not localPath:
 				localPath = repoRefspecCfg["localPath"] = defaultLocalPath
@@ -136,19 +238,18 @@ def prepareCfg(cfg):
 
 	#prepareFormats(cfg)
 
-	if validator is not None:
-		validator.check_schema(cfg)
-		validator.validate(cfg)
+	validateCfg(cfg)
 
 
-def scanForKsys(repoRefspecCfg) -> None:
+def scanForKsys(repoRefspecCfg, dirsIndex: typing.Optional[KSYDirsIndex] = None) -> None:
 	if repoRefspecCfg["search"]:
-		for file in repoRefspecCfg["inputDir"].glob("**/*.ksy"):
-			repoRefspecCfg["formats"][repoRefspecCfg["outputDir"] / file.parent.relative_to(repoRefspecCfg["inputDir"]) / (file.stem + ".py")] = {"path": file}
+		inputDir = repoRefspecCfg["inputDir"].absolute()
+		for file in walkKSYs(inputDir, repoRefspecCfg.get("searchInclude", ()), repoRefspecCfg.get("searchExclude", ()), dirsIndex):
+			repoRefspecCfg["formats"][repoRefspecCfg["outputDir"] / file.parent.relative_to(inputDir) / (file.stem + ".py")] = {"path": file}
 
 
-def prepareFormats(repoRefspecCfg) -> None:
-	scanForKsys(repoRefspecCfg)
+def prepareFormats(repoRefspecCfg, dirsIndex: typing.Optional[KSYDirsIndex] = None) -> None:
+	scanForKsys(repoRefspecCfg, dirsIndex)
 
 	formats = repoRefspecCfg["formats"]
 	iD = repoRefspecCfg["inputDir"]
@@ -246,66 +347,591 @@ def _schemaToUserOptions(schema):
 
 
 compoundJsonTypesNames = {"array", "object"}
+booleanOptionsValues = {"1": True, "true": True, "yes": True, "on": True, "0": False, "false": False, "no": False, "off": False}
+
+
+def parseUserOptionValue(v: str, jsonType: typing.Union[str, typing.Iterable[str]]):
+	"""The values of command line options are strings, converts them into the type the schema expects"""
+	jsonTypes = (jsonType,) if isinstance(jsonType, str) else tuple(jsonType)
+	if "string" in jsonTypes:
+		return v
+	if "null" in jsonTypes and v.strip().lower() in {"", "null", "none"}:
+		return None
+	if compoundJsonTypesNames & set(jsonTypes):
+		return json.loads(v)
+	if "integer" in jsonTypes:
+		return int(v)
+	if "number" in jsonTypes:
+		return float(v)
+	if "boolean" in jsonTypes:
+		try:
+			return booleanOptionsValues[v.strip().lower()]
+		except KeyError:
+			raise ValueError("Invalid boolean value: " + repr(v)) from None
+	return v
+
+
+def getPostprocessingTasks(targetDescr, postprocessorsRegistry) -> typing.Dict[typing.Callable, typing.Iterable[typing.Any]]:
+	if "postprocess" not in targetDescr:
+		return {}
+
+	pp = targetDescr["postprocess"]
+	if not hasattr(pp, "items"):
+		pp = {el: () for el in pp}
+
+	return {(postprocessorsRegistry[funcName] if funcName in postprocessorsRegistry else resolvePostprocessor(funcName)): args for funcName, args in pp.items()}
+
+
+def addRefspecPatches(postprocessingTasks, patches: typing.Sequence[str]) -> typing.Dict[typing.Callable, typing.Iterable[typing.Any]]:
+	"""The patches of a refspec are applied to every module after the own postprocessors of a target. They are usually multi-file patch sets, each module gets only the patches for its file name."""
+	if not patches:
+		return postprocessingTasks
+
+	from ..postprocessors import applyPatchesByName
+
+	res = dict(postprocessingTasks)
+	res[applyPatchesByName] = tuple(patches)
+	return res
+
+
+def getImportPaths(repoRefSpecCfg) -> typing.List[Path]:
+	localPath = repoRefSpecCfg["localPath"]
+	if localPath is None:
+		return []
+	return [localPath]
+
+
+def getSparsePaths(repoRefSpecCfg) -> typing.List[str]:
+	"""The paths within `localPath` needed to build a refspec: `inputDir` if it is searched and the KSYs of the formats listed explicitly. Their imports are found by `upgradeLibrary` after they are checked out."""
+	localPath = repoRefSpecCfg["localPath"].absolute()
+	inputDir = repoRefSpecCfg["inputDir"].absolute()
+
+	def relPath(p: Path) -> typing.Optional[str]:
+		try:
+			return p.relative_to(localPath).as_posix()
+		except ValueError:
+			return None  # outside of the repo
+
+	res = []
+	if repoRefSpecCfg["search"]:
+		rel = relPath(inputDir)
+		if rel is not None:
+			res.append("" if rel == "." else rel + "/")
+
+	for descriptor in repoRefSpecCfg["formats"].values():
+		p = descriptor["path"]
+		if not isinstance(p, Path):
+			if not p.endswith(".ksy"):
+				rel = relPath(inputDir / (p + ".ksy"))
+				if rel is not None:
+					res.append(rel)
+			p = inputDir / p
+		rel = relPath(p.absolute())
+		if rel is not None:
+			res.append(rel)
+	return res
+
+
+def openDiskCache(cacheCfg, defaultSubDirName: str) -> typing.Optional[DiskCache]:
+	if not cacheCfg or not cacheCfg["enabled"]:
+		return None
+
+	cacheDir = cacheCfg["dir"]
+	if cacheDir is None:
+		cacheDir = getUserCacheDir() / defaultSubDirName
+
+	return DiskCache(cacheDir, maxSize=cacheCfg["maxSize"], maxEntries=cacheCfg["maxEntries"])
+
+
+def openCompileCache(cfg) -> typing.Optional[DiskCache]:
+	return openDiskCache(cfg.get("cache", None), "compiled")
+
+
+def openPostprocessingCache(cfg) -> typing.Optional[DiskCache]:
+	return openDiskCache(cfg.get("postprocessingCache", None), "postprocessed")
+
+
+def getUncacheablePostprocessors(cfg, postprocessorsRegistry) -> typing.FrozenSet[typing.Callable]:
+	ppCacheCfg = cfg.get("postprocessingCache", None)
+	if not ppCacheCfg:
+		return frozenset()
+	return frozenset(postprocessorsRegistry[name] for name in ppCacheCfg["uncacheable"] if name in postprocessorsRegistry)
+
+
+def getStateDir(cfg) -> Path:
+	stateDir = cfg["stateDir"]
+	if stateDir is None:
+		stateDir = getDefaultStateDir(cfg["prefixPath"])
+	return stateDir
+
+
+def openBuildState(cfg) -> typing.Optional[BuildState]:
+	if not cfg["incremental"]:
+		return None
+	return BuildState(getStateDir(cfg))
+
+
+def getCompilerFingerprint(cfg) -> typing.List[str]:
+	dirs = KSCDirs(subDirsNames, root=cfg["kaitaiStructRoot"])
+	return dirFingerprint(dirs.bin) + dirFingerprint(dirs.lib)
+
+
+def resultsIntoCachePayload(resultsWithPaths, outputDir: Path) -> dict:
+	return {
+		"modules": [
+			{
+				"moduleName": res.moduleName,
+				"mainClassName": res.mainClassName,
+				"msg": res.msg,
+				"path": os.path.relpath(savePath, outputDir).replace(os.sep, "/"),
+				"text": res.getText(),
+			}
+			for res, savePath in resultsWithPaths
+		]
+	}
+
+
+def cachePayloadIntoResults(payload: dict, outputDir: Path):
+	return [(InMemoryCompileResult(moduleName=m["moduleName"], mainClassName=m["mainClassName"], msg=m["msg"], text=m["text"]), (outputDir / m["path"]).absolute()) for m in payload["modules"]]
+
+
+def placeResults(compileResults: typing.Mapping[str, ICompileResult], compilationResultFilePath: Path) -> typing.List[typing.Tuple[ICompileResult, Path]]:
+	"""The results are compiled aside, so all of them, both in-memory and in-file ones, are placed near the target, so the modules importing each other are in the same dir regardless of the mode"""
+	destDir = compilationResultFilePath.parent
+	return [(res, (destDir / (moduleName + ".py")).absolute()) for moduleName, res in compileResults.items()]
+
+
+def runPostprocessingInWorker(fileText: str, fileName: typing.Union[Path, str], postprocessingTasks, cache: typing.Optional[DiskCache], uncacheable, trace: bool = False) -> typing.Tuple[str, typing.Optional[CacheStats], typing.List[dict]]:
+	"""Returns the stats of the cache and the spans too, since the worker uses its own copy of the cache and own tracer"""
+	if cache is not None:
+		cache.stats = CacheStats()
+	if trace:
+		startTracing()
+	try:
+		fileText = runCachedPostprocessingChain(fileText, fileName, postprocessingTasks, cache, uncacheable)
+	finally:
+		events = stopTracing().events if trace else []
+	return fileText, (cache.stats if cache is not None else None), events
+
+
+class PostprocessingPool:
+	"""Runs postprocessing chains in worker processes. Shared by all the refspecs of a build. Postprocessing is CPU-bound pure python, so threads don't help. The chains which cannot be pickled (i.e. having lambdas as postprocessors) are run in the build process."""
+
+	__slots__ = ("jobs", "cache", "executor")
+
+	def __init__(self, jobs: int, cache: typing.Optional[DiskCache] = None) -> None:
+		self.jobs = jobs
+		self.cache = cache
+		self.executor = None
+
+	def canRunInWorker(self, postprocessingTasks, uncacheable) -> bool:
+		if self.jobs == 1:
+			return False
+
+		import pickle
+
+		try:
+			pickle.dumps((postprocessingTasks, uncacheable))
+		except Exception:
+			return False
+		return True
+
+	def submit(self, res: ICompileResult, postprocessingTasks: typing.Mapping[typing.Callable, typing.Iterable[typing.Any]], uncacheable: typing.Container[typing.Callable]) -> Future:
+		tasks = list(postprocessingTasks.items())
+		if self.canRunInWorker(tasks, uncacheable):
+			if self.executor is None:
+				from concurrent.futures import ProcessPoolExecutor
+
+				self.executor = ProcessPoolExecutor(max_workers=(self.jobs if self.jobs > 0 else None))
+			return self.executor.submit(runPostprocessingInWorker, res.getText(), getPostprocessingFileName(res), tasks, self.cache, uncacheable, getTracer().enabled)
+
+		f = Future()
+		f.set_result((runCachedPostprocessingChain(res.getText(), getPostprocessingFileName(res), tasks, self.cache, uncacheable), None, ()))
+		return f
+
+	def getText(self, future: Future) -> str:
+		text, stats, events = future.result()
+		if stats is not None:
+			self.cache.stats = self.cache.stats + stats
+		if events:
+			getTracer().addEvents(events)
+		return text
+
+	def close(self) -> None:
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+
+class CompilationTarget:
+	__slots__ = ("resultFilePath", "descr", "postprocessingTasks", "cacheKey")
+
+	def __init__(self, resultFilePath: Path, descr: dict, postprocessingTasks, cacheKey: typing.Optional[str]) -> None:
+		self.resultFilePath = resultFilePath
+		self.descr = descr
+		self.postprocessingTasks = postprocessingTasks
+		self.cacheKey = cacheKey
+
+
+class CompilationBatch:
+	"""Targets of a refspec having the same flags. They are compiled by a single `compileIter` of a backend, each target is handed over as soon as the modules it needs are compiled. Batches are independent from each other, so can be compiled concurrently."""
+
+	__slots__ = ("refspec", "targets", "messages", "compilerMessages", "tempDir")
+
+	def __init__(self, refspec: "RefspecCompilation") -> None:
+		self.refspec = refspec
+		self.targets = []
+		self.messages = []  # Buffered, in order to be printed in a deterministic order
+		self.compilerMessages = []
+		self.tempDir = None
+
+	@property
+	def flags(self):
+		return self.targets[0].descr["flags"]
+
+	def getTargetResults(self, t: CompilationTarget, modules: typing.Mapping[str, ICompileResult], reportedWithSource: typing.Iterable[str]) -> typing.Mapping[str, ICompileResult]:
+		"""A target gets the modules of its KSY and of the ones it imports, even if they have been reported for another source, and the ones reported for its source we cannot attribute"""
+		res = OrderedDict()
+		for moduleName in chain(getModulesNamesOfKSY(t.descr["path"], self.refspec.importPaths), reportedWithSource):
+			r = modules.get(moduleName, None)
+			if r is not None:
+				res[moduleName] = r
+		return res
+
+	def __call__(self, readyTargets: Queue) -> None:
+		"""Puts `(batch, target, results)` into `readyTargets` for each target, or `(batch, None, exception)` on failure"""
+		try:
+			compiler = self.refspec.createCompiler(progressCallback=self.compilerMessages.append)
+			ksyPaths = [t.descr["path"] for t in self.targets]
+			pending = OrderedDict()
+			for t in self.targets:
+				pending.setdefault(Path(t.descr["path"]).absolute(), []).append(t)
+
+			# The backends writing the modules themselves write them here, so that only the changed ones are written into `outputDir`
+			self.tempDir = TemporaryDirectory(prefix="kaitaiStructCompile-")
+			modules = OrderedDict()
+			reportedWithSources = defaultdict(list)
+			with span("compile", sources=len(ksyPaths)):
+				for ev in compiler.compileIter(ksyPaths, Path(self.tempDir.name), additionalFlags=self.flags, needInMemory=self.refspec.rootCfg["inMemory"]):
+					if ev.phase == CompilePhase.result:
+						modules[ev.result.moduleName] = ev.result
+						reportedWithSources[ev.source].append(ev.result.moduleName)
+					elif ev.phase == CompilePhase.finished:
+						for t in pending.pop(ev.source, ()):
+							readyTargets.put((self, t, self.getTargetResults(t, modules, reportedWithSources[ev.source])))
+
+			for targets in pending.values():  # the backend has reported the sources by other paths
+				for t in targets:
+					readyTargets.put((self, t, self.getTargetResults(t, modules, ())))
+		except BaseException as ex:
+			readyTargets.put((self, None, ex))
+			raise
+
+	def cleanup(self) -> None:
+		"""Removes the modules written by the backend, call it after the results have been written"""
+		if self.tempDir is not None:
+			self.tempDir.cleanup()
+			self.tempDir = None
+
+
+class BatchesRunner:
+	"""Compiles the batches, up to `jobs` ones concurrently, in background threads: the backends do the heavy lifting in subprocesses, so threads are enough. The build thread takes the targets as they are compiled and submits their postprocessing itself, since forking worker processes from multiple threads is unsafe."""
+
+	__slots__ = ("pool", "executor", "batchesFutures", "readyTargets", "postprocessing")
+
+	def __init__(self, batches: typing.Iterable[CompilationBatch], jobs: int, pool: PostprocessingPool) -> None:
+		from concurrent.futures import ThreadPoolExecutor
+
+		self.pool = pool
+		self.readyTargets = Queue()
+		self.postprocessing = {}
+		self.executor = ThreadPoolExecutor(max_workers=(jobs if jobs > 0 else None))
+		self.batchesFutures = {b: self.executor.submit(b, self.readyTargets) for b in batches}
+
+	def takeReadyTarget(self, block: bool) -> None:
+		batch, t, res = self.readyTargets.get(block)
+		if t is None:
+			raise res
+
+		futures = OrderedDict()
+		if t.postprocessingTasks:
+			for moduleName, r in res.items():
+				futures[moduleName] = self.pool.submit(r, t.postprocessingTasks, batch.refspec.uncacheablePostprocessors)
+		self.postprocessing[t] = (res, futures)
+
+	def waitForTarget(self, t: CompilationTarget) -> typing.Tuple[typing.Mapping[str, ICompileResult], typing.Mapping[str, Future]]:
+		"""Returns the compiled modules of the target and the futures of their postprocessing"""
+		while t not in self.postprocessing:
+			self.takeReadyTarget(True)
+
+		# The targets compiled meanwhile are postprocessed while this one is being written
+		try:
+			while True:
+				self.takeReadyTarget(False)
+		except Empty:
+			pass
+
+		return self.postprocessing.pop(t)
+
+	def waitForBatch(self, batch: CompilationBatch) -> None:
+		self.batchesFutures[batch].result()
+
+	def close(self) -> None:
+		self.executor.shutdown()
+
+
+class RefspecCompilation:
+	"""The state of compilation of targets of a single refspec"""
+
+	__slots__ = ("cfg", "rootCfg", "pathToPrettyString", "importPaths", "tolerableIssues", "backendIdentity", "storeInCache", "compilerClass", "targetsKeys", "targetsResults", "batches", "uncacheablePostprocessors")
+
+	def __init__(self, rootCfg, repoRefSpecCfg, tolerableIssues: typing.Set[str], pathToPrettyString: typing.Callable[[Path], str]) -> None:
+		self.rootCfg = rootCfg
+		self.cfg = repoRefSpecCfg
+		self.uncacheablePostprocessors = getUncacheablePostprocessors(rootCfg, repoRefSpecCfg["postprocessors"])
+		self.tolerableIssues = tolerableIssues
+		self.pathToPrettyString = pathToPrettyString
+		self.importPaths = getImportPaths(repoRefSpecCfg)
+		self.backendIdentity = None
+		self.storeInCache = True
+		self.compilerClass = None
+		self.targetsKeys = {}
+		self.targetsResults = OrderedDict()
+		self.batches = OrderedDict()
+
+	def iterKSYsForDependencyGraph(self, dirsIndex: typing.Optional[KSYDirsIndex] = None) -> typing.Iterator[typing.Tuple[Path, typing.List[Path]]]:
+		for d in (self.cfg["inputDir"], self.cfg["localPath"]):
+			if d is not None:
+				for p in walkKSYs(d, index=dirsIndex):
+					yield p, self.importPaths
+
+		for targetDescr in self.cfg["formats"].values():
+			yield targetDescr["path"], self.importPaths
+
+	def plan(self, cache: typing.Optional[DiskCache], buildState: typing.Optional[BuildState]) -> None:
+		"""Skips the up-to-date targets, restores the targets present in the cache and groups the rest into batches"""
+
+		# The backend is initialized lazily, only if something has to be compiled. So for the keys we use the backend that is going to be selected.
+		if cache is not None or buildState is not None:
+			expectedBackend = next(iterateSuitableBackends(tolerableIssues=self.tolerableIssues, forcedBackend=self.rootCfg["forceBackend"], ranking=self.rootCfg["backendRanking"], kaitaiStructRoot=self.rootCfg["kaitaiStructRoot"]), None)
+			if expectedBackend is not None:
+				self.backendIdentity = [expectedBackend.identity, getCompilerFingerprint(self.rootCfg)]
+
+		for compilationResultFilePath, targetDescr in self.cfg["formats"].items():
+			if "flags" not in targetDescr:
+				targetDescr["flags"] = {}
+
+			postprocessingTasks = addRefspecPatches(getPostprocessingTasks(targetDescr, self.cfg["postprocessors"]), self.cfg["patches"])
+
+			if buildState is not None and self.backendIdentity is not None:
+				targetKey = self.targetsKeys[compilationResultFilePath] = hashJSONable([self.backendIdentity, self.rootCfg["flags"], targetDescr["flags"], postprocessingChainIdentity(postprocessingTasks)])
+				upToDate = buildState.getUpToDateResults(compilationResultFilePath, targetDescr["path"], targetKey)
+				if upToDate is not None:
+					message(styles["operationName"]("Up to date") + ": " + styles["resultName"](self.pathToPrettyString(compilationResultFilePath)))
+					self.targetsResults[compilationResultFilePath] = upToDate
+					continue
+
+			cacheKey = None
+			cached = None
+			if cache is not None and self.backendIdentity is not None:
+				cacheKey = computeCompileCacheKey(targetDescr["path"], self.importPaths, self.backendIdentity, self.rootCfg["flags"], targetDescr["flags"], postprocessingTasks)
+				cached = cache.get(cacheKey)
+
+			if cached is not None:
+				message(styles["operationName"]("Restoring from cache") + " " + styles["resultName"](self.pathToPrettyString(compilationResultFilePath)) + " ...")
+				self.targetsResults[compilationResultFilePath] = cachePayloadIntoResults(cached, self.cfg["outputDir"])
+				self.recordTarget(buildState, compilationResultFilePath, targetDescr)
+			else:
+				self.targetsResults[compilationResultFilePath] = None
+				batchKey = hashJSONable(targetDescr["flags"])
+				batch = self.batches.get(batchKey, None)
+				if batch is None:
+					self.batches[batchKey] = batch = CompilationBatch(self)
+				batch.targets.append(CompilationTarget(compilationResultFilePath, targetDescr, postprocessingTasks, cacheKey))
+				batch.messages.append(styles["operationName"]("Compiling") + " " + styles["ksyName"](self.pathToPrettyString(targetDescr["path"])) + " into " + styles["resultName"](self.pathToPrettyString(compilationResultFilePath)) + " ...")
+
+	def recordTarget(self, buildState: typing.Optional[BuildState], compilationResultFilePath: Path, targetDescr) -> None:
+		targetKey = self.targetsKeys.get(compilationResultFilePath, None)
+		if buildState is not None and targetKey is not None:
+			buildState.recordTarget(compilationResultFilePath, targetDescr["path"], targetKey, self.targetsResults[compilationResultFilePath])
+
+	def initCompilerClass(self) -> None:
+		with span("backend select"):
+			backendDescriptor, self.compilerClass = selectAndInitializeBackendWithDescriptor(tolerableIssues=self.tolerableIssues, forcedBackend=self.rootCfg["forceBackend"], ranking=self.rootCfg["backendRanking"], kaitaiStructRoot=self.rootCfg["kaitaiStructRoot"])
+		if self.backendIdentity is not None and (backendDescriptor is None or backendDescriptor.identity != self.backendIdentity[0]):
+			self.storeInCache = False  # Not the one we have expected, so results must not be stored under the keys computed for the expected one
+		message(styles["operationName"]("Using backend") + ": " + styles["info"](str(self.compilerClass.__name__)))
+
+	def createCompiler(self, progressCallback):
+		kwargs = {}
+		if getattr(self.compilerClass, "selectsBackend", False):
+			kwargs.update(tolerableIssues=self.tolerableIssues, forcedBackend=self.rootCfg["forceBackend"])
+		return self.compilerClass(progressCallback=progressCallback, dirs=self.rootCfg["kaitaiStructRoot"], **self.rootCfg["flags"], importPath=self.cfg["localPath"], **kwargs)
+
+	def collectTarget(self, runner: BatchesRunner, batch: CompilationBatch, t: CompilationTarget, cache: typing.Optional[DiskCache], buildState: typing.Optional[BuildState], pool: PostprocessingPool) -> typing.List[typing.Tuple[ICompileResult, Path]]:
+		"""Waits for the target to be compiled and postprocessed and places its results. The messages of a batch are printed around its targets, so the output doesn't depend on the order the batches are compiled in."""
+		if t is batch.targets[0]:
+			for m in batch.messages:
+				message(m)
+
+		message(styles["operationName"]("Postprocessing") + " " + styles["resultName"](self.pathToPrettyString(t.resultFilePath)) + " ...")
+		targetCompileResults, futures = runner.waitForTarget(t)
+		if futures:
+			targetCompileResults = OrderedDict((moduleName, PostprocessResult(res, t.postprocessingTasks, text=pool.getText(futures[moduleName]))) for moduleName, res in targetCompileResults.items())
+
+		self.targetsResults[t.resultFilePath] = resultsWithPaths = placeResults(targetCompileResults, t.resultFilePath)
+		if t.cacheKey is not None and self.storeInCache:
+			cache.put(t.cacheKey, resultsIntoCachePayload(resultsWithPaths, self.cfg["outputDir"]))
+		self.recordTarget(buildState, t.resultFilePath, t.descr)
+
+		if t is batch.targets[-1]:
+			runner.waitForBatch(batch)
+			for m in batch.compilerMessages:
+				message(m, "backend")
+		return resultsWithPaths
+
+
+def byteCompileEmittedFiles(emittedFiles: typing.Iterable[typing.Tuple[ICompileResult, Path]], cfg) -> typing.List[typing.Tuple[ICompileResult, Path]]:
+	"""Returns the pycs paired with the results they are compiled from"""
+	from ..bytecode import byteCompileFiles
+
+	bytecodeCfg = cfg["bytecode"]
+	jobs = bytecodeCfg["jobs"]
+	if jobs is None:
+		jobs = cfg["postprocessingJobs"] if cfg.get("postprocessingJobs", None) is not None else cfg["jobs"]
+
+	emittedFiles = [(res, p) for res, p in emittedFiles if p.suffix == ".py"]
+	resultsBySource = {p: res for res, p in emittedFiles}
+	compiled = byteCompileFiles([p for res, p in emittedFiles], bytecodeCfg["optimizationLevels"], bytecodeCfg["invalidationMode"], jobs)
+	written = sum(1 for sourcePath, pycPath, w in compiled if w)
+	message(styles["operationName"]("Bytecode") + ": " + styles["info"]("written=" + str(written) + ", unchanged=" + str(len(compiled) - written)))
+	return [(resultsBySource[sourcePath], pycPath) for sourcePath, pycPath, w in compiled]
+
+
+def getTraceFile(cfg) -> typing.Optional[Path]:
+	"""The env variable overrides the config"""
+	res = getTraceFileFromEnv()
+	if res is None:
+		res = cfg.get("trace", None)
+		if res is not None and not isinstance(res, Path):
+			res = Path(cfg["prefixPath"]) / res
+	return res
+
+
+def finishTracing(traceFile: Path) -> None:
+	tracer = stopTracing()
+	tracer.save(traceFile)
+	message(tracer.summaryTable())
+	message(styles["operationName"]("Trace written") + ": " + styles["info"](str(traceFile)))
 
 
 def doTranspilationWithCfg(cfg):
-	emittedFiles = []
 	if not cfg:
 		return
 
+	traceFile = getTraceFile(cfg)
+	if traceFile is None:
+		return runTranspilation(cfg)
+
+	startTracing()
+	try:
+		with span("build"):
+			return runTranspilation(cfg)
+	finally:
+		finishTracing(traceFile)
+
+
+def runTranspilation(cfg):
+	emittedFiles = []
 	prefixPath = cfg["prefixPath"]
 
 	def pathToPrettyString(p: Path) -> str:
 		return str(p.relative_to(prefixPath))
 
+	cache = openCompileCache(cfg)
+	postprocessingCache = openPostprocessingCache(cfg)
+	with span("load state"):
+		buildState = openBuildState(cfg)
+	tolerableIssues = set(cfg["tolerableIssues"]) | getTolerableIssuesFromEnv()
+
+	refspecs = []
 	# `repoUnneeded` is unneeded, we have migrated it into `git` property
 	for repoUnneeded, repoCfg in cfg["repos"].items():
 		# `refspecUnneeded` is unneeded, we have migrated it into `refspec` property
 		for refspecUnneeded, repoRefSpecCfg in repoCfg.items():
 			if repoRefSpecCfg["update"]:
-				from .repo import upgradeLibrary
-
-				upgradeLibrary(repoRefSpecCfg["localPath"], repoRefSpecCfg["git"], repoRefSpecCfg["refspec"], print, prefixPath=prefixPath)
+				from ..repo import upgradeLibrary
 
-			prepareFormats(repoRefSpecCfg)
+				with span("git update", repo=repoRefSpecCfg["git"], refspec=repoRefSpecCfg["refspec"]):
+					upgradeLibrary(repoRefSpecCfg["localPath"], repoRefSpecCfg["git"], repoRefSpecCfg["refspec"], message, prefixPath=prefixPath, ttl=repoRefSpecCfg["updateTTL"], sparsePaths=(getSparsePaths(repoRefSpecCfg) if repoRefSpecCfg["sparse"] else None))
 
-			ChosenBackend = selectAndInitializeBackend(tolerableIssues=set(cfg["tolerableIssues"]) | getTolerableIssuesFromEnv(), forcedBackend=cfg["forceBackend"])
-			print(styles["operationName"]("Using backend") + ":", styles["info"](str(ChosenBackend.__name__)))
-			compiler = ChosenBackend(progressCallback=print, dirs=cfg["kaitaiStructRoot"], **cfg["flags"], importPath=repoRefSpecCfg["localPath"])
+			with span("KSY scan", dir=repoRefSpecCfg["inputDir"]):
+				prepareFormats(repoRefSpecCfg, buildState.dirsIndex if buildState is not None else None)
+			os.makedirs(repoRefSpecCfg["outputDir"], exist_ok=True)
 
-			os.makedirs(pathToPrettyString(repoRefSpecCfg["outputDir"]), exist_ok=True)
-			for compilationResultFilePath, targetDescr in repoRefSpecCfg["formats"].items():
-				if "flags" not in targetDescr:
-					targetDescr["flags"] = {}
+			refspecs.append(RefspecCompilation(cfg, repoRefSpecCfg, tolerableIssues, pathToPrettyString))
 
-				print(styles["operationName"]("Compiling") + " " + styles["ksyName"](pathToPrettyString(targetDescr["path"])) + " into " + styles["resultName"](pathToPrettyString(compilationResultFilePath)) + " ...")
+	if buildState is not None:
+		with span("dependency graph"):
+			buildState.updateGraph(el for rc in refspecs for el in rc.iterKSYsForDependencyGraph(buildState.dirsIndex))
 
-				compileResults = compiler.compile([targetDescr["path"]], repoRefSpecCfg["outputDir"], additionalFlags=targetDescr["flags"])
-				# print(compileResults)
+	for rc in refspecs:
+		with span("plan"):
+			rc.plan(cache, buildState)
+		if rc.batches:
+			rc.initCompilerClass()
 
-				print(styles["operationName"]("Postprocessing") + " " + styles["resultName"](pathToPrettyString(compilationResultFilePath)) + " ...")
+	batches = [b for rc in refspecs for b in rc.batches.values()]
+	postprocessingJobs = cfg.get("postprocessingJobs", None)
+	pool = PostprocessingPool(postprocessingJobs if postprocessingJobs is not None else cfg["jobs"], postprocessingCache)
+	runner = BatchesRunner(batches, cfg["jobs"], pool)
 
-				for moduleName, res in compileResults.items():
-					print("targetDescr", targetDescr)
-					if "postprocess" in targetDescr:
-						pp = targetDescr["postprocess"]
-						if not hasattr(pp, "items"):
-							pp = {el: () for el in pp}
-
-						res = PostprocessResult(res, {repoRefSpecCfg["postprocessors"][funcName]: args for funcName, args in pp.items()})
-
-					if isinstance(res, InFileCompileResult):
-						savePath = res.path
-					else:
-						savePath = (compilationResultFilePath.parent / (moduleName + ".py")).absolute()
-
-					print("res.needsSave", res.needsSave, savePath)
-					if res.needsSave:
-						with savePath.open("wt", encoding="utf-8") as f:
-							f.write(res.getText())
-					else:
-						pass  # TODO: find out if we need to move files
-					emittedFiles.append((res, savePath))
+	# The targets are written in order, each one as soon as it is ready, while the rest are still being compiled
+	written = 0
+	unchanged = 0
+	try:
+		for rc in refspecs:
+			batchesOfTargets = {t.resultFilePath: (b, t) for b in rc.batches.values() for t in b.targets}
+			for compilationResultFilePath, resultsWithPaths in list(rc.targetsResults.items()):
+				if resultsWithPaths is None:
+					b, t = batchesOfTargets[compilationResultFilePath]
+					resultsWithPaths = rc.collectTarget(runner, b, t, cache, buildState, pool)
+
+				with span("write"):
+					for res, savePath in resultsWithPaths:
+						if isinstance(res, InFileCompileResult) and res.path == savePath:
+							unchanged += 1  # up to date since the previous build
+						else:
+							with res.bytesView() as data:
+								isWritten = writeIfChanged(savePath, data)
+							if isWritten:
+								written += 1
+							else:
+								unchanged += 1
+							if isinstance(res, InFileCompileResult):
+								res = InFileCompileResult(res.moduleName, res.mainClassName, res.msg, savePath)  # the one in the temp dir is going to be removed
+						emittedFiles.append((res, savePath))
+	finally:
+		runner.close()
+		pool.close()
+		for b in batches:
+			b.cleanup()
+
+	if cfg["bytecode"]["enabled"]:
+		with span("bytecode"):
+			emittedFiles.extend(byteCompileEmittedFiles(emittedFiles, cfg))
+
+	if buildState is not None:
+		with span("save state"):
+			buildState.save()
+
+	for name, c in (("Compile cache", cache), ("Postprocessing cache", postprocessingCache)):
+		if c is not None:
+			stats = c.stats
+			c.flushStats()
+			message(styles["operationName"](name) + ": " + styles["info"](str(stats)))
+
+	message(styles["operationName"]("Outputs") + ": " + styles["info"]("written=" + str(written) + ", unchanged=" + str(unchanged)))
 
 	return emittedFiles
 
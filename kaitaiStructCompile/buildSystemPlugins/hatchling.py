@@ -19,7 +19,7 @@ class KaitaiHatchlingPlugin(BuildHookInterface):
 		emittedFiles = doTranspilationAssummingPyprojectTomlIsInCWD()
 		fi = build_data["force_include"]
 		cwd = Path(".").absolute().resolve()
-		for res, pth in emittedFiles:
+		for res, pth in emittedFiles:  # the pycs are there too, if byte-compilation is enabled
 			rp = pth.relative_to(cwd)
 			fi[rp] = rp
 
@@ -1,4 +1,3 @@
-import json
 import os
 import warnings
 from copy import deepcopy
@@ -8,7 +7,7 @@ from pathlib import Path
 
 import setuptools
 
-from .common import _schemaToUserOptions, compoundJsonTypesNames, doTranspilationWithCfg, getFromDicHierarchyByPath, getOurPyprojectTomlSectionFromAFile, prepareCfg, schema, setToDicHierarchyByPath, walkSchemaUserOptions
+from .common import _schemaToUserOptions, doTranspilationWithCfg, getFromDicHierarchyByPath, getOurPyprojectTomlSectionFromAFile, parseUserOptionValue, prepareCfg, schema, setToDicHierarchyByPath, walkSchemaUserOptions
 from .utils import inspectStackForUnexposedVariables
 
 helperInitialized = False
@@ -80,8 +79,8 @@ class kaitai_transpile(Command):
 			if rT:
 				v = getattr(self, propName)
 				#print("setOptBack", propName, getFromDicHierarchyByPath(cfg, path), v, el)
-				if isinstance(rT, str) and rT in compoundJsonTypesNames and isinstance(el, str):
-					v = json.loads(v)
+				if isinstance(v, str):
+					v = parseUserOptionValue(v, rT)
 				setToDicHierarchyByPath(cfg, path, v)
 
 		walkSchemaUserOptions(schema, setOptBack)
@@ -90,7 +89,25 @@ class kaitai_transpile(Command):
 		self.distribution.kaitai = cfg
 
 	def run(self):
-		return doTranspilationWithCfg(getattr(self.distribution, "kaitai", None))
+		emittedFiles = doTranspilationWithCfg(getattr(self.distribution, "kaitai", None))
+		if emittedFiles:
+			self.copyBytecodeIntoBuildLib(emittedFiles)
+		return emittedFiles
+
+	def copyBytecodeIntoBuildLib(self, emittedFiles):
+		"""`build_py` copies only sources, so the pycs of the emitted modules are put into `build_lib` by us"""
+		buildPy = self.get_finalized_command("build_py")
+		packagesDirs = {Path(buildPy.get_package_dir(pkg)).absolute(): pkg for pkg in (buildPy.packages or ())}
+		for res, p in emittedFiles:
+			if p.suffix != ".pyc":
+				continue
+			pkg = packagesDirs.get(p.parent.parent.absolute(), None)
+			if pkg is None:
+				warnings.warn("Cannot find the package " + str(p) + " belongs to, it is not included")
+				continue
+			dest = Path(buildPy.build_lib, *pkg.split("."), p.parent.name, p.name)
+			self.mkpath(str(dest.parent))
+			self.copy_file(str(p), str(dest))
 
 
 def getPyprojectTomlPath(dist):
@@ -0,0 +1,72 @@
+"""Byte-compiles the emitted modules, so the first import of them in production doesn't pay for compilation. Hash-based pycs are deterministic and don't depend on the mtimes of the sources, so they survive being packed into wheels and images."""
+
+import os
+import py_compile
+import typing
+from importlib.util import MAGIC_NUMBER, cache_from_source, source_hash
+from pathlib import Path
+
+__all__ = ("INVALIDATION_MODES", "byteCompileFile", "byteCompileFiles")
+
+INVALIDATION_MODES = {
+	"timestamp": py_compile.PycInvalidationMode.TIMESTAMP,
+	"checked-hash": py_compile.PycInvalidationMode.CHECKED_HASH,
+	"unchecked-hash": py_compile.PycInvalidationMode.UNCHECKED_HASH,
+}
+
+# https://peps.python.org/pep-0552/
+PYC_FLAG_HASH_BASED = 0b01
+PYC_FLAG_CHECK_SOURCE = 0b10
+
+
+def getPycFlags(invalidationMode: py_compile.PycInvalidationMode) -> int:
+	if invalidationMode == py_compile.PycInvalidationMode.TIMESTAMP:
+		return 0
+	if invalidationMode == py_compile.PycInvalidationMode.CHECKED_HASH:
+		return PYC_FLAG_HASH_BASED | PYC_FLAG_CHECK_SOURCE
+	return PYC_FLAG_HASH_BASED
+
+
+def isPycUpToDate(pycPath: Path, source: bytes, invalidationMode: py_compile.PycInvalidationMode) -> bool:
+	"""Only hash-based pycs are checked, their headers tell exactly what source they have been compiled from"""
+	flags = getPycFlags(invalidationMode)
+	if not flags & PYC_FLAG_HASH_BASED:
+		return False
+	try:
+		with pycPath.open("rb") as f:
+			header = f.read(16)
+	except OSError:
+		return False
+
+	return len(header) == 16 and header[:4] == MAGIC_NUMBER and int.from_bytes(header[4:8], "little") == flags and header[8:16] == source_hash(source)
+
+
+def byteCompileFile(sourcePath: Path, optimizationLevel: int = 0, invalidationMode: str = "checked-hash") -> typing.Tuple[Path, bool]:
+	"""Returns the path of the pyc and whether it has been written. An up-to-date hash-based pyc is not rewritten, so its mtime is kept."""
+	sourcePath = Path(sourcePath)
+	mode = INVALIDATION_MODES[invalidationMode]
+	pycPath = Path(cache_from_source(str(sourcePath), optimization=(optimizationLevel if optimizationLevel else "")))
+	if isPycUpToDate(pycPath, sourcePath.read_bytes(), mode):
+		return pycPath, False
+
+	py_compile.compile(str(sourcePath), cfile=str(pycPath), dfile=sourcePath.name, doraise=True, optimize=optimizationLevel, invalidation_mode=mode)
+	return pycPath, True
+
+
+def _byteCompileFileStar(args) -> typing.Tuple[Path, bool]:
+	return byteCompileFile(*args)
+
+
+def byteCompileFiles(sourcesPaths: typing.Iterable[Path], optimizationLevels: typing.Iterable[int] = (0,), invalidationMode: str = "checked-hash", jobs: int = 1) -> typing.List[typing.Tuple[Path, Path, bool]]:
+	"""Byte-compiles each of the files for each of the optimization levels, in up to `jobs` worker processes (`0` means the count of CPUs). Compilation holds the GIL, so threads don't help. Returns `(sourcePath, pycPath, written)` in the order of the args."""
+	tasks = [(Path(p), level, invalidationMode) for p in sourcesPaths for level in optimizationLevels]
+	if jobs == 1 or len(tasks) <= 1:
+		results = [byteCompileFile(*t) for t in tasks]
+	else:
+		from concurrent.futures import ProcessPoolExecutor
+
+		workers = jobs if jobs > 0 else (os.cpu_count() or 1)
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			results = list(pool.map(_byteCompileFileStar, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+
+	return [(t[0], pycPath, written) for t, (pycPath, written) in zip(tasks, results)]
@@ -0,0 +1,270 @@
+import hashlib
+import os
+import tempfile
+import typing
+from pathlib import Path
+
+from .ksyImports import iterTransitiveImports
+from .utils import json
+
+CACHE_FORMAT_VERSION = 1
+
+
+def hashBytes(b: bytes) -> str:
+	return hashlib.sha256(b).hexdigest()
+
+
+def hashFile(p: Path) -> str:
+	h = hashlib.sha256()
+	with p.open("rb") as f:
+		for chunk in iter(lambda: f.read(1 << 16), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def _jsonDefault(o):
+	if isinstance(o, Path):
+		return o.as_posix()
+	if isinstance(o, (set, frozenset)):
+		return sorted(o)
+	if callable(o):
+		return callableIdentity(o)
+	return repr(o)
+
+
+def hashJSONable(o) -> str:
+	"""Hashes an object that is JSON-serializable after converting paths, sets and functions"""
+	return hashBytes(json.dumps(o, sort_keys=True, default=_jsonDefault).encode("utf-8"))
+
+
+def callableIdentity(f: typing.Callable) -> str:
+	"""A stable name of a function to be used in cache keys. Set `version` attribute of a function to invalidate the caches when its behavior changes. The version of this package is included too, so upgrading it invalidates the results of the built-in postprocessors even if a `version` has not been bumped."""
+	from . import __version__
+
+	return getattr(f, "__module__", "") + "." + getattr(f, "__qualname__", repr(f)) + "@" + str(getattr(f, "version", 0)) + "@" + __version__
+
+
+def dirFingerprint(d: Path) -> typing.List[str]:
+	"""Names, sizes and mtimes of files in a dir. Cheap to compute, changes when a compiler is upgraded."""
+	try:
+		return sorted(e.name + ":" + str(e.stat().st_size) + ":" + str(e.stat().st_mtime_ns) for e in os.scandir(d))
+	except OSError:
+		return []
+
+
+def argIdentity(arg) -> typing.Any:
+	"""Postprocessors args are often paths to files. If they are, we hash the contents too, so editing a patch invalidates the results."""
+	if isinstance(arg, (str, Path)):
+		try:
+			p = Path(arg)
+			if p.is_file():
+				return [str(arg), hashFile(p)]
+		except (OSError, ValueError):
+			pass
+	return arg
+
+
+def postprocessingChainIdentity(postprocessingTasks: typing.Mapping[typing.Callable, typing.Iterable[typing.Any]]) -> list:
+	return [[callableIdentity(pp), [argIdentity(a) for a in args]] for pp, args in postprocessingTasks.items()]
+
+
+def sourcesIdentity(ksyPath: Path, importPaths: typing.Iterable[Path] = ()) -> list:
+	"""Hashes of the KSY and all the files it transitively imports. Paths are relative to the dir of the main file, so the identity doesn't depend on the location of a checkout."""
+	base = ksyPath.parent
+
+	def relName(p: Path) -> str:
+		return os.path.relpath(p, base).replace(os.sep, "/")
+
+	res = [[ksyPath.name, hashFile(ksyPath)]]
+	for importer, spec, resolved in iterTransitiveImports(ksyPath, importPaths):
+		if resolved is None:
+			res.append([relName(importer), spec, None])
+		else:
+			res.append([relName(importer), spec, relName(resolved), hashFile(resolved)])
+	return res
+
+
+def computeCompileCacheKey(ksyPath: Path, importPaths: typing.Iterable[Path], backendIdentity: str, flags: typing.Mapping[str, typing.Any], targetFlags: typing.Any, postprocessingTasks: typing.Mapping[typing.Callable, typing.Iterable[typing.Any]]) -> str:
+	return hashJSONable({
+		"format": CACHE_FORMAT_VERSION,
+		"backend": backendIdentity,
+		"flags": flags,
+		"namespaces": flags.get("namespaces", None),
+		"targetFlags": targetFlags,
+		"sources": sourcesIdentity(ksyPath, importPaths),
+		"postprocess": postprocessingChainIdentity(postprocessingTasks),
+	})
+
+
+class CacheStats:
+	__slots__ = ("hits", "misses", "stores", "evictions")
+
+	def __init__(self, hits: int = 0, misses: int = 0, stores: int = 0, evictions: int = 0) -> None:
+		self.hits = hits
+		self.misses = misses
+		self.stores = stores
+		self.evictions = evictions
+
+	def asDict(self) -> typing.Dict[str, int]:
+		return {k: getattr(self, k) for k in self.__class__.__slots__}
+
+	def __add__(self, other: "CacheStats") -> "CacheStats":
+		return self.__class__(**{k: getattr(self, k) + getattr(other, k) for k in self.__class__.__slots__})
+
+	def __str__(self) -> str:
+		return ", ".join(str(v) + " " + k for k, v in self.asDict().items())
+
+	def __repr__(self) -> str:
+		return self.__class__.__name__ + "(" + ", ".join(k + "=" + str(v) for k, v in self.asDict().items()) + ")"
+
+
+def atomicWrite(path: Path, data: bytes, mode: typing.Optional[int] = None) -> None:
+	"""`mkstemp` creates files readable only by the owner, set `mode` for the files meant for others"""
+	fd, tmpName = tempfile.mkstemp(dir=str(path.parent), prefix="." + path.name + ".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		if mode is not None:
+			os.chmod(tmpName, mode)
+		os.replace(tmpName, str(path))
+	except BaseException:
+		try:
+			os.unlink(tmpName)
+		except OSError:
+			pass
+		raise
+
+
+def getDefaultFileMode() -> int:
+	"""The mode `open` would create a file with"""
+	umask = os.umask(0)
+	os.umask(umask)
+	return 0o666 & ~umask
+
+
+def writeIfChanged(path: Path, data: bytes) -> bool:
+	"""Writes the file atomically, unless it already has the same contents. Keeping the unchanged files untouched keeps their mtimes, so `__pycache__` and the builds depending on them are not invalidated. Returns whether the file has been written."""
+	try:
+		st = path.stat()
+	except OSError:
+		mode = getDefaultFileMode()
+		path.parent.mkdir(parents=True, exist_ok=True)
+	else:
+		if st.st_size == len(data):
+			try:
+				if path.read_bytes() == data:
+					return False
+			except OSError:
+				pass
+		mode = st.st_mode & 0o7777
+
+	atomicWrite(path, data, mode)
+	return True
+
+
+class DiskCache:
+	"""A persistent content-addressed cache of JSON-serializable payloads. Entries are evicted in LRU order (by mtime, which is bumped on every hit) when the limits are exceeded. Safe to share a dir between processes and checkouts: all the writes are atomic renames."""
+
+	__slots__ = ("dir", "maxSize", "maxEntries", "stats")
+
+	ENTRIES_DIR_NAME = "entries"
+	STATS_FILE_NAME = "stats.json"
+
+	def __init__(self, dir: Path, maxSize: typing.Optional[int] = None, maxEntries: typing.Optional[int] = None) -> None:
+		self.dir = Path(dir)
+		self.maxSize = maxSize
+		self.maxEntries = maxEntries
+		self.stats = CacheStats()
+
+	@property
+	def entriesDir(self) -> Path:
+		return self.dir / self.__class__.ENTRIES_DIR_NAME
+
+	@property
+	def statsFile(self) -> Path:
+		return self.dir / self.__class__.STATS_FILE_NAME
+
+	def entryPath(self, key: str) -> Path:
+		return self.entriesDir / key[:2] / (key + ".json")
+
+	def get(self, key: str) -> typing.Optional[typing.Any]:
+		p = self.entryPath(key)
+		try:
+			with p.open("rb") as f:
+				res = json.loads(f.read().decode("utf-8"))
+		except (OSError, ValueError):
+			self.stats.misses += 1
+			return None
+
+		try:
+			os.utime(str(p))
+		except OSError:
+			pass
+
+		self.stats.hits += 1
+		return res
+
+	def put(self, key: str, payload: typing.Any) -> None:
+		p = self.entryPath(key)
+		p.parent.mkdir(parents=True, exist_ok=True)
+		atomicWrite(p, json.dumps(payload).encode("utf-8"))
+		self.stats.stores += 1
+		self.evict()
+
+	def iterEntries(self) -> typing.Iterator[os.DirEntry]:
+		try:
+			shards = list(os.scandir(str(self.entriesDir)))
+		except OSError:
+			return
+		for shard in shards:
+			if shard.is_dir():
+				for e in os.scandir(shard.path):
+					if e.name.endswith(".json"):
+						yield e
+
+	def evict(self) -> None:
+		"""Removes least recently used entries until the cache fits into the limits"""
+		if self.maxSize is None and self.maxEntries is None:
+			return
+
+		entries = []
+		for e in self.iterEntries():
+			try:
+				st = e.stat()
+			except OSError:
+				continue
+			entries.append((st.st_mtime_ns, st.st_size, e.path))
+
+		totalSize = sum(el[1] for el in entries)
+		count = len(entries)
+		entries.sort()
+		for mtime, size, path in entries:
+			if (self.maxSize is None or totalSize <= self.maxSize) and (self.maxEntries is None or count <= self.maxEntries):
+				break
+			try:
+				os.unlink(path)
+			except OSError:
+				continue
+			totalSize -= size
+			count -= 1
+			self.stats.evictions += 1
+
+	def clear(self) -> None:
+		for e in list(self.iterEntries()):
+			os.unlink(e.path)
+
+	def loadTotalStats(self) -> CacheStats:
+		"""Returns statistics accumulated by all the processes that used this cache dir"""
+		try:
+			with self.statsFile.open("rb") as f:
+				return CacheStats(**json.loads(f.read().decode("utf-8")))
+		except (OSError, ValueError, TypeError):
+			return CacheStats()
+
+	def flushStats(self) -> CacheStats:
+		"""Adds this process statistics to the persisted ones and resets them"""
+		total = self.loadTotalStats() + self.stats
+		self.dir.mkdir(parents=True, exist_ok=True)
+		atomicWrite(self.statsFile, json.dumps(total.asDict()).encode("utf-8"))
+		self.stats = CacheStats()
+		return total
@@ -0,0 +1,412 @@
+"""A backend keeping a warm compiler in a long-lived process. The process is started on demand, serves `compile` requests of all the build processes of a user over a Unix socket and exits after being idle for `KAITAI_STRUCT_COMPILE_DAEMON_IDLE_TIMEOUT` seconds.
+
+The daemon itself uses the best of other backends (or the one set in `KAITAI_STRUCT_COMPILE_DAEMON_BACKEND`), selected with the tolerable issues and the forced backend of each client. Since it spawns a background process, it has `spawnsDaemon` issue: add it to the tolerable ones (or force `daemon` backend) to use it."""
+
+import os
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import threading
+import time
+import typing
+import warnings
+from pathlib import Path
+
+from .ICompiler import CompilePhase, CompileProgressEvent, ICompiler, ICompileResult, InFileCompileResult, InMemoryCompileResult
+from .KaitaiCompilerException import KaitaiCompilerException
+from .tracing import span
+from .utils import getDaemonBackendFromEnv, getDaemonIdleTimeoutFromEnv, getDaemonSocketPath, getTolerableIssuesFromEnv, json
+
+ISSUE_NAME = "spawnsDaemon"
+PROTOCOL_VERSION = 1
+STARTUP_TIMEOUT = 30.0
+POLL_INTERVAL = 0.5
+
+
+def sendMessage(f, msg: typing.Any) -> None:
+	f.write(json.dumps(msg).encode("utf-8") + b"\n")
+	f.flush()
+
+
+def receiveMessage(f) -> typing.Any:
+	l = f.readline()
+	if not l:
+		raise ConnectionError("Connection closed by the peer")
+	return json.loads(l.decode("utf-8"))
+
+
+def request(socketPath: Path, msg: typing.Any, timeout: typing.Optional[float] = None) -> typing.Any:
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+		s.settimeout(timeout)
+		s.connect(str(socketPath))
+		with s.makefile("rwb") as f:
+			sendMessage(f, msg)
+			return receiveMessage(f)
+
+
+def isAlive(socketPath: Path) -> bool:
+	try:
+		return request(socketPath, {"op": "ping"}, timeout=STARTUP_TIMEOUT).get("protocol", None) == PROTOCOL_VERSION
+	except (OSError, ValueError):
+		return False
+
+
+def spawnDaemon(socketPath: Path, idleTimeout: float) -> subprocess.Popen:
+	"""Starts a daemon detached from the current process, so it survives it and can be reused by the next build processes"""
+	env = dict(os.environ)
+	packageParentDir = str(Path(__file__).absolute().parent.parent)
+	env["PYTHONPATH"] = os.pathsep.join(el for el in (packageParentDir, env.get("PYTHONPATH", "")) if el)
+	return subprocess.Popen([sys.executable, "-m", __name__, "serve", "--socket", str(socketPath), "--idle-timeout", str(idleTimeout)], env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def ensureDaemon(socketPath: Path, idleTimeout: float) -> None:
+	if isAlive(socketPath):
+		return
+
+	proc = spawnDaemon(socketPath, idleTimeout)
+	deadline = time.monotonic() + STARTUP_TIMEOUT
+	while time.monotonic() < deadline:
+		if isAlive(socketPath):
+			return
+		if proc.poll() is not None and proc.returncode != 0:
+			raise KaitaiCompilerException("The compiler daemon has exited with code " + str(proc.returncode))
+		time.sleep(0.05)
+
+	raise KaitaiCompilerException("The compiler daemon has not started in " + str(STARTUP_TIMEOUT) + " s")
+
+
+def ensurePrivateDir(d: Path) -> None:
+	"""Creates the dir of the socket, if it is missing. Refuses to use a dir that other users could have planted a socket into, as ssh-agent does: whatever a socket answers is written into the package as python source."""
+	d = Path(d)
+	try:
+		d.mkdir(mode=0o700, parents=True)
+		os.chmod(str(d), 0o700)  # `mkdir` mode is subject to umask
+	except FileExistsError:
+		pass
+
+	st = os.lstat(str(d))
+	if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+		raise KaitaiCompilerException("The dir of the compiler daemon socket " + str(d) + " must be a dir (not a symlink) owned by the current user and accessible only by them (mode 0700), refusing to use it")
+
+
+def _pathOrNone(p) -> typing.Optional[str]:
+	return str(Path(p).absolute()) if p is not None else None
+
+
+def serializeResult(r: ICompileResult) -> dict:
+	"""The results written into files are passed by path, the rest by text"""
+	inFile = not r.needsSave and r.path is not None
+	return {
+		"moduleName": r.moduleName,
+		"mainClassName": r.mainClassName,
+		"msg": r.msg,
+		"path": str(r.path) if inFile else None,
+		"text": None if inFile else r.getText(),
+	}
+
+
+def deserializeResult(r: dict) -> ICompileResult:
+	if r["text"] is not None:
+		return InMemoryCompileResult(r["moduleName"], r["mainClassName"], r["msg"], r["text"])
+	return InFileCompileResult(r["moduleName"], r["mainClassName"], r["msg"], Path(r["path"]))
+
+
+class DaemonCompiler(ICompiler):
+	"""Forwards the compilation requests to the daemon, starting it if needed"""
+
+	__slots__ = ("ctorArgs", "socketPath", "idleTimeout")
+
+	selectsBackend = True
+
+	def __init__(self, progressCallback=None, dirs=None, namespaces=None, additionalFlags: typing.Iterable[str] = (), importPath: typing.Optional[Path] = None, socketPath: typing.Optional[Path] = None, idleTimeout: typing.Optional[float] = None, tolerableIssues: typing.Optional[typing.Iterable[str]] = None, forcedBackend: typing.Optional[str] = None, **kwargs) -> None:
+		"""`tolerableIssues` and `forcedBackend` select the backend the daemon uses for this client, by default they are taken from the env of the client"""
+		super().__init__(progressCallback=progressCallback, dirs=dirs, namespaces=namespaces, importPath=importPath)
+		if socketPath is None:
+			socketPath = getDaemonSocketPath()
+		if idleTimeout is None:
+			idleTimeout = getDaemonIdleTimeoutFromEnv()
+		self.socketPath = Path(socketPath)
+		self.idleTimeout = idleTimeout
+
+		if tolerableIssues is None:
+			tolerableIssues = getTolerableIssuesFromEnv()
+		if not forcedBackend or forcedBackend == "daemon":
+			forcedBackend = getDaemonBackendFromEnv() or None
+
+		# The daemon may have been started by a process with other env, cwd and config, so we send it everything it needs
+		self.ctorArgs = {
+			"dirs": _pathOrNone(self.dirs.root),
+			"namespaces": namespaces,
+			"additionalFlags": list(additionalFlags),
+			"importPath": _pathOrNone(importPath),
+			"tolerableIssues": sorted(set(tolerableIssues) - {ISSUE_NAME, ""}),
+			"forcedBackend": forcedBackend,
+		}
+		self.ctorArgs.update(kwargs)
+
+	def makeRequest(self, op: str, sourceFilesAbsPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str], needInMemory: bool, target: str, verbose, opaqueTypes, autoRead, readStoresPos) -> dict:
+		return {
+			"op": op,
+			"ctorArgs": self.ctorArgs,
+			"sources": [str(p) for p in sourceFilesAbsPaths],
+			"destDir": _pathOrNone(destDir),
+			"additionalFlags": list(additionalFlags),
+			"needInMemory": needInMemory,
+			"target": target,
+			"verbose": list(verbose) if verbose is not None else None,
+			"opaqueTypes": opaqueTypes,
+			"autoRead": autoRead,
+			"readStoresPos": readStoresPos,
+		}
+
+	def ensureDaemon(self) -> None:
+		ensurePrivateDir(self.socketPath.parent)
+		with span("daemon start", "backend"):
+			ensureDaemon(self.socketPath, self.idleTimeout)
+
+	def processFinalResponse(self, resp: dict) -> None:
+		for m in resp.get("messages", ()):
+			self.progressCallback(m)
+
+		if "error" in resp:
+			raise KaitaiCompilerException(resp["error"]["type"] + ": " + resp["error"]["message"])
+
+	def compile_(self, sourceFilesAbsPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str], needInMemory: bool, target: str, verbose, opaqueTypes, autoRead, readStoresPos) -> typing.Mapping[str, ICompileResult]:
+		msg = self.makeRequest("compile", sourceFilesAbsPaths=sourceFilesAbsPaths, destDir=destDir, additionalFlags=additionalFlags, needInMemory=needInMemory, target=target, verbose=verbose, opaqueTypes=opaqueTypes, autoRead=autoRead, readStoresPos=readStoresPos)
+		self.ensureDaemon()
+		with span("daemon request", "backend", sources=len(msg["sources"])):
+			resp = request(self.socketPath, msg)
+
+		self.processFinalResponse(resp)
+		res = {}
+		for r in resp["results"]:
+			res[r["moduleName"]] = deserializeResult(r)
+		return res
+
+	def compileIter_(self, sourceFilesAbsPaths: typing.Iterable[Path], destDir: Path, additionalFlags: typing.Iterable[str], needInMemory: bool, target: str, verbose, opaqueTypes, autoRead, readStoresPos) -> typing.Iterator[CompileProgressEvent]:
+		"""The daemon sends the events of its backend as they come, one per line, and then the final response. A daemon of an older version not knowing this op compiles in chunks."""
+		sourceFilesAbsPaths = list(sourceFilesAbsPaths)
+		msg = self.makeRequest("compileIter", sourceFilesAbsPaths=sourceFilesAbsPaths, destDir=destDir, additionalFlags=additionalFlags, needInMemory=needInMemory, target=target, verbose=verbose, opaqueTypes=opaqueTypes, autoRead=autoRead, readStoresPos=readStoresPos)
+		self.ensureDaemon()
+
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			s.connect(str(self.socketPath))
+			with s.makefile("rwb") as f:
+				sendMessage(f, msg)
+				while True:
+					resp = receiveMessage(f)
+					ev = resp.get("event", None)
+					if ev is None:
+						break
+					yield CompileProgressEvent(Path(ev["source"]), CompilePhase(ev["phase"]), ev["elapsed"], deserializeResult(ev["result"]) if ev["result"] is not None else None)
+
+		if resp.get("error", {}).get("message", "").startswith("Unknown op"):
+			yield from super().compileIter_(sourceFilesAbsPaths=sourceFilesAbsPaths, destDir=destDir, additionalFlags=additionalFlags, needInMemory=needInMemory, target=target, verbose=verbose, opaqueTypes=opaqueTypes, autoRead=autoRead, readStoresPos=readStoresPos)
+			return
+
+		self.processFinalResponse(resp)
+
+
+def init(ICompilerModule, KaitaiCompilerException, utils, defaults):
+	return DaemonCompiler
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	"""Serves each connection in own thread, so pings are answered while a compilation is running. The compilations are serialized by `lock`, the backends are not required to be thread-safe. Keeps initialized compilers for reuse."""
+
+	def __init__(self, socketPath: Path, idleTimeout: float, forcedBackend: typing.Optional[str] = None) -> None:
+		self.idleTimeout = idleTimeout
+		self.timeout = min(idleTimeout, POLL_INTERVAL)  # the requests are handled in threads, so `idle` set by them is noticed on the next poll
+		self.lastActivity = time.monotonic()
+		self.idle = False
+		self.forcedBackend = forcedBackend
+		self.compilers = {}
+		self.messages = []
+		self.lock = threading.Lock()
+		self.activeLock = threading.Lock()
+		self.active = 0
+		super().__init__(str(socketPath), DaemonRequestHandler)
+
+	def process_request(self, request, client_address) -> None:
+		with self.activeLock:
+			self.active += 1
+		super().process_request(request, client_address)
+
+	def process_request_thread(self, request, client_address) -> None:
+		try:
+			super().process_request_thread(request, client_address)
+		finally:
+			with self.activeLock:
+				self.active -= 1
+				self.lastActivity = time.monotonic()
+
+	def handle_timeout(self) -> None:
+		with self.activeLock:
+			if not self.active and time.monotonic() - self.lastActivity >= self.idleTimeout:
+				self.idle = True
+
+	def getCompilerClass(self, tolerableIssues: typing.Iterable[str], forcedBackend: typing.Optional[str]):
+		"""The backend is selected with the settings of the client, the ones of the daemon itself are the defaults. Only in-process backends are used: the others (i.e. the CLI one) spawn a compiler for each compilation anyway, so the daemon would only add a hop."""
+		from .backendSelector import iterateSuitableBackends
+
+		if not forcedBackend or forcedBackend == "daemon":
+			forcedBackend = self.forcedBackend if self.forcedBackend != "daemon" else None
+
+		refused = []
+		for b in iterateSuitableBackends(tolerableIssues=set(tolerableIssues) - {ISSUE_NAME}, forcedBackend=forcedBackend or ""):
+			try:
+				compilerClass = b()
+			except Exception as ex:
+				warnings.warn(repr(ex) + " when loading backend " + b.entryPoint.name)
+				continue
+			if compilerClass.inProcess:
+				return compilerClass
+			refused.append(b.entryPoint.name)
+
+		if refused:
+			raise KaitaiCompilerException("The daemon gives no benefit with the backends not compiling in-process (" + ", ".join(refused) + "), use them directly: don't tolerate `" + ISSUE_NAME + "` issue or force one of them")
+		raise KaitaiCompilerException("No backend is available for the daemon")
+
+	def getCompiler(self, ctorArgs: dict):
+		"""The selection settings are in the key, so the clients with different configs don't get each other's backends"""
+		key = json.dumps(ctorArgs, sort_keys=True)
+		compiler = self.compilers.get(key, None)
+		if compiler is None:
+			ctorArgs = dict(ctorArgs)
+			compilerClass = self.getCompilerClass(ctorArgs.pop("tolerableIssues", ()), ctorArgs.pop("forcedBackend", None))
+			if ctorArgs["importPath"] is not None:
+				ctorArgs["importPath"] = Path(ctorArgs["importPath"])
+			self.compilers[key] = compiler = compilerClass(progressCallback=self.messages.append, **ctorArgs)
+		return compiler
+
+	def getCompileArgs(self, msg: dict) -> typing.Tuple[typing.List[Path], typing.Dict[str, typing.Any]]:
+		destDir = msg["destDir"]
+		return [Path(p) for p in msg["sources"]], {
+			"destDir": Path(destDir) if destDir is not None else None,
+			"additionalFlags": msg["additionalFlags"],
+			"needInMemory": msg["needInMemory"],
+			"target": msg["target"],
+			"verbose": msg["verbose"],
+			"opaqueTypes": msg["opaqueTypes"],
+			"autoRead": msg["autoRead"],
+			"readStoresPos": msg["readStoresPos"],
+		}
+
+	def compile(self, msg: dict) -> dict:
+		compiler = self.getCompiler(msg["ctorArgs"])
+		sources, kwargs = self.getCompileArgs(msg)
+		results = compiler.compile(sources, **kwargs)
+		return {"results": [serializeResult(r) for r in results.values()]}
+
+	def compileIter(self, msg: dict) -> typing.Iterator[dict]:
+		compiler = self.getCompiler(msg["ctorArgs"])
+		sources, kwargs = self.getCompileArgs(msg)
+		for ev in compiler.compileIter(sources, **kwargs):
+			yield {"source": str(ev.source), "phase": int(ev.phase), "elapsed": ev.elapsed, "result": serializeResult(ev.result) if ev.result is not None else None}
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+	def handle(self) -> None:
+		server = self.server
+		msg = receiveMessage(self.rfile)
+		op = msg.get("op", None)
+
+		if op == "ping":
+			resp = {"protocol": PROTOCOL_VERSION, "pid": os.getpid()}
+		elif op == "shutdown":
+			server.idle = True
+			resp = {}
+		elif op == "compile":
+			with server.lock:
+				del server.messages[:]
+				try:
+					resp = server.compile(msg)
+				except Exception as ex:
+					resp = {"error": {"type": ex.__class__.__name__, "message": str(ex)}}
+				resp["messages"] = list(server.messages)
+		elif op == "compileIter":
+			with server.lock:
+				del server.messages[:]
+				try:
+					for ev in server.compileIter(msg):
+						sendMessage(self.wfile, {"event": ev})
+					resp = {}
+				except Exception as ex:
+					resp = {"error": {"type": ex.__class__.__name__, "message": str(ex)}}
+				resp["messages"] = list(server.messages)
+		else:
+			resp = {"error": {"type": "ValueError", "message": "Unknown op: " + repr(op)}}
+
+		sendMessage(self.wfile, resp)
+
+
+def serve(socketPath: Path, idleTimeout: float, forcedBackend: typing.Optional[str] = None) -> None:
+	"""A daemon holds a lock on `<socket>.lock` while it lives, the other ones exit. The lock is released by the OS when its holder dies, so a socket found by the lock holder has been left by a dead daemon. A daemon removes the socket on exit only if it is still the one it has bound."""
+	import fcntl
+
+	socketPath = Path(socketPath)
+	ensurePrivateDir(socketPath.parent)
+	with open(str(socketPath) + ".lock", "wb") as lockFile:
+		try:
+			fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return  # Another daemon is serving or starting
+
+		if socketPath.exists():
+			if isAlive(socketPath):
+				return  # A daemon not using the lock
+			socketPath.unlink()  # stale
+
+		with DaemonServer(socketPath, idleTimeout, forcedBackend) as server:
+			boundInode = os.stat(str(socketPath)).st_ino
+			try:
+				while not server.idle:
+					server.handle_request()
+			finally:
+				try:
+					if os.stat(str(socketPath)).st_ino == boundInode:
+						socketPath.unlink()
+				except OSError:
+					pass
+
+
+def shutdown(socketPath: typing.Optional[Path] = None) -> bool:
+	"""Asks the daemon to exit. Returns `False` if there was no daemon."""
+	if socketPath is None:
+		socketPath = getDaemonSocketPath()
+	try:
+		request(socketPath, {"op": "shutdown"}, timeout=STARTUP_TIMEOUT)
+		return True
+	except OSError:
+		return False
+
+
+def main() -> None:
+	import argparse
+
+	ap = argparse.ArgumentParser(prog="python -m " + __name__, description="A daemon keeping a warm Kaitai Struct compiler")
+	sp = ap.add_subparsers(dest="command", required=True)
+
+	serveP = sp.add_parser("serve", help="Serve the requests until idle for the timeout")
+	serveP.add_argument("--socket", type=Path, default=None)
+	serveP.add_argument("--idle-timeout", type=float, default=None)
+	serveP.add_argument("--backend", default=None, help="The backend to use, the best available one by default")
+
+	stopP = sp.add_parser("shutdown", help="Ask the running daemon to exit")
+	stopP.add_argument("--socket", type=Path, default=None)
+
+	args = ap.parse_args()
+	socketPath = args.socket if args.socket is not None else getDaemonSocketPath()
+
+	if args.command == "serve":
+		idleTimeout = args.idle_timeout if args.idle_timeout is not None else getDaemonIdleTimeoutFromEnv()
+		forcedBackend = args.backend if args.backend is not None else getDaemonBackendFromEnv()
+		serve(socketPath, idleTimeout, forcedBackend or None)
+	else:
+		shutdown(socketPath)
+
+
+if __name__ == "__main__":
+	main()
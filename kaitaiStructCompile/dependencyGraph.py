@@ -0,0 +1,204 @@
+"""A graph of `meta/imports` of KSYs. It is persisted between builds together with the stats and the hashes of the files, so on a rebuild only the changed files are read, and the KSYs affected by the changes are found without reading the rest."""
+
+import typing
+from collections import defaultdict
+from pathlib import Path
+
+from .cache import atomicWrite, hashFile
+from .ksyImports import readKSYMeta, resolveImport
+from .utils import json
+
+__all__ = ("KSYNode", "KSYDependencyGraph")
+
+GRAPH_FORMAT_VERSION = 1
+
+
+class KSYNode:
+	__slots__ = ("mtime", "size", "digest", "importsSpecs", "imports")
+
+	def __init__(self, mtime: int, size: int, digest: str, importsSpecs: typing.Tuple[str, ...], imports: typing.Tuple[typing.Optional[str], ...] = ()) -> None:
+		self.mtime = mtime
+		self.size = size
+		self.digest = digest
+		self.importsSpecs = importsSpecs
+		self.imports = imports  # resolved paths, `None` for unresolved ones
+
+	def toJSON(self) -> list:
+		return [self.mtime, self.size, self.digest, list(self.importsSpecs), list(self.imports)]
+
+	@classmethod
+	def fromJSON(cls, o: list) -> "KSYNode":
+		mtime, size, digest, importsSpecs, imports = o
+		return cls(mtime, size, digest, tuple(importsSpecs), tuple(imports))
+
+	def __repr__(self) -> str:
+		return self.__class__.__name__ + "(" + self.digest[:8] + ", " + repr(self.imports) + ")"
+
+
+class KSYDependencyGraph:
+	"""Nodes are KSYs identified by their absolute paths, edges are imports."""
+
+	__slots__ = ("nodes", "_dependents")
+
+	def __init__(self, nodes: typing.Optional[typing.Dict[str, KSYNode]] = None) -> None:
+		if nodes is None:
+			nodes = {}
+		self.nodes = nodes
+		self._dependents = None
+
+	@staticmethod
+	def _key(p: Path) -> str:
+		return str(Path(p).absolute())
+
+	def __contains__(self, p: Path) -> bool:
+		return self._key(p) in self.nodes
+
+	def __len__(self) -> int:
+		return len(self.nodes)
+
+	def update(self, ksysWithImportPaths: typing.Iterable[typing.Tuple[Path, typing.Iterable[Path]]]) -> typing.Set[str]:
+		"""Brings the graph in sync with the files. `ksysWithImportPaths` are the KSYs to start from, each one with the import paths used to compile it, the KSYs they import are added automatically. The nodes unreachable from them are removed. Returns the paths of the KSYs that are new, changed, removed or have their imports resolved differently."""
+
+		changed = set()
+		visited = set()
+		stack = [(self._key(p), tuple(importPaths)) for p, importPaths in ksysWithImportPaths]
+		stack.reverse()
+
+		while stack:
+			key, importPaths = stack.pop()
+			if key in visited:
+				continue
+			visited.add(key)
+
+			p = Path(key)
+			try:
+				st = p.stat()
+			except OSError:
+				continue
+
+			node = self.nodes.get(key, None)
+			if node is None or node.mtime != st.st_mtime_ns or node.size != st.st_size:
+				digest = hashFile(p)
+				if node is None or node.digest != digest:
+					node = KSYNode(st.st_mtime_ns, st.st_size, digest, readKSYMeta(p).imports)
+					changed.add(key)
+				else:
+					node.mtime = st.st_mtime_ns
+					node.size = st.st_size
+				self.nodes[key] = node
+
+			# Resolution depends on presence of other files, so it is redone every time. It is just a few `stat`s.
+			imports = tuple(self._resolve(spec, p, importPaths) for spec in node.importsSpecs)
+			if imports != node.imports:
+				node.imports = imports
+				changed.add(key)
+
+			for el in reversed(imports):
+				if el is not None:
+					stack.append((el, importPaths))
+
+		removed = set(self.nodes) - visited
+		for key in removed:
+			del self.nodes[key]
+		changed |= removed
+
+		self._dependents = None
+		return changed
+
+	@staticmethod
+	def _resolve(spec: str, importer: Path, importPaths: typing.Iterable[Path]) -> typing.Optional[str]:
+		res = resolveImport(spec, importer, importPaths)
+		if res is None:
+			return None
+		return str(res.absolute())
+
+	def imports(self, p: Path) -> typing.Tuple[str, ...]:
+		"""Resolved direct imports of a KSY"""
+		node = self.nodes.get(self._key(p), None)
+		if node is None:
+			return ()
+		return tuple(el for el in node.imports if el is not None)
+
+	def dependents(self, p: Path) -> typing.Tuple[str, ...]:
+		"""KSYs directly importing a KSY"""
+		if self._dependents is None:
+			deps = defaultdict(list)
+			for key in sorted(self.nodes):
+				for imp in self.imports(key):
+					deps[imp].append(key)
+			self._dependents = deps
+		return tuple(self._dependents.get(self._key(p), ()))
+
+	def _closure(self, starts: typing.Iterable[Path], step: typing.Callable[[str], typing.Iterable[str]]) -> typing.Set[str]:
+		res = set()
+		stack = [self._key(p) for p in starts]
+		while stack:
+			key = stack.pop()
+			for el in step(key):
+				if el not in res:
+					res.add(el)
+					stack.append(el)
+		return res
+
+	def transitiveImports(self, p: Path) -> typing.Set[str]:
+		return self._closure((p,), self.imports)
+
+	def transitiveDependents(self, paths: typing.Iterable[Path]) -> typing.Set[str]:
+		"""All the KSYs importing any of `paths` directly or indirectly"""
+		return self._closure(paths, self.dependents)
+
+	def affectedBy(self, changed: typing.Iterable[Path]) -> typing.Set[str]:
+		"""The KSYs that must be recompiled when `changed` ones change: the changed ones themselves and their reverse dependencies"""
+		changed = {self._key(p) for p in changed}
+		return changed | self.transitiveDependents(changed)
+
+	def toJSON(self) -> dict:
+		return {"version": GRAPH_FORMAT_VERSION, "nodes": {k: v.toJSON() for k, v in self.nodes.items()}}
+
+	@classmethod
+	def fromJSON(cls, o: dict) -> "KSYDependencyGraph":
+		if o.get("version", None) != GRAPH_FORMAT_VERSION:
+			return cls()
+		return cls({k: KSYNode.fromJSON(v) for k, v in o["nodes"].items()})
+
+	def save(self, path: Path) -> None:
+		path.parent.mkdir(parents=True, exist_ok=True)
+		atomicWrite(path, json.dumps(self.toJSON()).encode("utf-8"))
+
+	@classmethod
+	def load(cls, path: Path) -> "KSYDependencyGraph":
+		"""Loads a persisted graph. Returns an empty one, if there is none, or it is broken."""
+		try:
+			with path.open("rb") as f:
+				return cls.fromJSON(json.loads(f.read().decode("utf-8")))
+		except (OSError, ValueError, TypeError, KeyError):
+			return cls()
+
+	@classmethod
+	def fromDirs(cls, dirs: typing.Iterable[Path], importPaths: typing.Iterable[Path] = ()) -> "KSYDependencyGraph":
+		"""Builds a graph of all the KSYs within dirs"""
+		res = cls()
+		importPaths = tuple(importPaths)
+		res.update((p, importPaths) for d in dirs for p in sorted(Path(d).glob("**/*.ksy")))
+		return res
+
+
+def main() -> None:
+	import argparse
+
+	ap = argparse.ArgumentParser(prog="python -m " + __name__, description="Queries a graph of imports of KSYs")
+	ap.add_argument("dirs", type=Path, nargs="+", help="Dirs to search for KSYs")
+	ap.add_argument("--import-path", type=Path, action="append", default=[], help="KSC import paths")
+	ap.add_argument("--dependents", type=Path, action="append", default=[], help="Print the KSYs depending on this one, directly or not")
+	args = ap.parse_args()
+
+	g = KSYDependencyGraph.fromDirs(args.dirs, args.import_path)
+	if args.dependents:
+		res = sorted(g.transitiveDependents(args.dependents))
+	else:
+		res = {k: list(g.imports(k)) for k in sorted(g.nodes)}
+	print(json.dumps(res, indent=2))
+
+
+if __name__ == "__main__":
+	main()
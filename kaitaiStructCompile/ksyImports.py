@@ -0,0 +1,138 @@
+import re
+import typing
+from pathlib import Path
+
+__all__ = ("KSYMeta", "readKSYMeta", "parseKSYMeta", "resolveImport", "iterTransitiveImports", "getModulesNamesOfKSY")
+
+keyRx = re.compile("^(\\s*)(-\\s+)?([\\w-]+)\\s*:\\s*(.*?)\\s*$")
+listItemRx = re.compile("^(\\s*)-\\s*(.*?)\\s*$")
+commentRx = re.compile("\\s+#.*$")
+
+
+class KSYMeta:
+	__slots__ = ("id", "imports")
+
+	def __init__(self, id: typing.Optional[str] = None, imports: typing.Tuple[str, ...] = ()) -> None:
+		self.id = id
+		self.imports = imports
+
+	def __repr__(self) -> str:
+		return self.__class__.__name__ + "(" + repr(self.id) + ", " + repr(self.imports) + ")"
+
+
+def _unquote(s: str) -> str:
+	s = commentRx.sub("", s).strip()
+	if len(s) >= 2 and s[0] == s[-1] and s[0] in "\"'":
+		return s[1:-1]
+	return s
+
+
+def _parseFlowList(s: str) -> typing.Tuple[str, ...]:
+	s = commentRx.sub("", s).strip()
+	if s[:1] != "[" or s[-1:] != "]":
+		return ()
+	return tuple(_unquote(el) for el in s[1:-1].split(",") if el.strip())
+
+
+def parseKSYMeta(lines: typing.Iterable[str]) -> KSYMeta:
+	"""Extracts `meta/id` and `meta/imports` from KSY source lines without parsing the whole YAML. Handles both block and flow styles of the `imports` list. Stops reading right after the `meta` section."""
+
+	res = KSYMeta()
+	imports = []
+	inMeta = False
+	metaIndent = None
+	importsIndent = None
+
+	for l in lines:
+		l = l.rstrip("\r\n")
+		stripped = l.strip()
+		if not stripped or stripped[0] == "#":
+			continue
+
+		indent = len(l) - len(l.lstrip())
+
+		if not inMeta:
+			if indent == 0 and stripped.startswith("meta:"):
+				inMeta = True
+			continue
+
+		if indent == 0:
+			break  # the end of `meta`
+
+		if importsIndent is not None:
+			m = listItemRx.match(l)
+			if m and len(m.group(1)) >= importsIndent:
+				imports.append(_unquote(m.group(2)))
+				continue
+			importsIndent = None
+
+		m = keyRx.match(l)
+		if not m or m.group(2):
+			continue
+
+		if metaIndent is None:
+			metaIndent = indent
+		if indent != metaIndent:
+			continue
+
+		k, v = m.group(3), m.group(4)
+		if k == "id":
+			res.id = _unquote(v)
+		elif k == "imports":
+			if v:
+				imports.extend(_parseFlowList(v))
+			else:
+				importsIndent = indent
+
+	res.imports = tuple(imports)
+	return res
+
+
+def readKSYMeta(ksyPath: Path) -> KSYMeta:
+	with ksyPath.open("rt", encoding="utf-8") as f:
+		return parseKSYMeta(f)
+
+
+def resolveImport(importSpec: str, importerPath: Path, importPaths: typing.Iterable[Path] = ()) -> typing.Optional[Path]:
+	"""Resolves an import as KSC does: relative ones against the dir of the importing file, absolute ones (starting with `/`) against the import paths"""
+	fileName = importSpec + ".ksy"
+	if importSpec[:1] == "/":
+		candidates = (Path(p) / fileName[1:] for p in importPaths)
+	else:
+		candidates = (importerPath.parent / fileName,)
+
+	for c in candidates:
+		if c.is_file():
+			return c
+
+	return None
+
+
+def iterTransitiveImports(ksyPath: Path, importPaths: typing.Iterable[Path] = (), metaGetter: typing.Callable[[Path], KSYMeta] = readKSYMeta) -> typing.Iterator[typing.Tuple[Path, str, typing.Optional[Path]]]:
+	"""Yields `(importer, importSpec, resolvedPath)` for every import reachable from `ksyPath`, each import edge once, in a deterministic order. `resolvedPath` is `None` for the imports we cannot resolve."""
+
+	importPaths = tuple(importPaths)
+	seen = {ksyPath}
+	stack = [ksyPath]
+	while stack:
+		importer = stack.pop()
+		for spec in metaGetter(importer).imports:
+			resolved = resolveImport(spec, importer, importPaths)
+			yield importer, spec, resolved
+			if resolved is not None and resolved not in seen:
+				seen.add(resolved)
+				stack.append(resolved)
+
+
+def getModulesNamesOfKSY(ksyPath: Path, importPaths: typing.Iterable[Path]) -> typing.List[str]:
+	"""Names of the modules KSC emits when compiling a KSY: the one for the KSY itself and the ones for all the KSYs it transitively imports"""
+
+	def getModuleName(p: Path) -> str:
+		meta = readKSYMeta(p)
+		return meta.id if meta.id else p.stem
+
+	res = [getModuleName(ksyPath)]
+	for importer, spec, resolved in iterTransitiveImports(ksyPath, importPaths):
+		if resolved is not None:
+			res.append(getModuleName(resolved))
+	return res
@@ -0,0 +1,122 @@
+"""Finds KSYs within dirs. The listings of dirs are persisted in an index together with the mtimes of the dirs, so on a rebuild only the dirs in which something has been added, removed or renamed are listed again, the rest cost a `stat` each."""
+
+import os
+import time
+import typing
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+from .cache import atomicWrite
+from .utils import json
+
+__all__ = ("IGNORED_DIRS_NAMES", "KSYDirsIndex", "walkKSYs")
+
+INDEX_FORMAT_VERSION = 1
+KSY_SUFFIX = ".ksy"
+
+VCS_DIRS_NAMES = frozenset((".git", ".hg", ".svn", ".bzr", "_darcs", "CVS"))
+IGNORED_DIRS_NAMES = VCS_DIRS_NAMES | frozenset(("__pycache__", ".mypy_cache", ".pytest_cache", ".tox", ".nox"))
+
+# A dir modified within this interval may be modified again within the same mtime tick without changing its mtime, so its listing is not trusted
+RACY_INTERVAL_NS = 2 * 10**9
+
+
+class KSYDirsIndex:
+	"""Maps absolute paths of dirs to their mtimes, the names of `*.ksy` files and the names of subdirs in them"""
+
+	__slots__ = ("dirs", "visited", "listed")
+
+	def __init__(self, dirs: typing.Optional[typing.Dict[str, list]] = None) -> None:
+		if dirs is None:
+			dirs = {}
+		self.dirs = dirs
+		self.visited = set()
+		self.listed = 0
+
+	def listDir(self, d: str) -> typing.Tuple[typing.List[str], typing.List[str]]:
+		"""Returns the names of `*.ksy` files and of subdirs, sorted. Symlinks to dirs are not followed to avoid cycles."""
+		self.visited.add(d)
+		st = os.stat(d)
+		rec = self.dirs.get(d, None)
+		if rec is not None and rec[0] == st.st_mtime_ns:
+			return rec[1], rec[2]
+
+		self.listed += 1
+		ksys = []
+		subDirs = []
+		with os.scandir(d) as it:
+			for e in it:
+				try:
+					if e.is_dir(follow_symlinks=False):
+						subDirs.append(e.name)
+					elif e.name.endswith(KSY_SUFFIX) and e.is_file():
+						ksys.append(e.name)
+				except OSError:
+					pass
+		ksys.sort()
+		subDirs.sort()
+
+		if time.time_ns() - st.st_mtime_ns > RACY_INTERVAL_NS:
+			self.dirs[d] = [st.st_mtime_ns, ksys, subDirs]
+		else:
+			self.dirs.pop(d, None)
+		return ksys, subDirs
+
+	def toJSON(self) -> dict:
+		"""Only the dirs visited since loading are kept, so removed dirs don't accumulate"""
+		return {"version": INDEX_FORMAT_VERSION, "dirs": {k: v for k, v in self.dirs.items() if k in self.visited}}
+
+	@classmethod
+	def fromJSON(cls, o: dict) -> "KSYDirsIndex":
+		if o.get("version", None) != INDEX_FORMAT_VERSION:
+			return cls()
+		return cls(o["dirs"])
+
+	def save(self, path: Path) -> None:
+		path.parent.mkdir(parents=True, exist_ok=True)
+		atomicWrite(path, json.dumps(self.toJSON()).encode("utf-8"))
+
+	@classmethod
+	def load(cls, path: Path) -> "KSYDirsIndex":
+		try:
+			with path.open("rb") as f:
+				return cls.fromJSON(json.loads(f.read().decode("utf-8")))
+		except (OSError, ValueError, TypeError, KeyError):
+			return cls()
+
+
+def _matchesAny(relPath: str, patterns: typing.Iterable[str]) -> bool:
+	return any(fnmatchcase(relPath, p) for p in patterns)
+
+
+def walkKSYs(root: Path, include: typing.Iterable[str] = (), exclude: typing.Iterable[str] = (), index: typing.Optional[KSYDirsIndex] = None) -> typing.Iterator[Path]:
+	"""Yields `*.ksy` files within `root` in a deterministic order. VCS and cache dirs are pruned. `include` and `exclude` are `fnmatch` patterns matched against the POSIX paths relative to `root`; the dirs matching `exclude` are pruned."""
+	include = tuple(include)
+	exclude = tuple(exclude)
+	if index is None:
+		index = KSYDirsIndex()
+
+	root = Path(root).absolute()
+	stack = [(str(root), "")]
+	while stack:
+		d, rel = stack.pop()
+		try:
+			ksys, subDirs = index.listDir(d)
+		except OSError:
+			continue
+
+		for name in ksys:
+			relPath = rel + name
+			if include and not _matchesAny(relPath, include):
+				continue
+			if exclude and _matchesAny(relPath, exclude):
+				continue
+			yield Path(d) / name
+
+		for name in reversed(subDirs):
+			if name in IGNORED_DIRS_NAMES:
+				continue
+			relPath = rel + name
+			if exclude and _matchesAny(relPath, exclude):
+				continue
+			stack.append((os.path.join(d, name), relPath + "/"))
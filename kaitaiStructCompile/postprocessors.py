@@ -1,9 +1,143 @@
 import ast
 import re
 import typing
+import warnings
+from functools import wraps
+from importlib import import_module
 from pathlib import Path
 
-from .utils import walkPathInMappingsTree
+from .tracing import span
+
+
+if typing.TYPE_CHECKING:
+	from .cache import DiskCache
+
+
+def astPostprocessor(transformTree: typing.Callable[..., ast.AST]) -> typing.Callable[..., str]:
+	"""Makes a usual text-to-text postprocessor from a function `transformTree(tree, fileName, *args) -> tree`. The function is kept in `transformTree` attribute, so `runPostprocessingChain` can pass the same tree through consecutive AST postprocessors, parsing and unparsing once."""
+
+	@wraps(transformTree)
+	def postprocessor(fileText: str, fileName: typing.Union[str, Path], *args) -> str:
+		return unparseTree(transformTree(ast.parse(fileText, filename=str(fileName)), fileName, *args))
+
+	postprocessor.transformTree = transformTree
+	return postprocessor
+
+
+def unparseTree(tree: ast.AST) -> str:
+	ast.fix_missing_locations(tree)
+	return ast.unparse(tree)
+
+
+def getPostprocessorName(postprocessor: typing.Callable) -> str:
+	return getattr(postprocessor, "__name__", repr(postprocessor))
+
+
+def runPostprocessingChain(fileText: str, fileName: typing.Union[str, Path], postprocessingTasks: typing.Iterable[typing.Tuple[typing.Callable, typing.Iterable[typing.Any]]]) -> str:
+	"""Applies the postprocessors in order. A run of AST postprocessors shares a single parsed tree. Text postprocessors having `commutesWithAST` attribute set don't break such a run: they are applied after the tree is unparsed."""
+
+	tree = None
+	deferred = []
+
+	def flush() -> str:
+		with span("unparse", "postprocess"):
+			fileText = unparseTree(tree)
+		for postprocessor, args in deferred:
+			with span("postprocess " + getPostprocessorName(postprocessor), "postprocess"):
+				fileText = postprocessor(fileText, fileName, *args)
+		del deferred[:]
+		return fileText
+
+	for postprocessor, args in postprocessingTasks:
+		transformTree = getattr(postprocessor, "transformTree", None)
+		if transformTree is not None:
+			if tree is None:
+				with span("parse", "postprocess"):
+					tree = ast.parse(fileText, filename=str(fileName))
+			with span("postprocess " + getPostprocessorName(postprocessor), "postprocess"):
+				tree = transformTree(tree, fileName, *args)
+		elif tree is not None and getattr(postprocessor, "commutesWithAST", False):
+			deferred.append((postprocessor, args))
+		else:
+			if tree is not None:
+				fileText = flush()
+				tree = None
+			with span("postprocess " + getPostprocessorName(postprocessor), "postprocess"):
+				fileText = postprocessor(fileText, fileName, *args)
+
+	if tree is not None:
+		fileText = flush()
+	return fileText
+
+
+def resolvePostprocessor(spec: typing.Union[str, typing.Callable]) -> typing.Callable:
+	"""Postprocessors can be registered by dotted names, `package.module:func` or `package.module.func`. Such ones are importable in worker processes too."""
+	if callable(spec):
+		return spec
+
+	if ":" in spec:
+		moduleName, qualName = spec.split(":", 1)
+	else:
+		moduleName, qualName = spec.rsplit(".", 1)
+
+	res = import_module(moduleName)
+	for name in qualName.split("."):
+		res = getattr(res, name)
+	return res
+
+
+POSTPROCESSING_CACHE_FORMAT_VERSION = 1
+
+
+def isCacheable(postprocessor: typing.Callable, uncacheable: typing.Container[typing.Callable] = ()) -> bool:
+	"""Postprocessors depending on anything except their input text, args and the files passed as args must set `cacheable` attribute to `False`"""
+	return getattr(postprocessor, "cacheable", True) and postprocessor not in uncacheable
+
+
+def computePostprocessingCacheKey(fileText: str, fileName: typing.Union[str, Path], postprocessingTasks: typing.Iterable[typing.Tuple[typing.Callable, typing.Iterable[typing.Any]]]) -> str:
+	from .cache import argIdentity, callableIdentity, hashBytes, hashJSONable
+
+	return hashJSONable({
+		"version": POSTPROCESSING_CACHE_FORMAT_VERSION,
+		"text": hashBytes(fileText.encode("utf-8")),
+		"fileName": Path(str(fileName)).name,
+		"chain": [[callableIdentity(pp), [argIdentity(a) for a in args]] for pp, args in postprocessingTasks],
+	})
+
+
+def runCachedPostprocessingChain(fileText: str, fileName: typing.Union[str, Path], postprocessingTasks: typing.Iterable[typing.Tuple[typing.Callable, typing.Iterable[typing.Any]]], cache: typing.Optional["DiskCache"] = None, uncacheable: typing.Container[typing.Callable] = ()) -> str:
+	"""Like `runPostprocessingChain`, but the results of the runs of cacheable postprocessors are taken from `cache`, if present there"""
+
+	if cache is None:
+		return runPostprocessingChain(fileText, fileName, postprocessingTasks)
+
+	segment = []
+
+	def flush(fileText: str) -> str:
+		if not segment:
+			return fileText
+
+		key = computePostprocessingCacheKey(fileText, fileName, segment)
+		payload = cache.get(key)
+		if payload is not None:
+			fileText = payload["text"]
+		else:
+			fileText = runPostprocessingChain(fileText, fileName, segment)
+			cache.put(key, {"text": fileText})
+
+		del segment[:]
+		return fileText
+
+	for postprocessor, args in postprocessingTasks:
+		if isCacheable(postprocessor, uncacheable):
+			segment.append((postprocessor, tuple(args)))
+		else:
+			fileText = flush(fileText)
+			with span("postprocess " + getPostprocessorName(postprocessor), "postprocess"):
+				fileText = postprocessor(fileText, fileName, *args)
+
+	return flush(fileText)
+
 
 permissiveDecodingRx = re.compile("\\.decode\\((u?)([\"'])([\\w-]+)(\\2)\\)")
 
@@ -12,122 +146,243 @@ def permissiveDecoding(fileText: str, fileName: typing.Union[str, Path]) -> str:
 	return permissiveDecodingRx.sub('.decode(\\1\\2\\3\\2, errors="ignore")', fileText)
 
 
-class RewriteEnumIntoIntEnum(ast.NodeTransformer):
-	__slots__ = ("registeredEnums", "registeredEnumVars", "rewriteFrom", "rewriteTo")
+permissiveDecoding.version = 1
+permissiveDecoding.commutesWithAST = True  # AST postprocessors don't touch `.decode` calls, and the regex matches both quotes styles `ast.unparse` may emit
+
+
+def getPathFromAttrNode(node: ast.AST) -> typing.Optional[typing.Tuple[str, ...]]:
+	"""`a.b.c` -> `("a", "b", "c")`, `None` if the chain doesn't start with a name"""
+	path = []
+	current = node
+	while isinstance(current, ast.Attribute):
+		path.append(current.attr)
+		current = current.value
+	if not isinstance(current, ast.Name):
+		return None
+	path.append(current.id)
+	path.reverse()
+	return tuple(path)
+
+
+def isResolveEnumCall(node: ast.AST) -> bool:
+	"""`KaitaiStream.resolve_enum(...)`"""
+	return isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "resolve_enum" and isinstance(node.func.value, ast.Name) and node.func.value.id == "KaitaiStream"
+
+
+STATEMENTS_LISTS_FIELDS = ("body", "orelse", "finalbody", "handlers", "cases")
+
+
+class EnumsIndex:
+	"""The first pass of `fixEnums`. Collects the full paths of enum classes and of the fields assigned results of `resolve_enum` into flat dicts. Only statements are walked, expressions cannot contain either."""
+
+	__slots__ = ("enumBaseName", "enums", "enumVars")
+
+	def __init__(self, tree: typing.Optional[ast.AST] = None, enumBaseName: str = "Enum") -> None:
+		self.enumBaseName = enumBaseName
+		self.enums = {}  # full path of an enum class -> its node
+		self.enumVars = {}  # full path of a field (the path of its class + its name) -> full path of its enum
+		if tree is not None:
+			self.add(tree)
+
+	def isEnumClass(self, node: ast.ClassDef) -> bool:
+		return len(node.bases) == 1 and isinstance(node.bases[0], ast.Name) and node.bases[0].id == self.enumBaseName
+
+	def registerAssign(self, node: ast.Assign, classPath: typing.Tuple[str, ...]) -> None:
+		if len(node.targets) != 1:
+			return
+		t = node.targets[0]
+		c = node.value
+		if isinstance(t, ast.Attribute) and isinstance(t.value, ast.Name) and t.value.id == "self" and isResolveEnumCall(c) and len(c.args) >= 2 and isinstance(c.args[0], ast.Attribute):
+			enumPath = getPathFromAttrNode(c.args[0])
+			if enumPath:
+				self.enumVars[classPath + (t.attr,)] = enumPath
+
+	def add(self, tree: ast.AST) -> None:
+		stack = [(tree, ())]
+		while stack:
+			node, classPath = stack.pop()
+			if isinstance(node, ast.ClassDef):
+				classPath = classPath + (node.name,)
+				if self.isEnumClass(node):
+					self.enums[classPath] = node
+			elif isinstance(node, ast.Assign):
+				self.registerAssign(node, classPath)
+				continue
+
+			for field in STATEMENTS_LISTS_FIELDS:
+				for el in getattr(node, field, ()):
+					stack.append((el, classPath))
+
+
+class RewriteEnumIntoIntEnum:
+	"""The second pass of `fixEnums`. Rewrites in place in a single traversal with lookups in the index built by the first one, so the uses of enums are recognized regardless of whether they precede the definitions."""
+
+	__slots__ = ("index", "rewriteFrom", "rewriteTo")
 
-	def __init__(self):
-		self.registeredEnums = {}
-		self.registeredEnumVars = {}
-		self.rewriteFrom = "Enum"
+	def __init__(self, index: EnumsIndex) -> None:
+		self.index = index
+		self.rewriteFrom = index.enumBaseName
 		self.rewriteTo = "IntEnum"
-		self.currentPath = []
-
-	def visit_ImportFrom(self, node):
-		if node.module == "enum":
-			for al in node.names:
-				if al.name == self.rewriteFrom:
-					al.name = self.rewriteTo
-		return self.generic_visit(node)
-
-	def registerEnum(self, enumNode):
-		self.registerMember(self.registeredEnums, enumNode.name, enumNode)
-
-	def registerEnumVariable(self, enumVarNodeName, payload):
-		self.registerMember(self.registeredEnumVars, enumVarNodeName, payload)
-
-	def registerMember(self, trie, memberName, payload):
-		current = trie
-		for c in self.currentPath:
-			try:
-				current = current[c]
-			except KeyError:
-				newSubItem = {}
-				current[c] = newSubItem
-				current = newSubItem
-
-		current[memberName] = payload
-
-	def getPathFromAttrNode(self, node):
-		path = []
-		current = node
-		while isinstance(current, ast.Attribute):
-			path.append(current.attr)
-			current = current.value
-		else:
-			if isinstance(current, ast.Name):
-				path.append(current.id)
-			else:
-				return None
-		path.reverse()
-		return tuple(path)
-
-	def visit_Assign(self, node):
-		if len(node.targets) == 1:
-			t = node.targets[0]
-			c = node.value
-			if isinstance(c, ast.Call) and isinstance(t, ast.Attribute) and isinstance(t.value, ast.Name) and t.value.id == "self" and isinstance(c.func, ast.Attribute) and isinstance(c.func.value, ast.Name) and c.func.value.id == "KaitaiStream" and c.func.attr == "resolve_enum":
-				varName = t.attr
-				if len(c.args) >= 2:
-					a = c.args[0]
-					if isinstance(a, ast.Attribute):
-						p = self.getPathFromAttrNode(a)
-						if p:
-							self.registerEnumVariable(varName, p)
-		return self.generic_visit(node)
-
-	def lookupPathInEnums(self, path):
-		return walkPathInMappingsTree(path, self.registeredEnums)
-
-	def lookupPathInEnumVars(self, path):
-		return walkPathInMappingsTree(path, self.registeredEnumVars)
-
-	def visit_ClassDef(self, node):
-		if len(node.bases) == 1 and node.bases[0].id == self.rewriteFrom:
-			self.registerEnum(node)
-			node.bases[0].id = self.rewriteTo
-
-		self.currentPath.append(node.name)
-		res = self.generic_visit(node)
-		self.currentPath.pop()
-		return res
 
-	def visit_Attribute(self, node):
-		path = self.getPathFromAttrNode(node)
+	def rewriteAttribute(self, node: ast.Attribute, classPath: typing.Tuple[str, ...]) -> typing.Optional[ast.AST]:
+		"""Returns the replacement of `<something>.value`, if the something is derived to be a enum"""
+		path = getPathFromAttrNode(node.value)
 		if path:
-			if path[-1] == "value":
-				path = path[:-1]  # we cut .value
-				if path:
-					if path[0] == "self":
-						# possible use of a variable that a enum value
-						path = path[1:]  # we cut self.
-						path = tuple(self.currentPath) + path
-						enumVar = self.lookupPathInEnumVars(path)
-						if enumVar:
-							return node.value
-					else:
-						# possible use of enum class
-						path = path[:-1]  # we cut .value_name
-						r = self.lookupPathInEnums(path)
-						if r:
-							return node.value
-		return self.generic_visit(node)
-
-
-def fixEnums(fileText: str, fileName: typing.Union[str, Path]) -> str:
+			if path[0] == "self":
+				# possible use of a variable that a enum value
+				if classPath + path[1:] in self.index.enumVars:
+					return node.value
+			elif path[:-1] in self.index.enums:
+				# use of a member of an enum class, `Enum.member.value`
+				return node.value
+		return None
+
+	def visit(self, tree: ast.AST) -> ast.AST:
+		stack = [(tree, ())]
+		while stack:
+			node, classPath = stack.pop()
+			if isinstance(node, ast.ClassDef):
+				classPath = classPath + (node.name,)
+				if classPath in self.index.enums:
+					self.rewriteEnumBase(node)
+			elif isinstance(node, ast.ImportFrom):
+				if node.module == "enum":
+					for al in node.names:
+						if al.name == self.rewriteFrom:
+							self.rewriteImportedName(node, al)
+				continue
+
+			for field in node._fields:
+				v = getattr(node, field, None)
+				if isinstance(v, list):
+					for i, el in enumerate(v):
+						if isinstance(el, ast.AST):
+							if isinstance(el, ast.Attribute) and el.attr == "value":
+								replacement = self.rewriteAttribute(el, classPath)
+								if replacement is not None:
+									v[i] = el = self.replaceNode(el, replacement)
+							stack.append((el, classPath))
+				elif isinstance(v, ast.AST):
+					if isinstance(v, ast.Attribute) and v.attr == "value":
+						replacement = self.rewriteAttribute(v, classPath)
+						if replacement is not None:
+							v = self.replaceNode(v, replacement)
+							setattr(node, field, v)
+					stack.append((v, classPath))
+		return tree
+
+	def rewriteEnumBase(self, node: ast.ClassDef) -> None:
+		node.bases[0].id = self.rewriteTo
+
+	def rewriteImportedName(self, node: ast.ImportFrom, alias: ast.alias) -> None:
+		alias.name = self.rewriteTo
+
+	def replaceNode(self, node: ast.AST, replacement: ast.AST) -> ast.AST:
+		"""Returns the node to be put into the tree instead of `node`"""
+		return replacement
+
+
+class EnumsSplicer(RewriteEnumIntoIntEnum):
+	"""Records the rewrites as edits of spans of the source instead of doing them in the tree, so the rest of the source, including formatting and comments, is kept intact"""
+
+	__slots__ = ("edits",)
+
+	def __init__(self, index: EnumsIndex) -> None:
+		super().__init__(index)
+		self.edits = []  # (node which span is replaced, a replacement: either a node which source is used, or a `str`)
+
+	def rewriteEnumBase(self, node: ast.ClassDef) -> None:
+		self.edits.append((node.bases[0], self.rewriteTo))
+
+	def rewriteImportedName(self, node: ast.ImportFrom, alias: ast.alias) -> None:
+		self.edits.append((alias if hasattr(alias, "end_col_offset") else (node, alias.name), self.rewriteTo))
+
+	def replaceNode(self, node: ast.AST, replacement: ast.AST) -> ast.AST:
+		self.edits.append((node, replacement))
+		return node
+
+
+class SourceSpans:
+	"""Converts positions of AST nodes (their columns are offsets in UTF-8 bytes) into offsets in the encoded source"""
+
+	__slots__ = ("source", "linesStarts")
+
+	def __init__(self, source: bytes) -> None:
+		self.source = source
+		self.linesStarts = [0]
+		for m in re.finditer(b"\n", source):
+			self.linesStarts.append(m.end())
+
+	def offset(self, lineNo: int, colOffset: int) -> int:
+		return self.linesStarts[lineNo - 1] + colOffset
+
+	def span(self, node: ast.AST) -> typing.Tuple[int, int]:
+		return self.offset(node.lineno, node.col_offset), self.offset(node.end_lineno, node.end_col_offset)
+
+	def nameSpan(self, node: ast.AST, name: str) -> typing.Tuple[int, int]:
+		"""For the nodes having no own positions, like `alias` before python 3.10: the span of the last occurrence of the name within the parent"""
+		start, end = self.span(node)
+		starts = [m.start() for m in re.finditer(b"\\b" + re.escape(name.encode("utf-8")) + b"\\b", self.source[start:end])]
+		return start + starts[-1], start + starts[-1] + len(name.encode("utf-8"))
+
+
+def spliceEdits(source: str, edits: typing.Iterable[typing.Tuple[typing.Union[ast.AST, typing.Tuple[ast.AST, str]], typing.Union[ast.AST, str]]]) -> str:
+	"""Applies the edits recorded by `EnumsSplicer` to the source. The edits nested into already applied ones are skipped."""
+	spans = SourceSpans(source.encode("utf-8"))
+	resolved = []
+	for target, replacement in edits:
+		if isinstance(target, tuple):
+			start, end = spans.nameSpan(*target)
+		else:
+			start, end = spans.span(target)
+
+		if isinstance(replacement, str):
+			replacement = replacement.encode("utf-8")
+		else:
+			rStart, rEnd = spans.span(replacement)
+			replacement = spans.source[rStart:rEnd]
+		resolved.append((start, end, replacement))
+
+	resolved.sort(key=lambda e: (e[0], -e[1]))
+	res = []
+	pos = 0
+	for start, end, replacement in resolved:
+		if start < pos:
+			continue  # nested into the previous one
+		res.append(spans.source[pos:start])
+		res.append(replacement)
+		pos = end
+	res.append(spans.source[pos:])
+	return b"".join(res).decode("utf-8")
+
+
+@astPostprocessor
+def fixEnums(tree: ast.Module, fileName: typing.Union[str, Path]) -> ast.Module:
 	"""
-	Replaces `Enum` with `IntEnum`, removes `.value` (result of `.to_i`, but broken for unrecognized enums, which are just ints) when it can derive the enum is used.
+	Replaces `Enum` with `IntEnum`, removes `.value` (result of `.to_i`, but broken for unrecognized enums, which are just ints) when it can derive the enum is used."""
+
+	return RewriteEnumIntoIntEnum(EnumsIndex(tree)).visit(tree)
+
+
+fixEnums.version = 2  # two-pass: the uses of enums preceding their definitions are rewritten too
+
+
+def fixEnumsSpliced(fileText: str, fileName: typing.Union[str, Path]) -> str:
+	"""The same as `fixEnums`, but splices the changes into the source instead of regenerating it with `ast.unparse`: faster, keeps formatting and comments, and leaves the unchanged lines as they are."""
 
-	ToDo: make it 2-pass"""
+	tree = ast.parse(fileText, filename=str(fileName))
+	splicer = EnumsSplicer(EnumsIndex(tree))
+	splicer.visit(tree)
+	return spliceEdits(fileText, splicer.edits)
 
-	iF = ast.parse(fileText, filename=fileName)
-	resTree = RewriteEnumIntoIntEnum().visit(iF)
-	ast.fix_missing_locations(resTree)
-	return ast.unparse(resTree)
+
+fixEnumsSpliced.version = 1
 
 
 postprocessors = {
 	"permissiveDecoding": permissiveDecoding,
 	"fixEnums": fixEnums,
+	"fixEnumsSpliced": fixEnumsSpliced,
 }
 
 patch = None
@@ -145,27 +400,53 @@ if patch:
 	from io import BytesIO
 	from pathlib import Path, PurePath
 
-	def applyPatch(fileText: str, fileName: typing.Union[str, Path], patchFile: Path):
-		with patchFile.open("rb") as psf:
-			ps = patch.PatchSet(psf)
-			ps.parse(psf)
-
-		if len(ps.items) != 1:
-			raise ValueError("Patch file contains more than 1 patch", patchFile, len(ps.items))
-
-		p = ps.items[0]
-		s = PurePath(p.source.decode("utf-8"))
-		t = PurePath(p.target.decode("utf-8"))
-		if s != t:
-			raise ValueError("Patch file patches not the same file", patchFile)
-		#t.name
+	_patchSets = {}
+
+	def loadPatchSet(patchFile: Path) -> "patch.PatchSet":
+		"""Parses a patch file. Parsed sets are cached by the hash of the contents, so a patch applied to many modules, or in many builds within a process, is parsed once."""
+		from .cache import hashBytes
+
+		data = Path(patchFile).read_bytes()
+		digest = hashBytes(data)
+		ps = _patchSets.get(digest, None)
+		if ps is None:
+			ps = patch.PatchSet(BytesIO(data))
+			if ps.errors:
+				raise ValueError("Patch file cannot be parsed", patchFile, ps.errors)
+			_patchSets[digest] = ps
+		return ps
+
+	def getPatchItemsForFile(ps: "patch.PatchSet", patchFile: Path, fileName: typing.Union[str, Path], byName: bool = False) -> list:
+		"""The patches are matched by the name of the target file, a set may have no patches for a file. Unless `byName`, a patch set of a single patch is applied to any file: a target's own patch is meant for its module whatever it is named."""
+		res = []
+		for p in ps.items:
+			s = PurePath(p.source.decode("utf-8"))
+			t = PurePath(p.target.decode("utf-8"))
+			if s.name != t.name:
+				raise ValueError("Patch file patches not the same file", patchFile, str(s), str(t))
+			if (not byName and len(ps.items) == 1) or t.name == PurePath(fileName).name:
+				res.append(p)
+		return res
 
-		with BytesIO(fileText.encode("utf-8")) as sF:
-			return b"".join(ps.patch_stream(sF, p.hunks)).decode("utf-8")
+	def applyPatch(fileText: str, fileName: typing.Union[str, Path], patchFile: Path, byName: bool = False):
+		ps = loadPatchSet(patchFile)
+		for p in getPatchItemsForFile(ps, patchFile, fileName, byName):
+			with BytesIO(fileText.encode("utf-8")) as sF:
+				fileText = b"".join(ps.patch_stream(sF, p.hunks)).decode("utf-8")
+		return fileText
 
 	def applyPatches(fileText: str, fileName: typing.Union[str, Path], *patchFiles: typing.Iterable[str]):
 		for f in patchFiles:
 			fileText = applyPatch(fileText, fileName, Path(f))
 		return fileText
 
+	def applyPatchesByName(fileText: str, fileName: typing.Union[str, Path], *patchFiles: typing.Iterable[str]):
+		"""Used for the patches of a refspec: they are applied to every module, so each module gets only the patches targeting a file of its name"""
+		for f in patchFiles:
+			fileText = applyPatch(fileText, fileName, Path(f), byName=True)
+		return fileText
+
+	applyPatches.version = 1
+	applyPatchesByName.version = 1
+
 	postprocessors["applyPatches"] = applyPatches
@@ -1,20 +1,218 @@
+import os
 import re
+import time
+import typing
+import warnings
 from pathlib import Path
 
 import git
 
 from .colors import styles
+from .ksyImports import readKSYMeta
+from .ksyScanner import walkKSYs
+from .tracing import span
+from .utils import json
 
-headBranchExtractionRegExp = re.compile("^\\s*HEAD\\s+branch:\\s+(.+)\\s*$", re.M)
+abbreviatedCommitRegExp = re.compile("^[0-9a-fA-F]{7,40}$")
 
+BRANCHES_PREFIX = "refs/heads/"
+TAGS_PREFIX = "refs/tags/"
 
-def getRemoteDefaultBranch(remote):
-	# get_remote_ref_states
-	return headBranchExtractionRegExp.search(remote.repo.git.remote("show", remote.name)).group(1)
+SPARSE_CHECKOUT_FILE_NAME = "info/sparse-checkout"
+WHOLE_TREE_PATTERN = "/*"
+PARTIAL_CLONE_FILTER = "blob:none"
 
+REMOTE_STATE_FILE_NAME = "kaitaiStructCompile.json"
+REMOTE_STATE_FORMAT_VERSION = 1
 
-def upgradeLibrary(localPath: Path, gitUri: str, refspec: str = None, progressCallback=None, prefixPath: Path = None):
-	"""Upgrades a library of Kaitai Struct formats"""
+
+def resolveLocalCommit(r: git.Repo, rev: str) -> typing.Optional[str]:
+	"""Returns the full hash of a commit, if it is present in the local repo"""
+	try:
+		return r.git.rev_parse("--verify", "--quiet", rev + "^{commit}")
+	except git.GitCommandError:
+		return None
+
+
+def resolvePinnedRefspec(r: git.Repo, refspec: str) -> typing.Optional[str]:
+	"""Tags and commits never move, so if they are present locally there is nothing to ask the remote about"""
+	if not refspec:
+		return None
+	commit = resolveLocalCommit(r, TAGS_PREFIX + refspec)
+	if commit is None and abbreviatedCommitRegExp.match(refspec):
+		commit = resolveLocalCommit(r, refspec)
+	return commit
+
+
+def lsRemote(remote, refspec: str) -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+	"""Returns the full name of the ref `refspec` (the default branch if empty) resolves to in the remote, and the commit it points to. Learning the default branch costs the same round trip as learning its commit. `(None, None)` if `refspec` is neither a branch, nor a tag (i.e. it is a commit)."""
+	if refspec:
+		out = remote.repo.git.ls_remote(remote.name, BRANCHES_PREFIX + refspec, TAGS_PREFIX + refspec)
+	else:
+		out = remote.repo.git.ls_remote("--symref", remote.name, "HEAD")
+
+	refs = {}
+	head = None
+	for l in out.splitlines():
+		if l.startswith("ref: "):
+			head = l[5:].split("\t", 1)[0]
+		elif l:
+			commit, ref = l.split("\t", 1)
+			refs[ref] = commit
+
+	if not refspec:
+		return head, refs.get("HEAD", None)
+
+	for ref in (BRANCHES_PREFIX + refspec, TAGS_PREFIX + refspec):
+		commit = refs.get(ref + "^{}", refs.get(ref, None))  # annotated tags are peeled
+		if commit is not None:
+			return ref, commit
+	return None, None
+
+
+class RemoteState:
+	"""What has been learnt from the remote: for each asked branch (`""` for the default one) the full name of the branch, the commit it has pointed to and when. Kept in `.git` dir, so it is removed together with the repo."""
+
+	__slots__ = ("path", "gitUri", "refs")
+
+	def __init__(self, gitDir: Path, gitUri: str) -> None:
+		self.path = Path(gitDir) / REMOTE_STATE_FILE_NAME
+		self.gitUri = gitUri
+		self.refs = {}
+		try:
+			with self.path.open("rb") as f:
+				o = json.loads(f.read().decode("utf-8"))
+		except (OSError, ValueError):
+			return
+
+		if isinstance(o, dict) and o.get("version", None) == REMOTE_STATE_FORMAT_VERSION and o.get("gitUri", None) == gitUri:
+			self.refs = o["refs"]
+
+	def get(self, refspec: str, ttl: float) -> typing.Optional[dict]:
+		rec = self.refs.get(refspec, None)
+		if rec is None or time.time() - rec["time"] > ttl:
+			return None
+		return rec
+
+	def set(self, refspec: str, ref: str, commit: str) -> None:
+		self.refs[refspec] = {"ref": ref, "commit": commit, "time": time.time()}
+
+	def save(self) -> None:
+		from .cache import atomicWrite
+
+		atomicWrite(self.path, json.dumps({"version": REMOTE_STATE_FORMAT_VERSION, "gitUri": self.gitUri, "refs": self.refs}).encode("utf-8"))
+
+
+def enablePartialClone(r: git.Repo, remoteName: str) -> None:
+	"""Makes the remote a promisor one: the fetches from it get only commits and trees, the blobs are fetched by git when they are checked out"""
+	section = 'remote "' + remoteName + '"'
+	with r.config_writer() as w:
+		w.set_value("core", "repositoryformatversion", "1")
+		w.set_value("core", "sparseCheckout", "true")
+		w.set_value("extensions", "partialClone", remoteName)
+		w.set_value(section, "promisor", "true")
+		w.set_value(section, "partialclonefilter", PARTIAL_CLONE_FILTER)
+
+
+def pathsIntoSparsePatterns(paths: typing.Iterable[str]) -> typing.Set[str]:
+	"""`paths` are POSIX paths relative to the root of the repo, the ones of dirs end with `/`. An empty path means the whole tree."""
+	res = set()
+	for p in paths:
+		p = p.strip("/") + ("/" if p.endswith("/") else "")
+		res.add("/" + p if p.strip("/") else WHOLE_TREE_PATTERN)
+	return res
+
+
+def getSparseCheckoutFile(r: git.Repo) -> Path:
+	return Path(r.git_dir) / SPARSE_CHECKOUT_FILE_NAME
+
+
+def readSparsePatterns(r: git.Repo) -> typing.Set[str]:
+	try:
+		return set(l for l in getSparseCheckoutFile(r).read_text(encoding="utf-8").splitlines() if l and l[0] != "#")
+	except OSError:
+		return set()
+
+
+def writeSparsePatterns(r: git.Repo, patterns: typing.Iterable[str]) -> bool:
+	"""Non-cone patterns are used, since the imports are single files. Returns whether the patterns have changed."""
+	patterns = set(patterns)
+	if patterns == readSparsePatterns(r):
+		return False
+	p = getSparseCheckoutFile(r)
+	p.parent.mkdir(parents=True, exist_ok=True)
+	p.write_text("".join(l + "\n" for l in sorted(patterns)), encoding="utf-8")
+	return True
+
+
+def isCoveredBySparsePatterns(pattern: str, patterns: typing.Set[str]) -> bool:
+	return pattern in patterns or any(p.endswith("/") and pattern.startswith(p) for p in patterns)
+
+
+def findMissingImports(localPath: Path, patterns: typing.Iterable[str]) -> typing.Set[str]:
+	"""Returns the patterns of the KSYs imported by the checked out ones and not covered by `patterns`. The import paths are the root of the repo, as in the pipeline."""
+	patterns = set(patterns)
+	if WHOLE_TREE_PATTERN in patterns:
+		return set()
+
+	res = set()
+	for pat in patterns:
+		p = localPath / pat.strip("/")
+		for ksy in walkKSYs(p) if pat.endswith("/") else ((p,) if p.is_file() else ()):
+			for spec in readKSYMeta(ksy).imports:
+				if spec[:1] == "/":
+					target = localPath / (spec[1:] + ".ksy")
+				else:
+					target = ksy.parent / (spec + ".ksy")
+				rel = os.path.relpath(str(target), str(localPath))
+				if rel.startswith(".."):
+					continue  # outside of the repo
+				importPattern = "/" + rel.replace(os.sep, "/")
+				if not isCoveredBySparsePatterns(importPattern, patterns):
+					res.add(importPattern)
+	return res
+
+
+def addCheckedOutImports(localPath: Path, patterns: typing.Set[str]) -> typing.Set[str]:
+	"""Adds the transitive imports found in the KSYs already checked out, so the patterns are rebuilt from the inputs, but the imports still needed are not removed from the working tree just to be checked out again"""
+	while True:
+		missing = findMissingImports(localPath, patterns)
+		if not missing:
+			return patterns
+		patterns |= missing
+
+
+def expandSparseCheckout(r: git.Repo, localPath: Path, patterns: typing.Set[str]) -> None:
+	"""Adds the transitive imports of the checked out KSYs to the sparse checkout, until nothing is missing"""
+	while True:
+		missing = findMissingImports(localPath, patterns)
+		if not missing:
+			return
+		patterns |= missing
+		writeSparsePatterns(r, patterns)
+		with span("git sparse checkout", "git"):
+			r.git.read_tree("-mu", "HEAD")
+
+
+def disableSparseCheckout(r: git.Repo) -> None:
+	"""Checks out the whole tree, if a sparse checkout has been enabled before, like `git sparse-checkout disable`. The repo stays a partial clone, the missing blobs are fetched by git."""
+	with r.config_reader() as c:
+		if not c.get_value("core", "sparseCheckout", False):
+			return
+
+	writeSparsePatterns(r, {WHOLE_TREE_PATTERN})
+	if r.head.is_valid():
+		with span("git sparse checkout", "git"):
+			r.git.read_tree("-mu", "HEAD")
+	with r.config_writer() as w:
+		w.set_value("core", "sparseCheckout", "false")
+	getSparseCheckoutFile(r).unlink()
+
+
+def upgradeLibrary(localPath: Path, gitUri: str, refspec: str = None, progressCallback=None, prefixPath: Path = None, ttl: float = 0, sparsePaths: typing.Optional[typing.Iterable[str]] = None):
+	"""Upgrades a library of Kaitai Struct formats. The network is used only when needed: tags and commits present locally are checked out as they are, the branches are resolved in the remote at most once per `ttl` seconds, and fetched only if the commit they point to is not present locally. If the remote is unreachable, the last known commit is used. The working tree is not touched if HEAD is already at the needed commit.
+
+	If `sparsePaths` (see `pathsIntoSparsePatterns`) are given, the repo is a partial clone and only these paths and the KSYs they import, transitively, are checked out. The patterns are rebuilt from them each time, so the paths no longer needed are removed from the working tree. If they are not given, a sparse checkout enabled before is disabled."""
 	if progressCallback is None:
 
 		def progressCallback(x):
@@ -45,31 +243,78 @@ def upgradeLibrary(localPath: Path, gitUri: str, refspec: str = None, progressCa
 	except BaseException:
 		remote = r.create_remote("origin", gitUri)
 
-	gargs = [r.remotes["origin"].name]
-	if not refspec:
-		refspec = getRemoteDefaultBranch(remote)
-
-	gargs.append(refspec)
-	r.git.checkout(refspec, B=True)
-
-	#def progressHandler(op_code, cur_count, max_count=None, message=''):
-	#	print(op_code, cur_count, max_count, message)
-	#	progressCallback(message)
+	if refspec is None:
+		refspec = ""
 
-	gkwargs = {
-		"depth": 1,
-		"force": True,
-		"update-shallow": True,
-		#"verify-signatures":True,
-		#"progress":progressHandler,
-		"verbose": True,
-	}
+	sparsePatterns = None
+	if sparsePaths is not None:
+		enablePartialClone(r, remote.name)
+		sparsePatterns = addCheckedOutImports(localPath, pathsIntoSparsePatterns(sparsePaths))
+	else:
+		disableSparseCheckout(r)
 
 	def pathToPrettyString(p: Path) -> str:
 		return str(p.relative_to(prefixPath) if prefixPath else p)
 
-	progressCallback(styles["operationName"](actName + "ing") + " " + styles["info"](gitUri) + " to " + styles["info"](pathToPrettyString(localPath)) + " ...")
-	r.remotes["origin"].fetch(*gargs[1:], **gkwargs)
-	r.head.reset(r.remotes["origin"].name + "/" + refspec, index=True, working_tree=True)
+	state = RemoteState(r.git_dir, gitUri)
+	ref = None
+	commit = resolvePinnedRefspec(r, refspec)
+	if commit is None:
+		rec = state.get(refspec, ttl)
+		if rec is None or resolveLocalCommit(r, rec["commit"]) is None:
+			try:
+				with span("git ls-remote", "git"):
+					ref, commit = lsRemote(remote, refspec)
+			except git.GitCommandError:
+				rec = state.refs.get(refspec, None)
+				if rec is None or resolveLocalCommit(r, rec["commit"]) is None:
+					raise
+				warnings.warn(gitUri + " is unreachable, using " + rec["commit"] + " having been fetched before")
+				ref, commit = rec["ref"], rec["commit"]
+		else:
+			ref, commit = rec["ref"], rec["commit"]
+
+		if commit is None or resolveLocalCommit(r, commit) is None:
+			#def progressHandler(op_code, cur_count, max_count=None, message=''):
+			#	print(op_code, cur_count, max_count, message)
+			#	progressCallback(message)
+
+			gkwargs = {
+				"depth": 1,
+				"force": True,
+				"update-shallow": True,
+				#"verify-signatures":True,
+				#"progress":progressHandler,
+				"verbose": True,
+			}
+
+			if ref is None:
+				fetchRefspec = refspec  # a commit
+			elif ref.startswith(TAGS_PREFIX):
+				fetchRefspec = ref + ":" + ref  # so next time it is present locally
+			else:
+				fetchRefspec = ref + ":refs/remotes/" + remote.name + "/" + ref[len(BRANCHES_PREFIX):]
+
+			progressCallback(styles["operationName"](actName + "ing") + " " + styles["info"](gitUri) + " to " + styles["info"](pathToPrettyString(localPath)) + " ...")
+			with span("git fetch", "git"):
+				remote.fetch(fetchRefspec, **gkwargs)
+			commit = r.git.rev_parse("FETCH_HEAD^{commit}")
+			progressCallback("\b" + styles["operationName"](actName + "ed"))
+
+		if ref is not None and ref.startswith(BRANCHES_PREFIX):
+			state.set(refspec, ref, commit)
+			state.save()
+
+	patternsChanged = sparsePatterns is not None and writeSparsePatterns(r, sparsePatterns)
+	if not (r.head.is_valid() and r.head.commit.hexsha == commit):
+		with span("git checkout", "git"):
+			if ref is not None and ref.startswith(BRANCHES_PREFIX):
+				r.git.checkout(commit, B=ref[len(BRANCHES_PREFIX):], force=True)
+			else:
+				r.git.checkout(commit, detach=True, force=True)
+	elif patternsChanged:
+		with span("git sparse checkout", "git"):
+			r.git.read_tree("-mu", "HEAD")
 
-	progressCallback("\b" + styles["operationName"](actName + "ed"))
+	if sparsePatterns is not None:
+		expandSparseCheckout(r, localPath, sparsePatterns)
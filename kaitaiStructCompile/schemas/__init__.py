@@ -1,19 +1,35 @@
-from pathlib import Path
-
-from ..utils import json
-
-thisDir = Path(__file__).parent
-schemasDir = thisDir / "schemas"
-with (schemasDir / "config.schema.json").open("rt", encoding="utf-8") as f:
-	schema = json.load(f)
-
-
-def isPath(val):
-	if isinstance(val, Path):
-		return True
-	elif isinstance(val, str):
-		try:
-			Path(val)
-		except BaseException:
-			return False
-	return False
+import typing
+from pathlib import Path
+
+from ..utils import json
+
+thisDir = Path(__file__).parent
+schemasDir = thisDir / "schemas"
+
+_schema = None
+
+
+def getSchema() -> dict:
+	"""Loads the config schema on first call"""
+	global _schema
+	if _schema is None:
+		with (schemasDir / "config.schema.json").open("rt", encoding="utf-8") as f:
+			_schema = json.load(f)
+	return _schema
+
+
+def __getattr__(name: str) -> typing.Any:
+	if name == "schema":
+		return getSchema()
+	raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+def isPath(val):
+	if isinstance(val, Path):
+		return True
+	elif isinstance(val, str):
+		try:
+			Path(val)
+		except BaseException:
+			return False
+	return False
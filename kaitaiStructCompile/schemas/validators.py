@@ -1,10 +1,80 @@
-import jsonschema
+import typing
+from pathlib import PurePath
 
-from . import isPath, schema
+from . import getSchema, isPath
 
-types = {"function": callable, "path": isPath}
-ValidatorT = jsonschema.validators._LATEST_VERSION
-ourTypeChecker = ValidatorT.TYPE_CHECKER.redefine_many(types)
-ValidatorT = jsonschema.validators.extend(ValidatorT, type_checker=ourTypeChecker)
-validator = ValidatorT(schema)
-flagsValidator = ValidatorT(schema["definitions"]["compilerFlags"])
+__all__ = ("getValidatorClass", "getValidator", "getFlagsValidator", "normalizeForHashing", "validateCfg")
+
+_validatorClass = None
+_validator = None
+_flagsValidator = None
+_validatedHashes = set()
+
+
+def getValidatorClass():
+	"""Imports `jsonschema` and builds our validator class on first call"""
+	global _validatorClass
+	if _validatorClass is None:
+		import jsonschema
+
+		types = {"function": callable, "path": isPath}
+		ValidatorT = jsonschema.validators._LATEST_VERSION
+		ourTypeChecker = ValidatorT.TYPE_CHECKER.redefine_many(types)
+		_validatorClass = jsonschema.validators.extend(ValidatorT, type_checker=ourTypeChecker)
+	return _validatorClass
+
+
+def getValidator():
+	global _validator
+	if _validator is None:
+		_validator = getValidatorClass()(getSchema())
+	return _validator
+
+
+def getFlagsValidator():
+	global _flagsValidator
+	if _flagsValidator is None:
+		_flagsValidator = getValidatorClass()(getSchema()["definitions"]["compilerFlags"])
+	return _flagsValidator
+
+
+def __getattr__(name: str) -> typing.Any:
+	if name == "validator":
+		return getValidator()
+	if name == "flagsValidator":
+		return getFlagsValidator()
+	raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+def normalizeForHashing(o: typing.Any) -> typing.Any:
+	"""Converts a config into a JSON-serializable form preserving everything the validation result depends on: the types of values too, since `"a"` and `PurePath("a")`, or a list and a tuple, are validated differently. Raises `TypeError` for the objects it cannot represent faithfully."""
+	if o is None or isinstance(o, (bool, int, float, str)):
+		return [type(o).__name__, o]
+	if isinstance(o, PurePath):
+		return ["path", str(o)]
+	# The order is kept as is: sorting costs more than an occasional miss for a reordered equal config
+	if isinstance(o, dict):
+		return ["dict", [[normalizeForHashing(k), normalizeForHashing(v)] for k, v in o.items()]]
+	if isinstance(o, (list, tuple, set, frozenset)):
+		return [type(o).__name__, [normalizeForHashing(el) for el in o]]
+	if callable(o):
+		return ["callable"]  # only callability is checked
+	raise TypeError("Cannot normalize " + repr(type(o)))
+
+
+def validateCfg(cfg: dict) -> None:
+	"""Validates a config against the schema. The configs already validated within this process are recognized by the hash of their normalized form and are not validated again."""
+	from ..cache import hashJSONable
+
+	try:
+		h = hashJSONable(normalizeForHashing(cfg))
+	except TypeError:
+		h = None
+
+	if h is not None and h in _validatedHashes:
+		return
+
+	getValidator().validate(cfg)
+
+	if h is not None:
+		_validatedHashes.add(h)
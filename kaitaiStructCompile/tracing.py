@@ -0,0 +1,170 @@
+"""Timed spans of the phases of a build and the messages for the user. Tracing is disabled by default, in this case `span` costs a function call and the messages are only passed to the listeners. Enabled with `KAITAI_STRUCT_COMPILE_TRACE` env variable or `tool.kaitai.trace`, both set to the path of the file to write the trace into. The trace is in Chrome trace event format, open it in `chrome://tracing` or https://ui.perfetto.dev ; a summary table is printed at the end of a build."""
+
+import os
+import threading
+import typing
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter_ns
+
+from .utils import ENV_PREFIX, json
+
+__all__ = ("Tracer", "NullTracer", "getTracer", "span", "message", "printMessage", "startTracing", "stopTracing", "getTraceFileFromEnv")
+
+
+def getTraceFileFromEnv() -> typing.Optional[Path]:
+	varName = ENV_PREFIX + "TRACE"
+	p = os.getenv(varName, default=None)
+	if p:
+		return Path(p)
+	return None
+
+
+def printMessage(ev: dict) -> None:
+	"""The default listener, prints the messages"""
+	if ev["ph"] == "i":
+		print(ev["args"]["message"])
+
+
+def makeMessageEvent(text: str, category: str, args: typing.Mapping[str, typing.Any]) -> dict:
+	"""An instant event (`"ph": "i"`) of the thread"""
+	ev = {"name": "message", "cat": category, "ph": "i", "s": "t", "ts": perf_counter_ns() / 1000, "pid": os.getpid(), "tid": threading.get_ident(), "args": {k: str(v) for k, v in args.items()}}
+	ev["args"]["message"] = text
+	return ev
+
+
+class NullTracer:
+	"""Used when tracing is disabled. Records nothing, but the messages are passed to the `listeners`."""
+
+	__slots__ = ("listeners",)
+
+	enabled = False
+
+	def __init__(self) -> None:
+		self.listeners = [printMessage]
+
+	@contextmanager
+	def span(self, name: str, category: str = "build", **args) -> typing.Iterator[None]:
+		yield
+
+	def addEvents(self, events: typing.Iterable[dict]) -> None:
+		pass
+
+	def message(self, text: str, category: str = "build", **args) -> None:
+		ev = makeMessageEvent(text, category, args)
+		for l in self.listeners:
+			l(ev)
+
+
+class Tracer:
+	"""Records complete events (`"ph": "X"`) of the spans and instant ones (`"ph": "i"`) of the messages. Thread-safe, the batches are compiled in threads. Timestamps are from the monotonic clock shared by the processes, so the events recorded in worker processes can be merged as they are. `listeners` are called with each event as soon as it is recorded."""
+
+	__slots__ = ("events", "listeners", "lock", "pid")
+
+	enabled = True
+
+	def __init__(self, listeners: typing.Optional[typing.List[typing.Callable[[dict], None]]] = None) -> None:
+		self.events = []
+		self.listeners = listeners if listeners is not None else [printMessage]
+		self.lock = threading.Lock()
+		self.pid = os.getpid()
+
+	@contextmanager
+	def span(self, name: str, category: str = "build", **args) -> typing.Iterator[None]:
+		start = perf_counter_ns()
+		try:
+			yield
+		finally:
+			end = perf_counter_ns()
+			ev = {"name": name, "cat": category, "ph": "X", "ts": start / 1000, "dur": (end - start) / 1000, "pid": self.pid, "tid": threading.get_ident()}
+			if args:
+				ev["args"] = {k: str(v) for k, v in args.items()}
+			self.addEvents((ev,))
+
+	def addEvents(self, events: typing.Iterable[dict]) -> None:
+		events = list(events)
+		with self.lock:
+			self.events.extend(events)
+		for l in self.listeners:
+			for ev in events:
+				l(ev)
+
+	def message(self, text: str, category: str = "build", **args) -> None:
+		self.addEvents((makeMessageEvent(text, category, args),))
+
+	def toChromeTrace(self) -> dict:
+		with self.lock:
+			events = sorted(self.events, key=lambda ev: (ev["ts"], -ev.get("dur", 0)))
+		return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+	def save(self, path: Path) -> None:
+		path = Path(path)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		with path.open("wt", encoding="utf-8") as f:
+			f.write(json.dumps(self.toChromeTrace()))
+
+	def summarize(self) -> typing.List[typing.Tuple[str, int, float, float]]:
+		"""`(name, count, total s, max s)` for each span name, the most time-consuming first. Nested spans are counted in their parents too."""
+		stats = defaultdict(lambda: [0, 0.0, 0.0])
+		with self.lock:
+			for ev in self.events:
+				if ev["ph"] != "X":
+					continue
+				s = stats[ev["name"]]
+				s[0] += 1
+				s[1] += ev["dur"] / 1e6
+				s[2] = max(s[2], ev["dur"] / 1e6)
+		return sorted(((k, c, t, m) for k, (c, t, m) in stats.items()), key=lambda r: -r[2])
+
+	def summaryTable(self) -> str:
+		rows = [("span", "count", "total, s", "max, s")]
+		rows.extend((name, str(count), format(total, ".3f"), format(maxDur, ".3f")) for name, count, total, maxDur in self.summarize())
+		widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+		return "\n".join("  ".join((c.ljust(w) if i == 0 else c.rjust(w)) for i, (c, w) in enumerate(zip(r, widths))) for r in rows)
+
+
+NULL_TRACER = NullTracer()
+_tracer = NULL_TRACER
+
+
+def getTracer() -> typing.Union[Tracer, NullTracer]:
+	return _tracer
+
+
+def span(name: str, category: str = "build", **args) -> typing.ContextManager[None]:
+	"""A span of the current tracer"""
+	return _tracer.span(name, category, **args)
+
+
+def message(text: str, category: str = "build", **args) -> None:
+	"""A message for the user, passed to the listeners of the current tracer (printed by default) and recorded if tracing is enabled"""
+	_tracer.message(text, category, **args)
+
+
+def startTracing() -> Tracer:
+	"""Makes a new tracer current, unless one is already. Returns the current one. The new one gets the listeners of the disabled one. A tracer inherited by a forked worker process is replaced, it belongs to the parent."""
+	global _tracer
+	if not _tracer.enabled:
+		_tracer = Tracer(_tracer.listeners)
+	elif _tracer.pid != os.getpid():
+		_tracer = Tracer()
+	return _tracer
+
+
+def stopTracing() -> typing.Union[Tracer, NullTracer]:
+	"""Disables tracing, returns the tracer having been current"""
+	global _tracer
+	res = _tracer
+	_tracer = NULL_TRACER
+	return res
+
+
+def _resetInForkedChild() -> None:
+	"""The tracer of the parent (and maybe its held lock) must not be used by the forked workers, they start own ones if asked"""
+	global _tracer
+	_tracer = NULL_TRACER
+
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=_resetInForkedChild)
@@ -44,11 +44,57 @@ def getForcedBackendFromEnv() -> str:
 	return os.getenv(varName, default="")
 
 
+def getBackendRankingFromEnv() -> str:
+	varName = ENV_PREFIX + "BACKEND_RANKING"
+	return os.getenv(varName, default="")
+
+
 def getAdditionalBackendEntryPointSources() -> str:
 	varName = ENV_PREFIX + "ADDITIONAL_BACKEND_ENTRY_POINTS"
 	return os.getenv(varName, default="").splitlines()
 
 
+def getDaemonSocketPath() -> Path:
+	"""`$XDG_RUNTIME_DIR` is preferred, it is private to the user. The fallback dir in the temp dir is checked by the daemon to be owned by the user and not accessible by others."""
+	varName = ENV_PREFIX + "DAEMON_SOCKET"
+	p = os.getenv(varName, default=None)
+	if p:
+		return Path(p)
+
+	p = os.getenv("XDG_RUNTIME_DIR", default=None)
+	if p:
+		return Path(p) / "kaitaiStructCompile" / "daemon.sock"
+
+	import tempfile
+
+	return Path(tempfile.gettempdir()) / ("kaitaiStructCompile-" + str(os.getuid())) / "daemon.sock"
+
+
+def getDaemonIdleTimeoutFromEnv() -> float:
+	varName = ENV_PREFIX + "DAEMON_IDLE_TIMEOUT"
+	return float(os.getenv(varName, default="600"))
+
+
+def getDaemonBackendFromEnv() -> str:
+	varName = ENV_PREFIX + "DAEMON_BACKEND"
+	return os.getenv(varName, default="")
+
+
+def getUserCacheDir() -> Path:
+	"""Returns the dir where we keep our caches shared between projects. Can be overridden with `KAITAI_STRUCT_COMPILE_CACHE_DIR` env variable."""
+	varName = ENV_PREFIX + "CACHE_DIR"
+	p = os.getenv(varName, default=None)
+	if p:
+		return Path(p)
+
+	p = os.getenv("XDG_CACHE_HOME", default=None)
+	if p:
+		p = Path(p)
+	else:
+		p = Path.home() / ".cache"
+	return p / "kaitaiStructCompile"
+
+
 class KSCDirs:
 	def __init__(self, subDirsNames: typing.Dict[str, str], root=None) -> None:
 		if root is None:
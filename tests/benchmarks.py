@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""Performance measurements. The timings are recorded and reported, not asserted, since they depend on the machine; only the deterministic things, like counts of invocations, are checked."""
+
+import os
+import subprocess
+import sys
+import typing
+import unittest
+from contextlib import ExitStack
+from pathlib import Path
+
+testsDir = Path(__file__).parent.absolute()
+parentDir = testsDir.parent.absolute()
+
+sys.path.insert(0, str(testsDir))
+import standInBackend
+import standInFixtures
+
+
+def getSetting(name: str, default: float) -> float:
+	return float(os.environ.get("KAITAI_STRUCT_COMPILE_BENCHMARK_" + name, default))
+
+
+results = {}
+
+
+def recordResult(name: str, **metrics: float) -> None:
+	"""The results are saved into the file set in `KAITAI_STRUCT_COMPILE_BENCHMARK_RESULTS` env variable, to be compared between commits with `python benchmarks.py compare old.json new.json`"""
+	results[name] = metrics
+
+
+def getCommit() -> typing.Optional[str]:
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=str(parentDir), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+moduleFixtures = ExitStack()
+
+
+def setUpModule() -> None:
+	"""The stand-in backend is registered and the caches shared between projects are kept in a temp dir only while the benchmarks run"""
+	moduleFixtures.enter_context(standInFixtures.standInEnv())
+
+
+def tearDownModule() -> None:
+	moduleFixtures.close()
+
+	resultsFile = os.environ.get("KAITAI_STRUCT_COMPILE_BENCHMARK_RESULTS", None)
+	if not resultsFile or not results:
+		return
+
+	import json
+	import platform
+	import time
+
+	with open(resultsFile, "wt", encoding="utf-8") as f:
+		json.dump({"commit": getCommit(), "python": platform.python_version(), "platform": platform.platform(), "time": time.time(), "results": results}, f, indent="\t", sort_keys=True)
+
+
+def compareResults(oldFile: Path, newFile: Path) -> typing.List[typing.Tuple[str, str, float, float]]:
+	"""`(benchmark, metric, old, new)` for the metrics present in both files"""
+	import json
+
+	with open(oldFile, "rt", encoding="utf-8") as f:
+		old = json.load(f)["results"]
+	with open(newFile, "rt", encoding="utf-8") as f:
+		new = json.load(f)["results"]
+	return [(name, metric, v, new[name][metric]) for name, metrics in sorted(old.items()) if name in new for metric, v in sorted(metrics.items()) if metric in new[name]]
+
+
+def runPython(code: str, *args: str) -> subprocess.CompletedProcess:
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join(el for el in (str(parentDir), env.get("PYTHONPATH", "")) if el)
+	return subprocess.run([sys.executable, *args, "-c", code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def parseImportTime(log: str) -> dict:
+	"""Parses `python -X importtime` output into `{module: (self µs, cumulative µs)}`"""
+	res = {}
+	for l in log.splitlines():
+		if not l.startswith("import time:"):
+			continue
+		selfTime, cumulative, name = l[len("import time:"):].split("|")
+		try:
+			res[name.strip()] = (int(selfTime), int(cumulative))
+		except ValueError:
+			pass  # the header
+	return res
+
+
+def makeLargeCfg(root: Path, formatsCount: int) -> dict:
+	return {
+		"prefixPath": root,
+		"repos": {
+			"local": {
+				"local": {
+					"localPath": root / "formats",
+					"outputDir": root / "output",
+					"formats": {root / "output" / ("f" + str(i) + ".py"): {"path": root / "formats" / ("f" + str(i) + ".ksy"), "flags": {"additionalFlags": ["--read-pos"]}} for i in range(formatsCount)},
+				}
+			}
+		},
+	}
+
+
+class TestCfgPreparation(unittest.TestCase):
+	FORMATS_COUNT = 2000
+
+	def testPreparationOfLargeCfg(self):
+		from time import perf_counter
+
+		from kaitaiStructCompile.buildSystemPlugins.common import prepareCfg
+
+		root = Path("/nonexistent")
+		durations = []
+		for i in range(3):
+			cfg = makeLargeCfg(root, self.__class__.FORMATS_COUNT)
+			start = perf_counter()
+			prepareCfg(cfg)
+			durations.append(perf_counter() - start)
+
+		cold, warm = durations[0], min(durations[1:])
+		recordResult("prepareCfg", coldSeconds=cold, warmSeconds=warm)
+		print("prepareCfg of", self.__class__.FORMATS_COUNT, "formats: cold", cold, "s, warm", warm, "s")
+
+
+def generateLargeModule(typesCount: int) -> str:
+	"""Resembles the modules generated by KSC: nested types with enums and fields resolving them"""
+	res = ["from enum import Enum", "import kaitaistruct", "from kaitaistruct import KaitaiStruct, KaitaiStream, BytesIO", "", "", "class Root(KaitaiStruct):"]
+	for i in range(typesCount):
+		res.extend((
+			"    class Kind" + str(i) + "(Enum):",
+			"        a = 0",
+			"        b = 1",
+			"",
+			"    class Type" + str(i) + "(KaitaiStruct):",
+			"        def _read(self):",
+			"            self.kind = KaitaiStream.resolve_enum(Root.Kind" + str(i) + ", self._io.read_u1())",
+			"            self.name = (self._io.read_bytes_term(0, False, True, True)).decode(u\"utf-8\")",
+			"            if self.kind.value == Root.Kind" + str(i) + ".a.value:",
+			"                self.payload = self._io.read_u4le()",
+			"",
+		))
+	return "\n".join(res)
+
+
+class TestPostprocessing(unittest.TestCase):
+	TYPES_COUNT = 500
+
+	def testFixEnumsOnManyEnums(self):
+		import ast
+		from time import perf_counter
+
+		from kaitaiStructCompile.postprocessors import fixEnums
+
+		tree = ast.parse(generateLargeModule(self.__class__.TYPES_COUNT))
+		start = perf_counter()
+		res = ast.unparse(fixEnums.transformTree(tree, "<large>"))
+		duration = perf_counter() - start
+
+		recordResult("fixEnums", seconds=duration)
+		print("fixEnums of", self.__class__.TYPES_COUNT, "enums:", duration, "s")
+		self.assertNotIn(".value", res)
+		self.assertEqual(res.count("(IntEnum)"), self.__class__.TYPES_COUNT)
+
+	def testFixEnumsSplicedVsUnparse(self):
+		from time import perf_counter
+
+		from kaitaiStructCompile.postprocessors import fixEnums, fixEnumsSpliced
+
+		text = generateLargeModule(self.__class__.TYPES_COUNT)
+		throughputs = {}
+		for postprocessor in (fixEnums, fixEnumsSpliced):
+			durations = []
+			for i in range(3):
+				start = perf_counter()
+				res = postprocessor(text, "<large>")
+				durations.append(perf_counter() - start)
+			throughputs[postprocessor.__name__] = len(text) / min(durations) / 2**20
+			self.assertNotIn(".value", res)
+			self.assertEqual(res.count("(IntEnum)"), self.__class__.TYPES_COUNT)
+
+		recordResult("fixEnumsThroughput", **{k + "MiBPerS": v for k, v in throughputs.items()})
+		print("fixEnums throughput, MiB/s:", ", ".join(k + ": " + format(v, ".2f") for k, v in throughputs.items()))
+
+	def testASTPostprocessorsShareTree(self):
+		import ast
+		from time import perf_counter
+		from unittest.mock import patch
+
+		from kaitaiStructCompile.postprocessors import astPostprocessor, fixEnums, permissiveDecoding, runPostprocessingChain
+
+		@astPostprocessor
+		def keepTree(tree, fileName):
+			return tree
+
+		tasks = [(fixEnums, ()), (permissiveDecoding, ()), (keepTree, ())]
+		text = generateLargeModule(self.__class__.TYPES_COUNT)
+
+		with patch.object(ast, "parse", wraps=ast.parse) as parse:
+			start = perf_counter()
+			separately = text
+			for postprocessor, args in tasks:
+				separately = postprocessor(separately, "<large>", *args)
+			separatelyDuration = perf_counter() - start
+			separatelyParses = parse.call_count
+
+			parse.reset_mock()
+			start = perf_counter()
+			chained = runPostprocessingChain(text, "<large>", tasks)
+			chainedDuration = perf_counter() - start
+			chainedParses = parse.call_count
+
+		recordResult("postprocessingChain", separatelySeconds=separatelyDuration, chainedSeconds=chainedDuration)
+		print("postprocessing of", len(text), "chars: separately", separatelyDuration, "s, chained", chainedDuration, "s")
+		self.assertEqual(ast.dump(ast.parse(chained)), ast.dump(ast.parse(separately)))
+		self.assertEqual((separatelyParses, chainedParses), (2, 1))  # `permissiveDecoding` is a text postprocessor
+
+
+class TestCompileModes(unittest.TestCase):
+	KSYS_COUNT = 300
+
+	def testInMemoryVsOnDisk(self):
+		from tempfile import TemporaryDirectory
+		from time import perf_counter
+
+		from kaitaiStructCompile import compile
+		from kaitaiStructCompile.backendSelector import selectAndInitializeBackend
+
+		backend = selectAndInitializeBackend(tolerableIssues={"standIn"}, forcedBackend="standIn")
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			ksys = []
+			for i in range(self.__class__.KSYS_COUNT):
+				p = d / ("f" + str(i) + ".ksy")
+				p.write_text("meta:\n  id: f" + str(i) + "\nseq:\n  - id: a\n    type: u1\n")
+				ksys.append(p)
+			outDir = d / "output"
+			outDir.mkdir()
+
+			durations = {}
+			for mode, kwargs in (("on disk", {"outputDir": outDir}), ("in memory", {})):
+				runs = []
+				for i in range(3):
+					start = perf_counter()
+					texts = [r.getText() for r in compile(ksys, backend=backend, **kwargs).values()]  # the pipeline needs the texts in both modes
+					runs.append(perf_counter() - start)
+				self.assertEqual(len(texts), self.__class__.KSYS_COUNT)
+				durations[mode] = min(runs)
+
+			self.assertEqual(len(list(outDir.iterdir())), self.__class__.KSYS_COUNT)  # only the on-disk runs have written there
+			recordResult("compileModes", onDiskSeconds=durations["on disk"], inMemorySeconds=durations["in memory"])
+			print("compile of", self.__class__.KSYS_COUNT, "KSYs:", ", ".join(k + ": " + format(v, ".4f") + " s" for k, v in durations.items()))
+
+
+def generateKSYCorpus(root: Path, count: int, importDepth: int = 2, enumsCount: int = 2, groupSize: int = 50) -> typing.List[Path]:
+	"""Writes `count` KSYs into `groupSize`-sized subdirs of `root`. They form chains of imports `importDepth` long within a subdir, each KSY has `enumsCount` enums. Returns the paths in the order of creation."""
+	res = []
+	for i in range(count):
+		d = root / ("g" + str(i // groupSize))
+		d.mkdir(parents=True, exist_ok=True)
+		lines = ["meta:", "  id: f" + str(i)]
+		if importDepth and i % (importDepth + 1) and i % groupSize:
+			lines.extend(("  imports:", "    - f" + str(i - 1)))
+		lines.extend(("seq:", "  - id: magic", "    size: 4"))
+		if enumsCount:
+			lines.append("enums:")
+			for j in range(enumsCount):
+				lines.extend(("  kind_" + str(j) + ":", "    0: a", "    1: b"))
+		p = d / ("f" + str(i) + ".ksy")
+		p.write_text("\n".join(lines) + "\n", encoding="utf-8")
+		res.append(p)
+	return res
+
+
+def makeCorpusCfg(root: Path, **kwargs) -> dict:
+	"""Each run compiles and postprocesses everything"""
+	return standInFixtures.makeStandInCfg(root, **dict({"incremental": False, "cache": {"enabled": False}, "postprocessingCache": {"enabled": False}}, **kwargs))
+
+
+def timeBest(func: typing.Callable[[], typing.Any], repeats: int = 3) -> float:
+	from time import perf_counter
+
+	durations = []
+	for i in range(repeats):
+		start = perf_counter()
+		func()
+		durations.append(perf_counter() - start)
+	return min(durations)
+
+
+class TestCorpusPipeline(unittest.TestCase):
+	"""The phases of the pipeline on a synthetic corpus compiled by the stand-in backend. Sizes can be changed with `KAITAI_STRUCT_COMPILE_BENCHMARK_CORPUS_*` env variables."""
+
+	@classmethod
+	def setUpClass(cls) -> None:
+		from tempfile import TemporaryDirectory
+
+		cls.tempDir = TemporaryDirectory()
+		cls.root = Path(cls.tempDir.name)
+		cls.count = int(getSetting("CORPUS_SIZE", 300))
+		cls.ksys = generateKSYCorpus(cls.root / "formats", cls.count, int(getSetting("CORPUS_IMPORT_DEPTH", 2)), int(getSetting("CORPUS_ENUMS", 4)))
+
+	@classmethod
+	def tearDownClass(cls) -> None:
+		cls.tempDir.cleanup()
+
+	def transpile(self, **kwargs) -> list:
+		from kaitaiStructCompile.buildSystemPlugins.common import doTranspilationWithCfgPopulatePathWithCWD
+
+		return doTranspilationWithCfgPopulatePathWithCWD(makeCorpusCfg(self.__class__.root, **kwargs))
+
+	def testScanForKsys(self):
+		from kaitaiStructCompile.buildSystemPlugins.common import prepareCfg, scanForKsys
+		from kaitaiStructCompile.ksyScanner import KSYDirsIndex
+
+		cfg = makeCorpusCfg(self.__class__.root)
+		prepareCfg(cfg)
+		refspecCfg = cfg["repos"]["local"]["local"]
+		index = KSYDirsIndex()
+
+		def scan(index: typing.Optional[KSYDirsIndex]) -> None:
+			refspecCfg["formats"] = {}
+			scanForKsys(refspecCfg, index)
+			self.assertEqual(len(refspecCfg["formats"]), self.__class__.count)
+
+		# freshly created dirs are within the racy interval and would not be indexed
+		old = os.stat(str(self.__class__.root)).st_mtime - 3600
+		for d, subDirs, files in os.walk(str(self.__class__.root / "formats")):
+			os.utime(d, (old, old))
+
+		cold = timeBest(lambda: scan(None))
+		scan(index)
+		warm = timeBest(lambda: scan(index))
+		self.assertEqual(index.listed, len(index.dirs))
+		recordResult("corpus.scanForKsys", coldSeconds=cold, indexedSeconds=warm)
+		print("scanForKsys of", self.__class__.count, "KSYs: without index", cold, "s, with index", warm, "s")
+
+	def testCompileDispatch(self):
+		from kaitaiStructCompile import backendSelector
+
+		backendSelector.clearSelectedBackendsCache()
+		sequential = timeBest(lambda: self.transpile(jobs=1), 2)
+		parallel = timeBest(lambda: self.transpile(jobs=4, postprocessingJobs=1), 2)
+		del standInBackend.invocations[:]
+		emitted = self.transpile(jobs=1)
+		self.assertGreaterEqual(len(emitted), self.__class__.count)  # imported modules are emitted too
+		self.assertEqual([len(batch) for batch in standInBackend.invocations], [self.__class__.count])  # all the targets share the flags, so are compiled by a single invocation
+		recordResult("corpus.compileDispatch", sequentialSeconds=sequential, parallelSeconds=parallel)
+		print("Full build of", self.__class__.count, "KSYs with the stand-in backend: jobs=1", sequential, "s, jobs=4", parallel, "s")
+
+	def testPostprocessors(self):
+		import difflib
+
+		from kaitaiStructCompile.postprocessors import postprocessors
+
+		texts = [standInBackend.generateModule(p.stem, (), p.read_text(encoding="utf-8")) for p in self.__class__.ksys]
+		size = sum(len(t) for t in texts) / 2**20
+
+		patchFile = self.__class__.root / "all.patch"
+		with patchFile.open("wt", encoding="utf-8") as f:
+			for p, t in zip(self.__class__.ksys, texts):
+				f.write("".join(difflib.unified_diff(t.splitlines(True), t.replace("        self._read()\n", "        self._read()\n        self.patched = True\n").splitlines(True), "a/" + p.stem + ".py", "b/" + p.stem + ".py")))
+
+		metrics = {}
+		for name, postprocessor in sorted(postprocessors.items()):
+			args = (str(patchFile),) if name == "applyPatches" else ()
+
+			def run() -> None:
+				for p, t in zip(self.__class__.ksys, texts):
+					postprocessor(t, p.stem + ".py", *args)
+
+			metrics[name + "MiBPerS"] = size / timeBest(run)
+		recordResult("corpus.postprocessors", **metrics)
+		print("Postprocessors throughput, MiB/s:", ", ".join(k + ": " + format(v, ".2f") for k, v in metrics.items()))
+
+	def testOutputWriting(self):
+		import shutil
+
+		from kaitaiStructCompile.cache import writeIfChanged
+
+		texts = [(self.__class__.root / "written" / (p.stem + ".py"), standInBackend.generateModule(p.stem, (), p.read_text(encoding="utf-8")).encode("utf-8")) for p in self.__class__.ksys]
+
+		def writeAll() -> int:
+			return sum(writeIfChanged(p, data) for p, data in texts)
+
+		def writeFresh() -> None:
+			shutil.rmtree(str(self.__class__.root / "written"), ignore_errors=True)
+			self.assertEqual(writeAll(), len(texts))
+
+		fresh = timeBest(writeFresh)
+		unchanged = timeBest(lambda: self.assertEqual(writeAll(), 0))
+		recordResult("corpus.outputWriting", freshSeconds=fresh, unchangedSeconds=unchanged)
+		print("Writing", len(texts), "outputs: fresh", fresh, "s, unchanged", unchanged, "s")
+
+
+class TestImportTime(unittest.TestCase):
+	EXPENSIVE_MODULES = ("kaitaiStructCompile.backendSelector", "importlib.metadata", "jsonschema")
+
+	def testImportIsLazy(self):
+		loaded = runPython("import sys, kaitaiStructCompile; print('\\n'.join(sys.modules))").stdout.splitlines()
+		for m in self.__class__.EXPENSIVE_MODULES:
+			self.assertNotIn(m, loaded)
+
+	def testImportTime(self):
+		best = min(parseImportTime(runPython("import kaitaiStructCompile", "-X", "importtime").stderr)["kaitaiStructCompile"][1] for i in range(5))
+		budget = getSetting("IMPORT_TIME_US", 75000)
+		recordResult("importTime", microseconds=best)
+		print("import kaitaiStructCompile:", best, "µs, budget:", budget, "µs")
+		self.assertLess(best, budget)  # generous, since the import must stay free of backend discovery
+
+
+def main() -> None:
+	if len(sys.argv) == 4 and sys.argv[1] == "compare":
+		for name, metric, old, new in compareResults(Path(sys.argv[2]), Path(sys.argv[3])):
+			print(name, metric, old, "->", new, "(" + format(new / old if old else float("inf"), ".2f") + "x)")
+	else:
+		unittest.main()
+
+
+if __name__ == "__main__":
+	main()
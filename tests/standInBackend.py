@@ -0,0 +1,143 @@
+"""A stand-in for a real backend. Doesn't need a Kaitai Struct compiler, emits deterministic python from `meta` and `enums` of KSYs. Register it with
+`KAITAI_STRUCT_COMPILE_ADDITIONAL_BACKEND_ENTRY_POINTS='standIn@{"issues": ["standIn"]} = standInBackend:init'`."""
+
+import os
+import typing
+from pathlib import Path
+from time import perf_counter
+
+ENTRY_POINT_LINE = 'standIn@{"issues": ["standIn"]} = standInBackend:init'
+
+invocations = []
+afterSource = None  # called by `compileIter_` with the path of each source, after all its events have been consumed
+
+
+def parseEnums(ksyText: str) -> typing.Dict[str, typing.List[typing.Tuple[int, str]]]:
+	"""Only the block style of the top-level `enums`, which is what the synthetic corpora use"""
+	res = {}
+	inEnums = False
+	current = None
+	for l in ksyText.splitlines():
+		if not l.strip():
+			continue
+		indent = len(l) - len(l.lstrip())
+		if indent == 0:
+			inEnums = l.strip() == "enums:"
+		elif inEnums:
+			k, v = (el.strip() for el in l.split(":", 1))
+			if indent == 2:
+				res[k] = current = []
+			else:
+				current.append((int(k), v))
+	return res
+
+
+def generateModule(moduleName: str, imports, ksyText: str) -> str:
+	from kaitaiStructCompile.utils import transformName
+
+	className = transformName(moduleName, isClass=True)
+	enums = parseEnums(ksyText)
+	res = [
+		"# This is a generated file! Please edit source .ksy file and use kaitai-struct-compiler to rebuild",
+		"",
+		"import kaitaistruct",
+		"from kaitaistruct import KaitaiStruct, KaitaiStream, BytesIO",
+	]
+	if enums:
+		res.append("from enum import Enum")
+	for imp in imports:
+		res.append("import " + imp.rsplit("/", 1)[-1])
+	res.extend((
+		"",
+		"",
+		"class " + className + "(KaitaiStruct):",
+		"    SOURCE_LENGTH = " + str(len(ksyText)),
+		"",
+	))
+	for enumName, items in enums.items():
+		res.append("    class " + transformName(enumName, isClass=True) + "(Enum):")
+		res.extend("        " + name + " = " + str(value) for value, name in items)
+		res.append("")
+	res.extend((
+		"    def __init__(self, _io, _parent=None, _root=None):",
+		"        self._io = _io",
+		"        self._parent = _parent",
+		"        self._root = _root if _root else self",
+		"        self._read()",
+		"",
+		"    def _read(self):",
+		"        self.magic = self._io.read_bytes(4)",
+	))
+	for enumName, items in enums.items():
+		enumPath = className + "." + transformName(enumName, isClass=True)
+		res.extend((
+			"        self." + enumName + " = KaitaiStream.resolve_enum(" + enumPath + ", self._io.read_u1())",
+			"        if self." + enumName + ".value == " + enumPath + "." + items[0][1] + ".value:",
+			"            self." + enumName + "_name = (self._io.read_bytes_term(0, False, True, True)).decode(u\"utf-8\")",
+		))
+	res.append("")
+	return "\n".join(res)
+
+
+def markPostprocessed(fileText: str, fileName) -> str:
+	"""A postprocessor registered by its dotted name in the tests"""
+	return fileText + "# postprocessed\n"
+
+
+def appendPid(fileText: str, fileName) -> str:
+	return fileText + str(os.getpid())
+
+
+def init(ICompilerModule, KaitaiCompilerException, utils, defaults):
+	from kaitaiStructCompile.ksyImports import iterTransitiveImports, readKSYMeta
+
+	class StandInCompiler(ICompilerModule.ICompiler):
+		__slots__ = ()
+
+		inProcess = True
+
+		def __init__(self, progressCallback=None, dirs=None, namespaces=None, additionalFlags=(), importPath=None, **kwargs):
+			super().__init__(progressCallback=progressCallback, dirs=dirs if dirs is not None else ".", namespaces=namespaces, importPath=importPath)
+
+		def iterResults(self, sourceFilesAbsPaths, destDir, needInMemory):
+			"""Generates the modules one by one, each right after the source importing it first, yields them with the phases of compilation of the sources"""
+			sourceFilesAbsPaths = list(sourceFilesAbsPaths)
+			invocations.append(sourceFilesAbsPaths)
+			importPaths = (self.importPath,) if self.importPath else ()
+
+			generated = set()
+			for src in sourceFilesAbsPaths:
+				yield src, ICompilerModule.CompilePhase.started, None
+				toCompile = {src: None}
+				for importer, spec, resolved in iterTransitiveImports(src, importPaths):
+					if resolved is not None:
+						toCompile[resolved] = None
+
+				for p in toCompile:
+					if p in generated:
+						continue
+					generated.add(p)
+					meta = readKSYMeta(p)
+					moduleName = meta.id if meta.id else p.stem
+					text = generateModule(moduleName, meta.imports, p.read_text(encoding="utf-8"))
+					mainClassName = utils.transformName(moduleName, isClass=True)
+					if needInMemory:
+						yield src, ICompilerModule.CompilePhase.result, ICompilerModule.InMemoryCompileResult(moduleName, mainClassName, "", text)
+					else:
+						resPath = Path(destDir) / (moduleName + ".py")
+						resPath.write_text(text, encoding="utf-8")
+						yield src, ICompilerModule.CompilePhase.result, ICompilerModule.InFileCompileResult(moduleName, mainClassName, "", resPath)
+				yield src, ICompilerModule.CompilePhase.finished, None
+
+		def compile_(self, sourceFilesAbsPaths, destDir, additionalFlags, needInMemory, target, verbose, opaqueTypes, autoRead, readStoresPos):
+			return {r.moduleName: r for src, phase, r in self.iterResults(sourceFilesAbsPaths, destDir, needInMemory) if r is not None}
+
+		def compileIter_(self, sourceFilesAbsPaths, destDir, additionalFlags, needInMemory, target, verbose, opaqueTypes, autoRead, readStoresPos):
+			"""Streams the results of a single invocation, as an in-process backend would"""
+			start = perf_counter()
+			for src, phase, r in self.iterResults(sourceFilesAbsPaths, destDir, needInMemory):
+				yield ICompilerModule.CompileProgressEvent(src, phase, perf_counter() - start, r)
+				if phase == ICompilerModule.CompilePhase.finished and afterSource is not None:
+					afterSource(src)
+
+	return StandInCompiler
@@ -0,0 +1,46 @@
+"""The fixtures shared by the tests and the benchmarks building with the stand-in backend from `standInBackend`"""
+
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import standInBackend
+
+
+@contextmanager
+def standInEnv():
+	"""Registers the stand-in backend and keeps the caches shared between projects in a temp dir instead of the user's one"""
+	from unittest.mock import patch
+
+	with TemporaryDirectory() as cacheDir, patch.dict(os.environ, {
+		"KAITAI_STRUCT_COMPILE_ADDITIONAL_BACKEND_ENTRY_POINTS": standInBackend.ENTRY_POINT_LINE,
+		"KAITAI_STRUCT_COMPILE_CACHE_DIR": cacheDir,
+	}):
+		yield
+
+
+def makeStandInCfg(root: Path, **kwargs) -> dict:
+	"""A config of a project in `root` compiling all the KSYs found in `root / "formats"` by the stand-in backend. The caches and the state are kept in `root` too."""
+	inDir = root / "formats"
+	cfg = {
+		"prefixPath": root,
+		"forceBackend": "standIn",
+		"tolerableIssues": ["standIn"],
+		"cache": {"dir": root / "cache"},
+		"postprocessingCache": {"dir": root / "postprocessingCache"},
+		"stateDir": root / "state",
+		"repos": {
+			"local": {
+				"local": {
+					"localPath": inDir,
+					"inputDir": inDir,
+					"outputDir": root / "output",
+					"search": True,
+					"formats": {},
+				}
+			}
+		},
+	}
+	cfg.update(kwargs)
+	return cfg
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
+import os
 import sys
 import unittest
 from collections import OrderedDict
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
 
 testsDir = Path(__file__).parent.absolute()
@@ -10,6 +12,66 @@ parentDir = testsDir.parent.absolute()
 
 inputDir = testsDir / "ksys"
 
+sys.path.insert(0, str(testsDir))
+import standInBackend
+import standInFixtures
+
+testKSYs = {
+	"a.ksy": "meta:\n  id: a\n  imports:\n    - b\nseq:\n  - id: test\n    type: b\n",
+	"b.ksy": "meta:\n  id: b\nseq:\n  - id: test\n    type: strz\n    encoding: utf-8\n",
+	"c.ksy": "meta:\n  id: c\n  imports: [sub/d]\nseq:\n  - id: test\n    type: d\n",
+	"sub/d.ksy": "meta:\n  id: d\nseq:\n  - id: test\n    type: u1\n",
+}
+
+
+def makeKSYTree(root: Path) -> Path:
+	inDir = root / "formats"
+	for name, text in testKSYs.items():
+		p = inDir / name
+		p.parent.mkdir(parents=True, exist_ok=True)
+		if not p.is_file() or p.read_text(encoding="utf-8") != text:
+			p.write_text(text, encoding="utf-8")
+	return inDir
+
+
+def getUmask() -> int:
+	umask = os.umask(0)
+	os.umask(umask)
+	return umask
+
+
+def makeStandInCfg(root: Path, **kwargs) -> dict:
+	makeKSYTree(root)
+	return standInFixtures.makeStandInCfg(root, **kwargs)
+
+
+def transpileWithStandIn(cfg: dict):
+	from kaitaiStructCompile.buildSystemPlugins.common import doTranspilationWithCfgPopulatePathWithCWD
+
+	del standInBackend.invocations[:]
+	return doTranspilationWithCfgPopulatePathWithCWD(cfg)
+
+
+class StandInTestCase(unittest.TestCase):
+	"""Registers the stand-in backend and keeps the caches shared between projects in a temp dir instead of the user's one, both only for the duration of a test. Used by the tests of the features built on top of the baseline, the baseline `Test` runs as is."""
+
+	def setUp(self) -> None:
+		env = standInFixtures.standInEnv()
+		env.__enter__()
+		self.addCleanup(env.__exit__, None, None, None)
+
+		self.forgetBackends()
+		self.addCleanup(self.forgetBackends)
+
+	@staticmethod
+	def forgetBackends() -> None:
+		"""The backends discovered and selected while the stand-in is registered must not leak into other tests"""
+		from kaitaiStructCompile import backendSelector
+
+		for name in ("discoveredBackends", "ChosenBackend"):
+			backendSelector.__dict__.pop(name, None)
+		backendSelector.clearSelectedBackendsCache()
+
 
 class Test(unittest.TestCase):
 	def testCompile(self):
@@ -60,5 +122,1010 @@ class Test(unittest.TestCase):
 		self.assertEqual(r.test._debug["test"]["end"], len(testDataBin))
 
 
+class TestCompileFunction(StandInTestCase):
+	def getStandInBackend(self):
+		from kaitaiStructCompile.backendSelector import selectAndInitializeBackend
+
+		return selectAndInitializeBackend(tolerableIssues={"standIn"}, forcedBackend="standIn")
+
+	def testInMemoryDoesNotTouchOutputDir(self):
+		from kaitaiStructCompile import compile
+		from kaitaiStructCompile.ICompiler import InMemoryCompileResult
+
+		backendCtorsArgs = []
+
+		class RecordingBackend(self.getStandInBackend()):
+			__slots__ = ()
+
+			def __init__(self, **kwargs):
+				backendCtorsArgs.append(kwargs)
+				super().__init__(**kwargs)
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			inDir = makeKSYTree(d)
+			outDir = d / "output"
+			outDir.mkdir()
+			for kwargs in ({}, {"outputDir": outDir, "needInMemory": True}):
+				res = compile(inDir / "c.ksy", backend=RecordingBackend, additionalFlags=("--no-auto-read",), **kwargs)
+				self.assertEqual(set(res), {"c", "d"})
+				for r in res.values():
+					self.assertIsInstance(r, InMemoryCompileResult)
+					self.assertIsNone(r.path)
+				self.assertEqual(list(outDir.iterdir()), [])
+
+			self.assertEqual([a["additionalFlags"] for a in backendCtorsArgs], [("--no-auto-read",)] * 2)
+
+			res = compile(inDir / "c.ksy", outDir, backend=RecordingBackend)
+			self.assertEqual({p.name for p in outDir.iterdir()}, {"c.py", "d.py"})
+
+
+	def testCompileIterStreamsResults(self):
+		from kaitaiStructCompile import CompilePhase, compileIter
+
+		with TemporaryDirectory() as d, TemporaryDirectory() as outDir:
+			inDir = makeKSYTree(Path(d))
+			outDir = Path(outDir)
+			del standInBackend.invocations[:]
+			events = []
+			for ev in compileIter([inDir / "c.ksy", inDir / "sub" / "d.ksy", inDir / "b.ksy"], outDir, backend=self.getStandInBackend()):
+				events.append((ev.source.name, ev.phase, ev.result.moduleName if ev.result is not None else None, (outDir / "b.py").exists()))
+				self.assertGreaterEqual(ev.elapsed, 0)
+
+		self.assertEqual([[p.name for p in batch] for batch in standInBackend.invocations], [["c.ksy", "d.ksy", "b.ksy"]])
+		# the modules come while the last source has not been compiled yet
+		self.assertEqual(events, [
+			("c.ksy", CompilePhase.started, None, False),
+			("c.ksy", CompilePhase.result, "c", False),
+			("c.ksy", CompilePhase.result, "d", False),
+			("c.ksy", CompilePhase.finished, None, False),
+			("d.ksy", CompilePhase.started, None, False),
+			("d.ksy", CompilePhase.finished, None, False),  # `d` has already been yielded
+			("b.ksy", CompilePhase.started, None, False),
+			("b.ksy", CompilePhase.result, "b", True),
+			("b.ksy", CompilePhase.finished, None, True),
+		])
+
+	def testCompileIterCompilesInChunksByDefault(self):
+		from kaitaiStructCompile import CompilePhase, compileIter
+		from kaitaiStructCompile.ICompiler import ICompiler
+
+		class NonStreamingBackend(self.getStandInBackend()):
+			__slots__ = ()
+			compileIter_ = ICompiler.compileIter_
+
+		with TemporaryDirectory() as d:
+			inDir = makeKSYTree(Path(d))
+			del standInBackend.invocations[:]
+			events = []
+			for ev in compileIter([inDir / "c.ksy", inDir / "sub" / "d.ksy", inDir / "b.ksy"], backend=NonStreamingBackend):
+				events.append((ev.source.name, ev.phase, ev.result.moduleName if ev.result is not None else None, len(standInBackend.invocations)))
+
+		self.assertEqual([[p.name for p in batch] for batch in standInBackend.invocations], [["c.ksy"], ["d.ksy", "b.ksy"]])
+		self.assertEqual(events, [
+			("c.ksy", CompilePhase.started, None, 0),
+			("c.ksy", CompilePhase.result, "c", 1),
+			("c.ksy", CompilePhase.result, "d", 1),
+			("c.ksy", CompilePhase.finished, None, 1),
+			("d.ksy", CompilePhase.started, None, 1),
+			("b.ksy", CompilePhase.started, None, 1),
+			("d.ksy", CompilePhase.finished, None, 2),  # `d` has already been yielded
+			("b.ksy", CompilePhase.result, "b", 2),
+			("b.ksy", CompilePhase.finished, None, 2),
+		])
+
+
+class TestCompileResults(StandInTestCase):
+	def testInFileResultIsNotKeptInMemory(self):
+		import hashlib
+
+		from kaitaiStructCompile.ICompiler import InFileCompileResult
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			results = []
+			for i in range(1000):
+				p = d / ("m" + str(i) + ".py")
+				p.write_bytes(("x = " + repr("ш" * i) + "\r\n").encode("utf-8"))
+				results.append(InFileCompileResult("m" + str(i), "M" + str(i), "", p))
+			(d / "empty.py").write_bytes(b"")
+			results.append(InFileCompileResult("empty", "Empty", "", d / "empty.py"))
+
+			for r in results:
+				data = r.path.read_bytes()
+				with r.bytesView() as b:
+					self.assertEqual(b, data)
+				self.assertEqual(r.digest, hashlib.sha256(data).hexdigest())
+				self.assertEqual(r.getText(), data.decode("utf-8").replace("\r\n", "\n"))
+				self.assertIsNone(r.text)
+
+			r = results[5]
+			digest = r.digest
+			r.copyTo(d / "copy.py")
+			self.assertEqual((d / "copy.py").read_bytes(), r.path.read_bytes())
+			(d / "moved").mkdir()
+			r.moveTo(d / "moved" / "m5.py")
+			self.assertFalse((d / "m5.py").exists())
+			self.assertEqual(r.path, d / "moved" / "m5.py")
+			self.assertEqual(r.digest, digest)
+			with r.bytesView() as b:
+				self.assertEqual(hashlib.sha256(b).hexdigest(), digest)
+
+
+class TestBatching(StandInTestCase):
+	def testTargetsWithSameFlagsAreBatched(self):
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			cfg = makeStandInCfg(d, cache={"enabled": False})
+			cfg["repos"]["local"]["local"]["formats"] = {"c_custom.py": {"path": "c.ksy", "flags": {"readStoresPos": True}}}
+			emitted = transpileWithStandIn(cfg)
+			self.assertEqual([sorted(p.name for p in batch) for batch in standInBackend.invocations], [["a.ksy", "b.ksy", "c.ksy", "d.ksy"], ["c.ksy"]])
+			self.assertEqual(sorted({p.relative_to(d / "output").as_posix() for res, p in emitted}), ["a.py", "b.py", "c.py", "d.py", "sub/d.py"])
+
+	def testResultsArePlacedNearTheirTargets(self):
+		for inMemory in (True, False):
+			with self.subTest(inMemory=inMemory), TemporaryDirectory() as d:
+				d = Path(d)
+				emitted = transpileWithStandIn(makeStandInCfg(d, incremental=False, inMemory=inMemory, cache={"enabled": False}))
+				byTarget = {}
+				for res, p in emitted:
+					byTarget.setdefault(p.parent.relative_to(d / "output").as_posix(), set()).add(p.name)
+				# `sub/d.ksy` is a target itself, so it goes into `sub`, and it is also imported by `c`, so it goes near `c` too
+				self.assertEqual(byTarget, {".": {"a.py", "b.py", "c.py", "d.py"}, "sub": {"d.py"}})
+				for res, p in emitted:
+					self.assertTrue(p.is_file())
+
+	def testPostprocessingInWorkers(self):
+		from kaitaiStructCompile.buildSystemPlugins.common import PostprocessingPool
+		from kaitaiStructCompile.ICompiler import InMemoryCompileResult
+		from kaitaiStructCompile.postprocessors import fixEnums
+
+		def build(d: Path, postprocessingJobs: int):
+			cfg = makeStandInCfg(d, incremental=False, cache={"enabled": False}, postprocessingCache={"enabled": False}, postprocessingJobs=postprocessingJobs)
+			cfg["repos"]["local"]["local"]["search"] = False
+			cfg["postprocessors"] = {"fixEnums": fixEnums, "mark": "standInBackend:markPostprocessed"}
+			cfg["repos"]["local"]["local"]["formats"] = {"c_" + str(i) + ".py": {"path": "c.ksy", "flags": {"verbose": [str(i)]}, "postprocess": ["fixEnums", "mark"]} for i in range(3)}
+			return [(p.relative_to(d).as_posix(), p.read_text()) for res, p in transpileWithStandIn(cfg)]
+
+		with TemporaryDirectory() as d1, TemporaryDirectory() as d2:
+			inProcess = build(Path(d1), 1)
+			self.assertTrue(all(text.endswith("# postprocessed\n") for name, text in inProcess))
+			self.assertEqual(build(Path(d2), 2), inProcess)
+
+		pool = PostprocessingPool(2)
+		try:
+			f = pool.submit(InMemoryCompileResult("a", "A", "", ""), {standInBackend.appendPid: ()}, ())
+			self.assertNotEqual(pool.getText(f), str(os.getpid()))
+			f = pool.submit(InMemoryCompileResult("a", "A", "", ""), {(lambda fileText, fileName: fileText + "local"): ()}, ())
+			self.assertEqual(pool.getText(f), "local")  # unpicklable, so run in this process
+		finally:
+			pool.close()
+
+	def testWritingOverlapsCompilation(self):
+		import time
+		from unittest.mock import patch
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			outDir = d / "output"
+			waitedAfter = []
+
+			def waitForOutput(src: Path):
+				"""Blocks the backend after the first source until something is written, so the build fails unless the first target is written while the rest are being compiled"""
+				if waitedAfter:
+					return
+				deadline = time.monotonic() + 10
+				while not any(outDir.glob("*.py")):
+					if time.monotonic() > deadline:
+						raise AssertionError("Nothing has been written while the backend was compiling")
+					time.sleep(0.01)
+				waitedAfter.append(src.name)
+
+			with patch.object(standInBackend, "afterSource", waitForOutput):
+				emitted = transpileWithStandIn(makeStandInCfg(d, incremental=False, cache={"enabled": False}))
+			self.assertEqual(len(waitedAfter), 1)
+			self.assertEqual(len(standInBackend.invocations), 1)
+			self.assertEqual(sorted({p.relative_to(outDir).as_posix() for res, p in emitted}), ["a.py", "b.py", "c.py", "d.py", "sub/d.py"])
+
+	def testParallelCompilationIsDeterministic(self):
+		import contextlib
+		import io
+
+		import kaitaiStructCompile.buildSystemPlugins.common
+
+		def run(d: Path, jobs: int):
+			cfg = makeStandInCfg(d, cache={"enabled": False}, jobs=jobs)
+			cfg["repos"]["local"]["local"]["formats"] = {"c_" + str(i) + ".py": {"path": "c.ksy", "flags": {"verbose": [str(i)]}} for i in range(4)}
+			out = io.StringIO()
+			with contextlib.redirect_stdout(out):
+				emitted = transpileWithStandIn(cfg)
+			self.assertEqual(len(standInBackend.invocations), 5)
+			return [p.relative_to(d).as_posix() for res, p in emitted], out.getvalue().replace(str(d), "")
+
+		with TemporaryDirectory() as d1, TemporaryDirectory() as d2:
+			self.assertEqual(run(Path(d1), 1), run(Path(d2), 4))
+
+
+class TestCompileCache(StandInTestCase):
+	def testHitSkipsBackend(self):
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			emitted = transpileWithStandIn(makeStandInCfg(d, incremental=False))
+			self.assertTrue(standInBackend.invocations)
+			firstRun = {p: p.read_text() for res, p in emitted}
+
+			emitted = transpileWithStandIn(makeStandInCfg(d, incremental=False))
+			self.assertEqual(standInBackend.invocations, [])
+			self.assertEqual({p: p.read_text() for res, p in emitted}, firstRun)
+
+	def testImportedKSYChangeInvalidates(self):
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			transpileWithStandIn(makeStandInCfg(d, incremental=False))
+			testKSYsBackup = dict(testKSYs)
+			try:
+				testKSYs["sub/d.ksy"] += "  - id: test2\n    type: u1\n"
+				transpileWithStandIn(makeStandInCfg(d, incremental=False))
+			finally:
+				testKSYs.update(testKSYsBackup)
+			self.assertEqual(sorted(p.name for batch in standInBackend.invocations for p in batch), ["c.ksy", "d.ksy"])
+
+	def testPostprocessingIsCached(self):
+		from unittest.mock import patch
+
+		from kaitaiStructCompile.cache import DiskCache
+		from kaitaiStructCompile.postprocessors import fixEnums
+
+		def build(d: Path, **kwargs):
+			cfg = makeStandInCfg(d, incremental=False, cache={"enabled": False}, **kwargs)
+			cfg["repos"]["local"]["local"]["formats"] = {"c_fixed.py": {"path": "c.ksy", "postprocess": ["fixEnums", "permissiveDecoding"]}}
+			emitted = transpileWithStandIn(cfg)
+			return DiskCache(d / "postprocessingCache").loadTotalStats(), {p.relative_to(d): p.read_text() for res, p in emitted}
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			stats, first = build(d)
+			self.assertEqual((stats.hits, stats.stores), (0, 2))
+			stats, second = build(d)
+			self.assertEqual((stats.hits, stats.stores), (2, 2))
+			self.assertEqual(first, second)
+
+			with patch.object(fixEnums, "version", fixEnums.version + 1):
+				stats, bumped = build(d)
+			self.assertEqual((stats.hits, stats.stores), (2, 4))  # the results of the previous version are not reused
+			self.assertEqual(bumped, first)
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			build(d, postprocessingCache={"dir": d / "postprocessingCache", "uncacheable": ["fixEnums"]})
+			stats, third = build(d, postprocessingCache={"dir": d / "postprocessingCache", "uncacheable": ["fixEnums"]})
+			self.assertEqual((stats.hits, stats.stores), (2, 2))  # only `permissiveDecoding` is cached
+			self.assertEqual(third, first)
+
+	def testUnchangedOutputsAreNotRewritten(self):
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			cfg = makeStandInCfg(d, incremental=False)
+			first = {p: p.stat() for res, p in transpileWithStandIn(cfg)}
+			for p, st in first.items():
+				self.assertEqual(st.st_mode & 0o777, 0o666 & ~getUmask())
+
+			cfg = makeStandInCfg(d, incremental=False)
+			second = {p: p.stat() for res, p in transpileWithStandIn(cfg)}
+			self.assertEqual(standInBackend.invocations, [])
+			self.assertEqual({p: st.st_mtime_ns for p, st in second.items()}, {p: st.st_mtime_ns for p, st in first.items()})
+
+	def testUnchangedOutputsOfOnDiskBackendAreNotRewritten(self):
+		import contextlib
+		import io
+
+		def build(d: Path):
+			out = io.StringIO()
+			with contextlib.redirect_stdout(out):
+				emitted = transpileWithStandIn(makeStandInCfg(d, incremental=False, inMemory=False, cache={"enabled": False}))
+			self.assertTrue(standInBackend.invocations)  # a cache miss, so the backend writes the modules itself
+			return {p: p.stat().st_mtime_ns for res, p in emitted}, len(emitted), out.getvalue()
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			first, count, out = build(d)
+			# the modules imported by several targets are emitted for each of them, but written only once
+			self.assertIn("written=" + str(len(first)) + ", unchanged=" + str(count - len(first)), out)
+			for p in first:
+				os.utime(str(p), ns=(0, 0))
+
+			second, count, out = build(d)
+			self.assertIn("written=0, unchanged=" + str(count), out)
+			self.assertEqual(second, {p: 0 for p in first})
+
+	def testLRUEviction(self):
+		from kaitaiStructCompile.cache import DiskCache
+
+		with TemporaryDirectory() as d:
+			c = DiskCache(Path(d), maxEntries=2)
+			c.put("aa", 1)
+			c.put("bb", 2)
+			os.utime(str(c.entryPath("aa")), ns=(0, 0))
+			os.utime(str(c.entryPath("bb")), ns=(1, 1))
+			self.assertEqual(c.get("aa"), 1)  # bumps `aa`, so `bb` is the LRU one
+			c.put("cc", 3)
+			self.assertIsNone(c.get("bb"))
+			self.assertEqual(c.get("cc"), 3)
+			self.assertEqual((c.stats.hits, c.stats.misses, c.stats.stores, c.stats.evictions), (2, 1, 3, 1))
+			c.flushStats()
+			self.assertEqual(c.loadTotalStats().hits, 2)
+
+
+class TestIncremental(StandInTestCase):
+	def testOnlyAffectedTargetsAreRebuilt(self):
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			emitted = transpileWithStandIn(makeStandInCfg(d, cache={"enabled": False}))
+			self.assertEqual(len(standInBackend.invocations), 1)
+
+			emittedAgain = transpileWithStandIn(makeStandInCfg(d, cache={"enabled": False}))
+			self.assertEqual(standInBackend.invocations, [])
+			self.assertEqual([p for res, p in emittedAgain], [p for res, p in emitted])
+
+			testKSYsBackup = dict(testKSYs)
+			try:
+				testKSYs["sub/d.ksy"] += "  - id: test2\n    type: u1\n"
+				transpileWithStandIn(makeStandInCfg(d, cache={"enabled": False}))
+			finally:
+				testKSYs.update(testKSYsBackup)
+			self.assertEqual([sorted(p.name for p in batch) for batch in standInBackend.invocations], [["c.ksy", "d.ksy"]])
+
+			transpileWithStandIn(makeStandInCfg(d, cache={"enabled": False}, flags={"readStoresPos": True}))
+			self.assertEqual(len(standInBackend.invocations[0]), 4)
+
+	def testDependencyGraphAPI(self):
+		from kaitaiStructCompile.dependencyGraph import KSYDependencyGraph
+
+		with TemporaryDirectory() as d:
+			inDir = makeKSYTree(Path(d))
+			g = KSYDependencyGraph.fromDirs([inDir])
+			self.assertEqual(g.imports(inDir / "c.ksy"), (str(inDir / "sub" / "d.ksy"),))
+			self.assertEqual(g.dependents(inDir / "b.ksy"), (str(inDir / "a.ksy"),))
+			self.assertEqual(g.transitiveDependents([inDir / "sub" / "d.ksy"]), {str(inDir / "c.ksy")})
+
+			g.save(Path(d) / "g.json")
+			g = KSYDependencyGraph.load(Path(d) / "g.json")
+			(inDir / "b.ksy").write_text(testKSYs["b.ksy"] + "  - id: test2\n    type: u1\n")
+			changed = g.update((p, ()) for p in sorted(inDir.glob("**/*.ksy")))
+			self.assertEqual(changed, {str(inDir / "b.ksy")})
+			self.assertEqual(g.affectedBy(changed), {str(inDir / "a.ksy"), str(inDir / "b.ksy")})
+
+
+class TestKSYSearch(StandInTestCase):
+	def testPruningAndPatterns(self):
+		from kaitaiStructCompile.ksyScanner import walkKSYs
+
+		with TemporaryDirectory() as d:
+			inDir = makeKSYTree(Path(d))
+			(inDir / ".git").mkdir()
+			(inDir / ".git" / "e.ksy").write_text(testKSYs["b.ksy"], encoding="utf-8")
+
+			def rel(it):
+				return sorted(p.relative_to(inDir).as_posix() for p in it)
+
+			self.assertEqual(rel(walkKSYs(inDir)), ["a.ksy", "b.ksy", "c.ksy", "sub/d.ksy"])
+			self.assertEqual(rel(walkKSYs(inDir, exclude=["sub"])), ["a.ksy", "b.ksy", "c.ksy"])
+			self.assertEqual(rel(walkKSYs(inDir, include=["*d.ksy", "a.*"])), ["a.ksy", "sub/d.ksy"])
+
+	def testUnchangedDirsAreNotListed(self):
+		from kaitaiStructCompile.ksyScanner import KSYDirsIndex, walkKSYs
+
+		with TemporaryDirectory() as d:
+			inDir = makeKSYTree(Path(d))
+			for sub in (inDir, inDir / "sub"):
+				os.utime(sub, (1, 1))
+			indexFile = Path(d) / "index.json"
+
+			index = KSYDirsIndex.load(indexFile)
+			first = list(walkKSYs(inDir, index=index))
+			self.assertEqual(index.listed, 2)
+			index.save(indexFile)
+
+			index = KSYDirsIndex.load(indexFile)
+			self.assertEqual(list(walkKSYs(inDir, index=index)), first)
+			self.assertEqual(index.listed, 0)
+
+			(inDir / "sub" / "e.ksy").write_text(testKSYs["b.ksy"], encoding="utf-8")
+			os.utime(inDir / "sub", (2, 2))
+			self.assertEqual(len(list(walkKSYs(inDir, index=index))), len(first) + 1)
+			self.assertEqual(index.listed, 1)
+
+	def testSearchExcludeInCfg(self):
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			cfg = makeStandInCfg(d, cache={"enabled": False}, searchExclude=["a.ksy", "sub"])
+			transpileWithStandIn(cfg)
+			self.assertEqual([sorted(p.name for p in batch) for batch in standInBackend.invocations], [["b.ksy", "c.ksy"]])
+
+
+class TestPostprocessing(StandInTestCase):
+	def testFixEnumsIsTwoPass(self):
+		from kaitaiStructCompile.postprocessors import fixEnums
+
+		text = "\n".join((
+			"from enum import Enum",
+			"",
+			"class Root(KaitaiStruct):",
+			"",
+			"    class Item(KaitaiStruct):",
+			"",
+			"        def _read(self):",
+			"            self.kind = KaitaiStream.resolve_enum(Root.Kind, self._io.read_u1())",
+			"            self.isA = self.kind.value == Root.Kind.a.value",
+			"            self.other = self.value",
+			"",
+			"    class Kind(Enum):",
+			"        a = 0",
+			"",
+		))
+		res = fixEnums(text, "<test>")
+		self.assertIn("class Kind(IntEnum)", res)
+		self.assertIn("self.isA = self.kind == Root.Kind.a", res)  # used before the definition
+		self.assertIn("self.other = self.value", res)  # not a enum field
+
+	def testFixEnumsSplicedKeepsSource(self):
+		import ast
+
+		from kaitaiStructCompile.postprocessors import fixEnums, fixEnumsSpliced
+
+		text = "\n".join((
+			"from enum import Enum  # the enums",
+			"",
+			"class Root(KaitaiStruct):",
+			"",
+			"    class Kind(Enum):",
+			"        a = 0  # первый",
+			"",
+			"    def _read(self):",
+			"        self.kind = KaitaiStream.resolve_enum(Root.Kind, self._io.read_u1())",
+			"        self.s = u\"ш\"; self.isA = (self.kind.value  ==  Root.Kind.a.value)",
+			"",
+		))
+		res = fixEnumsSpliced(text, "<test>")
+		self.assertEqual(ast.dump(ast.parse(res)), ast.dump(ast.parse(fixEnums(text, "<test>"))))
+		self.assertIn("from enum import IntEnum  # the enums", res)
+		self.assertIn("        a = 0  # первый", res)
+		self.assertIn("self.s = u\"ш\"; self.isA = (self.kind  ==  Root.Kind.a)", res)
+
+	def testASTPostprocessorsShareTree(self):
+		import ast
+		from unittest.mock import patch
+
+		from kaitaiStructCompile.postprocessors import astPostprocessor, fixEnums, permissiveDecoding, runPostprocessingChain
+
+		@astPostprocessor
+		def renameRoot(tree, fileName):
+			tree.body[-1].name = "Renamed"
+			return tree
+
+		text = "from enum import Enum\n\nclass Root:\n\n    class Kind(Enum):\n        a = 0\n\n    def _read(self):\n        self.s = self._io.read_bytes(1).decode('ascii')\n"
+		tasks = [(fixEnums, ()), (permissiveDecoding, ()), (renameRoot, ())]
+
+		separately = text
+		for postprocessor, args in tasks:
+			separately = postprocessor(separately, "<test>", *args)
+
+		with patch.object(ast, "parse", wraps=ast.parse) as parse, patch.object(ast, "unparse", wraps=ast.unparse) as unparse:
+			chained = runPostprocessingChain(text, "<test>", tasks)
+			self.assertEqual((parse.call_count, unparse.call_count), (1, 1))
+
+		self.assertEqual(ast.dump(ast.parse(chained)), ast.dump(ast.parse(separately)))  # only quotes may differ
+		self.assertIn("class Renamed", chained)
+		self.assertIn("IntEnum", chained)
+		self.assertIn("errors=\"ignore\"", chained)
+
+
+class TestBytecode(StandInTestCase):
+	def testEmittedModulesAreByteCompiled(self):
+		from importlib.util import cache_from_source, source_hash
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			cfg = makeStandInCfg(d, incremental=False, bytecode={"enabled": True, "optimizationLevels": [0, 2], "jobs": 2})
+			emitted = transpileWithStandIn(cfg)
+			sources = [p for res, p in emitted if p.suffix == ".py"]
+			pycs = {p: p.stat().st_mtime_ns for res, p in emitted if p.suffix == ".pyc"}
+			self.assertEqual(set(pycs), {Path(cache_from_source(str(p), optimization=level)) for p in sources for level in ("", 2)})
+
+			for p in sources:
+				header = Path(cache_from_source(str(p))).read_bytes()[:16]
+				self.assertEqual(int.from_bytes(header[4:8], "little"), 0b11)  # checked hash-based
+				self.assertEqual(header[8:16], source_hash(p.read_bytes()))
+
+			cfg = makeStandInCfg(d, incremental=False, bytecode={"enabled": True, "optimizationLevels": [0, 2], "jobs": 2})
+			self.assertEqual({p: p.stat().st_mtime_ns for res, p in transpileWithStandIn(cfg) if p.suffix == ".pyc"}, pycs)
+
+
+class TestPatches(StandInTestCase):
+	def testRefspecPatchSetIsParsedOnce(self):
+		import difflib
+		from unittest.mock import patch
+
+		from kaitaiStructCompile import postprocessors
+
+		def makeDiff(moduleName: str, imports) -> str:
+			original = standInBackend.generateModule(moduleName, imports, testKSYs["c.ksy" if moduleName == "c" else "sub/d.ksy"])
+			patched = original.replace("        self._read()\n", "        self._read()\n        self.patched = " + repr(moduleName) + "\n")
+			return "".join(difflib.unified_diff(original.splitlines(True), patched.splitlines(True), "a/" + moduleName + ".py", "b/" + moduleName + ".py"))
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			(d / "vendored.patch").write_text(makeDiff("c", ["sub/d"]) + makeDiff("d", []))
+			cfg = makeStandInCfg(d, incremental=False, cache={"enabled": False}, postprocessingCache={"enabled": False}, postprocessingJobs=1)
+			refspecCfg = cfg["repos"]["local"]["local"]
+			refspecCfg.update(search=False, formats={"c.py": {"path": "c.ksy"}}, patches=["vendored.patch"])
+
+			postprocessors._patchSets.clear()
+			with patch.object(postprocessors.patch, "PatchSet", wraps=postprocessors.patch.PatchSet) as patchSetCtor:
+				emitted = transpileWithStandIn(cfg)
+
+			self.assertEqual(patchSetCtor.call_count, 1)
+			texts = {p.name: p.read_text() for res, p in emitted}
+			self.assertIn("self.patched = 'c'", texts["c.py"])
+			self.assertIn("self.patched = 'd'", texts["d.py"])
+
+	def testOneFilePatchOfRefspecIsAppliedOnlyToItsFile(self):
+		import difflib
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			original = standInBackend.generateModule("c", ["sub/d"], testKSYs["c.ksy"])
+			patched = original.replace("        self._read()\n", "        self._read()\n        self.patched = True\n")
+			(d / "c.patch").write_text("".join(difflib.unified_diff(original.splitlines(True), patched.splitlines(True), "a/c.py", "b/c.py")))
+			cfg = makeStandInCfg(d, incremental=False, cache={"enabled": False}, postprocessingCache={"enabled": False}, postprocessingJobs=1)
+			refspecCfg = cfg["repos"]["local"]["local"]
+			refspecCfg.update(search=False, formats={"c.py": {"path": "c.ksy"}}, patches=["c.patch"])
+
+			texts = {p.name: p.read_text() for res, p in transpileWithStandIn(cfg)}
+			self.assertIn("self.patched = True", texts["c.py"])
+			self.assertEqual(texts["d.py"], standInBackend.generateModule("d", [], testKSYs["sub/d.ksy"]))
+
+
+class TestTracing(StandInTestCase):
+	def testTraceIsWritten(self):
+		import json
+		from unittest.mock import patch
+
+		from kaitaiStructCompile.buildSystemPlugins.common import doTranspilationWithCfg, prepareCfg
+		from kaitaiStructCompile.tracing import getTracer
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			cfg = makeStandInCfg(d, trace="trace.json", postprocessingJobs=2)
+			cfg["repos"]["local"]["local"]["formats"] = {"c_fixed.py": {"path": "c.ksy", "postprocess": ["fixEnums"]}}
+			transpileWithStandIn(cfg)
+			self.assertFalse(getTracer().enabled)
+
+			events = json.loads((d / "trace.json").read_text())["traceEvents"]
+			names = {ev["name"] for ev in events}
+			for name in ("config preparation", "build", "KSY scan", "backend select", "compile", "parse", "postprocess fixEnums", "unparse", "write"):
+				self.assertIn(name, names)
+			self.assertNotIn(os.getpid(), {ev["pid"] for ev in events if ev["name"] == "postprocess fixEnums"})  # merged from the workers
+
+			with patch.dict(os.environ, {"KAITAI_STRUCT_COMPILE_TRACE": str(d / "fromEnv.json")}):
+				transpileWithStandIn(makeStandInCfg(d))
+			self.assertIn("build", {ev["name"] for ev in json.loads((d / "fromEnv.json").read_text())["traceEvents"]})
+
+			cfg = makeStandInCfg(d, trace="plugin.json")
+			prepareCfg(cfg)  # as the `setuptools` plugin does, before running the command
+			doTranspilationWithCfg(cfg)
+			self.assertIn("config preparation", {ev["name"] for ev in json.loads((d / "plugin.json").read_text())["traceEvents"]})
+
+	def testMessagesGoToListeners(self):
+		import contextlib
+		import io
+		from unittest.mock import patch
+
+		from kaitaiStructCompile.tracing import getTracer
+
+		with TemporaryDirectory() as d:
+			d = Path(d)
+			received = []
+			out = io.StringIO()
+			with patch.object(getTracer(), "listeners", [received.append]), contextlib.redirect_stdout(out):
+				transpileWithStandIn(makeStandInCfg(d))
+				transpileWithStandIn(makeStandInCfg(d, trace="trace.json"))
+			self.assertEqual(out.getvalue(), "")  # the default listener printing them has been replaced
+
+			messages = [ev["args"]["message"] for ev in received if ev["ph"] == "i"]
+			self.assertEqual(sum(1 for m in messages if "Outputs" in m), 2)
+			self.assertTrue(any("Trace written" in m for m in messages))
+			self.assertTrue(any(ev["ph"] == "X" for ev in received))  # the tracer started by the build has got the listeners
+
+
+class TestBackendSelection(StandInTestCase):
+	def testSelectionIsMemoized(self):
+		from kaitaiStructCompile import backendSelector
+
+		backendSelector.clearSelectedBackendsCache()
+		descriptor, cls = backendSelector.selectAndInitializeBackendWithDescriptor(tolerableIssues={"standIn"}, forcedBackend="standIn")
+		self.assertEqual(descriptor.name, "standIn")
+		self.assertIs(backendSelector.selectAndInitializeBackendWithDescriptor(tolerableIssues={"standIn"}, forcedBackend="standIn")[1], cls)
+
+	def testDiscoveryIsMemoized(self):
+		from unittest.mock import patch
+
+		from kaitaiStructCompile import backendSelector
+
+		discovered = []
+
+		def discover():
+			discovered.append(True)
+			return backendSelector.discoverBackends()
+
+		with patch.dict(backendSelector.__dict__), patch.dict(backendSelector._lazyGlobals, discoveredBackends=discover):
+			backendSelector.__dict__.pop("discoveredBackends", None)
+			res = backendSelector.getDiscoveredBackends()
+			self.assertIs(backendSelector.getDiscoveredBackends(), res)
+			self.assertIs(backendSelector.discoveredBackends, res)
+		self.assertEqual(len(discovered), 1)
+
+	def testLatencyRanking(self):
+		from unittest.mock import patch
+
+		from kaitaiStructCompile import backendSelector
+
+		def makeDescriptor(name: str, prio: int) -> "backendSelector.BackendDescriptor":
+			return backendSelector.recognizeBackends(next(backendSelector.parseAdditionalEntryPoints([name + '@{"prio": ' + str(prio) + ', "issues": ["standIn"]} = standInBackend:init'])), version=name)
+
+		backends = backendSelector.descriptorsIntoBackends([makeDescriptor("slow", 2), makeDescriptor("broken", 1), makeDescriptor("fast", 0)])
+		latencies = {"slow": 0.5, "broken": None, "fast": 0.1}
+
+		def select(ranking: str) -> list:
+			return [b.name for b in backendSelector.iterateSuitableBackends(tolerableIssues={"standIn"}, backendsPresent=backends, forcedBackend="", ranking=ranking)]
+
+		def calibrate(b, kaitaiStructRoot=None):
+			calibrated.append((b.name, kaitaiStructRoot))
+			return latencies[b.name]
+
+		backendSelector.clearSelectedBackendsCache()
+		with TemporaryDirectory() as d, patch.dict(os.environ, {"KAITAI_STRUCT_COMPILE_CACHE_DIR": d}):
+			self.assertIsInstance(backendSelector.calibrateBackend(backends["fast"]), float)  # the stand-in is healthy
+
+			calibrated = []
+			backendSelector._saveLatencyCache(backendSelector.getLatencyCacheFile(backends["slow"].identity), backends["slow"].identity, latencies["slow"])
+			with patch.object(backendSelector, "calibrateBackend", side_effect=calibrate):
+				self.assertEqual(select("prio"), ["slow", "broken", "fast"])
+				self.assertEqual(calibrated, [])
+				self.assertEqual([b.name for b in backendSelector.iterateSuitableBackends(tolerableIssues={"standIn"}, backendsPresent=backends, forcedBackend="fast", ranking="latency")], ["fast"])
+				self.assertEqual(calibrated, [])  # a single suitable backend needs no ranking
+				self.assertEqual(select("latency"), ["fast", "slow", "broken"])
+				self.assertEqual(calibrated, [("broken", None), ("fast", None)])  # `slow` has its timing cached
+				self.assertEqual(select("latency"), ["fast", "slow", "broken"])
+				self.assertEqual(len(calibrated), 2)  # once per backend version
+
+				del calibrated[:]
+				list(backendSelector.iterateSuitableBackends(tolerableIssues={"standIn"}, backendsPresent=backends, forcedBackend="", ranking="latency", kaitaiStructRoot=d))
+				self.assertEqual(calibrated, [(name, d) for name in ("slow", "broken", "fast")])  # with the KSC they are going to use
+
+			with patch.dict(os.environ, {"KAITAI_STRUCT_COMPILE_BACKEND_RANKING": "latency"}):
+				self.assertEqual(backendSelector.selectAndInitializeBackendWithDescriptor(tolerableIssues={"standIn"}, backendsPresent=backends, forcedBackend="")[0].name, "fast")
+
+	def testDiscoveryIsPersisted(self):
+		from unittest.mock import patch
+
+		from kaitaiStructCompile import backendSelector
+
+		with TemporaryDirectory() as d, patch.dict(os.environ, {"KAITAI_STRUCT_COMPILE_CACHE_DIR": d}):
+			first = backendSelector.discoverInstalledEntryPoints()
+			self.assertTrue(backendSelector.getDiscoveryCacheFile().is_file())
+			with patch.object(backendSelector, "_discoverEntryPoints", side_effect=AssertionError("Must not be rescanned")):
+				self.assertEqual(backendSelector.discoverInstalledEntryPoints(), first)
+				self.assertIn("standIn", backendSelector.discoverBackends())
+
+
+class TestRepoUpdates(StandInTestCase):
+	"""Against a local bare repo standing in for the remote one"""
+
+	def setUp(self) -> None:
+		import git
+
+		super().setUp()
+		self.tempDir = TemporaryDirectory()
+		self.root = Path(self.tempDir.name)
+		self.actor = git.Actor("test", "test@example.org")
+		self.work = git.Repo.init(str(self.root / "work"))
+		self.bareDir = self.root / "formats.git"
+		bare = git.Repo.init(str(self.bareDir), bare=True)
+		bare.git.symbolic_ref("HEAD", "refs/heads/main")
+		self.work.create_remote("origin", str(self.bareDir))
+		self.local = self.root / "local"
+
+	def tearDown(self) -> None:
+		self.tempDir.cleanup()
+
+	def commit(self, text: str, tag: str = None) -> str:
+		(self.root / "work" / "a.ksy").write_text(text)
+		self.work.index.add(["a.ksy"])
+		c = self.work.index.commit(text, author=self.actor, committer=self.actor)
+		self.work.git.push("origin", "HEAD:refs/heads/main")
+		if tag:
+			self.work.create_tag(tag)
+			self.work.git.push("origin", "refs/tags/" + tag)
+		return c.hexsha
+
+	def update(self, refspec: str = "", ttl: float = 0, gitUri: str = None) -> str:
+		import git
+
+		from kaitaiStructCompile.repo import upgradeLibrary
+
+		upgradeLibrary(self.local, gitUri or str(self.bareDir), refspec, ttl=ttl)
+		return git.Repo(str(self.local)).head.commit.hexsha
+
+	def testUpdatesUseNetworkOnlyWhenNeeded(self):
+		from unittest.mock import patch
+
+		import git
+
+		from kaitaiStructCompile import repo
+
+		first = self.commit("first", tag="v1")
+		self.assertEqual(self.update(ttl=3600), first)
+		self.assertEqual(git.Repo(str(self.local)).active_branch.name, "main")  # the default branch of the remote
+
+		second = self.commit("second")
+		with patch.object(repo, "lsRemote", side_effect=AssertionError("Must be within TTL")):
+			self.assertEqual(self.update(ttl=3600), first)
+		self.assertEqual(self.update(), second)
+
+		(self.local / "a.ksy").write_text("edited")
+		with patch.object(git.Remote, "fetch", side_effect=AssertionError("Already present")):
+			self.assertEqual(self.update(), second)
+		self.assertEqual((self.local / "a.ksy").read_text(), "edited")  # HEAD matches, so the working tree is not reset
+
+		self.assertEqual(self.update("v1"), first)
+		self.assertEqual((self.local / "a.ksy").read_text(), "first")
+		self.assertEqual(self.update(first[:10], gitUri=str(self.root / "nonexistent.git")), first)  # pinned, so the remote is not needed
+		self.assertEqual(self.update("v1", gitUri=str(self.root / "nonexistent.git")), first)
+
+		self.bareDir.rename(self.root / "unreachable.git")
+		with self.assertWarns(UserWarning):
+			self.assertEqual(self.update(), second)  # the last known commit
+
+
+	def testSparseCheckoutOfNeededKSYs(self):
+		from unittest.mock import patch
+
+		import git
+
+		from kaitaiStructCompile.repo import upgradeLibrary
+
+		files = {
+			"fmt/a.ksy": "meta:\n  id: a\n  imports:\n    - ../common/b\n",
+			"common/b.ksy": "meta:\n  id: b\n  imports:\n    - /common/c\n",
+			"common/c.ksy": "meta:\n  id: c\n",
+			"other/x.ksy": "meta:\n  id: x\n",
+			"other/y.ksy": "meta:\n  id: y\n",
+		}
+		for name, text in files.items():
+			p = self.root / "work" / name
+			p.parent.mkdir(parents=True, exist_ok=True)
+			p.write_text(text)
+		self.work.index.add(list(files))
+		self.work.index.commit("formats", author=self.actor, committer=self.actor)
+		self.work.git.push("origin", "HEAD:refs/heads/main")
+		git.Repo(str(self.bareDir)).git.config("uploadpack.allowFilter", "true")
+
+		upgradeLibrary(self.local, self.bareDir.as_uri(), sparsePaths=["fmt/", "other/y.ksy"])
+		present = {p.relative_to(self.local).as_posix() for p in self.local.rglob("*.ksy")}
+		self.assertEqual(present, {"fmt/a.ksy", "common/b.ksy", "common/c.ksy", "other/y.ksy"})
+
+		missingObjects = git.Repo(str(self.local)).git.rev_list("--objects", "--missing=print", "--all").splitlines()
+		self.assertEqual(sum(1 for l in missingObjects if l.startswith("?")), 1)  # the blob of `other/x.ksy` has not been fetched
+
+		with patch.object(git.cmd.Git, "read_tree", side_effect=AssertionError("Nothing has changed"), create=True):
+			upgradeLibrary(self.local, self.bareDir.as_uri(), sparsePaths=["fmt/", "other/y.ksy"])
+
+		upgradeLibrary(self.local, self.bareDir.as_uri(), sparsePaths=["other/y.ksy"])
+		self.assertEqual({p.relative_to(self.local).as_posix() for p in self.local.rglob("*.ksy")}, {"other/y.ksy"})  # the paths no longer needed are removed
+
+		upgradeLibrary(self.local, self.bareDir.as_uri())
+		self.assertEqual({p.relative_to(self.local).as_posix() for p in self.local.rglob("*.ksy")}, set(files))
+
+
+class TestCfgValidation(StandInTestCase):
+	def testValidatedCfgIsNotRevalidated(self):
+		from unittest.mock import patch
+
+		import jsonschema
+
+		from kaitaiStructCompile.schemas import validators
+
+		cfg = {"repos": {}, "jobs": 3}
+		validators.validateCfg(cfg)
+		with patch.object(validators, "getValidator", side_effect=AssertionError("Must be memoized")):
+			validators.validateCfg({"repos": {}, "jobs": 3})
+		with self.assertRaises(jsonschema.ValidationError):
+			validators.validateCfg({"repos": {}, "jobs": -1})
+		with self.assertRaises(jsonschema.ValidationError):
+			validators.validateCfg({"repos": {}, "jobs": 3.5})
+
+	def testSetuptoolsOptionsAreConvertedToSchemaTypes(self):
+		from setuptools.dist import Distribution
+
+		from kaitaiStructCompile.buildSystemPlugins.setuptools import kaitai_transpile
+
+		with TemporaryDirectory() as d:
+			dist = Distribution()
+			dist.kaitai = makeStandInCfg(Path(d))
+			cmd = kaitai_transpile(dist)
+			# the way they come from the command line or `setup.cfg`
+			cmd.bytecode_enabled = "yes"
+			cmd.bytecode_jobs = "4"
+			cmd.bytecode_optimizationLevels = "[0, 2]"
+			cmd.bytecode_invalidationMode = "unchecked-hash"
+			cmd.cache_maxSize = "1048576"
+			cmd.cache_maxEntries = ""
+			cmd.postprocessingCache_maxEntries = "100"
+			cmd.finalize_options()
+
+			self.assertEqual(dist.kaitai["bytecode"], {"enabled": True, "jobs": 4, "optimizationLevels": [0, 2], "invalidationMode": "unchecked-hash"})
+			self.assertEqual((dist.kaitai["cache"]["maxSize"], dist.kaitai["cache"]["maxEntries"]), (1048576, None))
+			self.assertEqual(dist.kaitai["postprocessingCache"]["maxEntries"], 100)
+
+
+class TestDaemon(StandInTestCase):
+	def daemonEnv(self):
+		from unittest.mock import patch
+
+		return patch.dict(os.environ, {
+			"KAITAI_STRUCT_COMPILE_DAEMON_BACKEND": "standIn",
+			"KAITAI_STRUCT_COMPILE_TOLERATE_ISSUES": "standIn",
+			"PYTHONPATH": os.pathsep.join((str(testsDir), os.environ.get("PYTHONPATH", ""))),
+		})
+
+	def testDaemonIsReused(self):
+		from kaitaiStructCompile.daemon import DaemonCompiler, request, shutdown
+
+		with TemporaryDirectory() as d, self.daemonEnv():
+			d = Path(d)
+			inDir = makeKSYTree(d)
+			sock = d / "daemon.sock"
+			try:
+				res = DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock).compile([inDir / "a.ksy"], None)
+				pid = request(sock, {"op": "ping"})["pid"]
+				self.assertEqual(sorted(res), ["a", "b"])
+				self.assertEqual(res["a"].getText(), standInBackend.generateModule("a", ("b",), testKSYs["a.ksy"]))
+
+				res = DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock).compile([inDir / "c.ksy"], None)
+				self.assertEqual(sorted(res), ["c", "d"])
+				self.assertEqual(request(sock, {"op": "ping"})["pid"], pid)
+			finally:
+				shutdown(sock)
+
+	def testOutOfProcessBackendIsRefused(self):
+		from unittest.mock import patch
+
+		from kaitaiStructCompile.daemon import DaemonServer
+		from kaitaiStructCompile.KaitaiCompilerException import KaitaiCompilerException
+
+		origInit = standInBackend.init
+
+		def initOutOfProcess(*args):
+			compilerClass = origInit(*args)
+			compilerClass.inProcess = False
+			return compilerClass
+
+		with TemporaryDirectory() as d:
+			server = DaemonServer(Path(d) / "daemon.sock", 1)
+			try:
+				self.assertTrue(server.getCompilerClass(["standIn"], "standIn").inProcess)
+
+				self.forgetBackends()
+				with patch.object(standInBackend, "init", initOutOfProcess):
+					with self.assertRaisesRegex(KaitaiCompilerException, "no benefit.*standIn"):
+						server.getCompilerClass(["standIn"], "standIn")
+			finally:
+				server.server_close()
+
+	def testCompileIterIsStreamed(self):
+		from kaitaiStructCompile.daemon import DaemonCompiler, shutdown
+		from kaitaiStructCompile.ICompiler import CompilePhase
+
+		with TemporaryDirectory() as d, self.daemonEnv():
+			d = Path(d)
+			inDir = makeKSYTree(d)
+			sock = d / "daemon.sock"
+			try:
+				events = [(ev.source.name, ev.phase, ev.result.getText() if ev.result is not None else None) for ev in DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock).compileIter([inDir / "a.ksy", inDir / "b.ksy"], None)]
+			finally:
+				shutdown(sock)
+
+		self.assertEqual(events, [
+			("a.ksy", CompilePhase.started, None),
+			("a.ksy", CompilePhase.result, standInBackend.generateModule("a", ("b",), testKSYs["a.ksy"])),
+			("a.ksy", CompilePhase.result, standInBackend.generateModule("b", (), testKSYs["b.ksy"])),
+			("a.ksy", CompilePhase.finished, None),
+			("b.ksy", CompilePhase.started, None),
+			("b.ksy", CompilePhase.finished, None),
+		])
+
+	def testForeignSocketDirIsRefused(self):
+		from kaitaiStructCompile.daemon import DaemonCompiler
+		from kaitaiStructCompile.KaitaiCompilerException import KaitaiCompilerException
+
+		with TemporaryDirectory() as d, self.daemonEnv():
+			d = Path(d)
+			inDir = makeKSYTree(d)
+			sockDir = d / "sockets"
+			sockDir.mkdir(mode=0o755)
+			os.chmod(str(sockDir), 0o755)
+			(d / "link").symlink_to(d / "private", target_is_directory=True)
+			(d / "private").mkdir(mode=0o700)
+			for sock in (sockDir / "daemon.sock", d / "link" / "daemon.sock"):
+				with self.assertRaises(KaitaiCompilerException):
+					DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock).compile([inDir / "b.ksy"], None)
+				self.assertFalse(sock.exists())
+
+	def testPingsAreAnsweredDuringCompilation(self):
+		import threading
+		from unittest.mock import patch
+
+		from kaitaiStructCompile import daemon
+
+		started = threading.Event()
+		release = threading.Event()
+
+		def slowCompile(self, msg: dict) -> dict:
+			started.set()
+			release.wait(10)
+			return {"results": []}
+
+		with TemporaryDirectory() as d, self.daemonEnv(), patch.object(daemon.DaemonServer, "compile", slowCompile):
+			sock = Path(d) / "daemon.sock"
+			serving = threading.Thread(target=daemon.serve, args=(sock, 10.0))
+			serving.start()
+			try:
+				daemon.ensureDaemon(sock, 10.0)
+				compiling = threading.Thread(target=daemon.request, args=(sock, {"op": "compile"}))
+				compiling.start()
+				self.assertTrue(started.wait(10))
+				self.assertEqual(daemon.request(sock, {"op": "ping"}, timeout=2)["pid"], os.getpid())
+
+				daemon.serve(sock, 10.0)  # a second daemon exits and leaves the socket of the live one alone
+				self.assertTrue(daemon.isAlive(sock))
+			finally:
+				release.set()
+				daemon.shutdown(sock)
+				serving.join(10)
+			self.assertFalse(serving.is_alive())
+			self.assertFalse(sock.exists())
+
+	def testBackendIsSelectedWithSettingsOfClient(self):
+		from kaitaiStructCompile.daemon import DaemonCompiler, shutdown
+		from kaitaiStructCompile.KaitaiCompilerException import KaitaiCompilerException
+
+		with TemporaryDirectory() as d, self.daemonEnv():
+			d = Path(d)
+			inDir = makeKSYTree(d)
+			sock = d / "daemon.sock"
+			try:
+				self.assertEqual(sorted(DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock, tolerableIssues={"standIn"}, forcedBackend="standIn").compile([inDir / "b.ksy"], None)), ["b"])
+				with self.assertRaises(KaitaiCompilerException):
+					DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock, tolerableIssues=set(), forcedBackend="standIn").compile([inDir / "b.ksy"], None)  # the stand-in's issue is not tolerated by this client
+			finally:
+				shutdown(sock)
+
+	def testIdleTimeout(self):
+		import time
+
+		from kaitaiStructCompile.daemon import DaemonCompiler
+
+		with TemporaryDirectory() as d, self.daemonEnv():
+			d = Path(d)
+			inDir = makeKSYTree(d)
+			sock = d / "daemon.sock"
+			DaemonCompiler(dirs=str(d), importPath=inDir, socketPath=sock, idleTimeout=0.2).compile([inDir / "b.ksy"], None)
+			deadline = time.monotonic() + 10
+			while sock.exists() and time.monotonic() < deadline:
+				time.sleep(0.05)
+			self.assertFalse(sock.exists())
+
+
 if __name__ == "__main__":
 	unittest.main()